@@ -0,0 +1 @@
+"""Benchmarks for the deepstack_object component."""
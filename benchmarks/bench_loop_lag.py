@@ -0,0 +1,161 @@
+"""
+Benchmark the event loop lag caused by the pixel work of many cameras.
+
+The platform is set up for N cameras against a fake Deepstack, and every
+entity processes frames concurrently, cropping, scaling and saving an
+annotated snapshot of each. Meanwhile a probe sleeps for a short interval
+in a loop on the event loop, and records how late it wakes up: the lag
+that every other integration sees. Each count of cameras is run with the
+pixel work in executor threads, then in image_workers processes, each in
+a fresh process. Run from the repository root:
+
+    python -m benchmarks.bench_loop_lag --cameras 1 4 8 --workers 2
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from homeassistant.core import HomeAssistant
+
+from custom_components.deepstack_object import image_processing
+from custom_components.deepstack_object.instrumentation import percentile
+
+from .bench_pipeline import make_jpeg
+from .stub_server import StubDeepstack, make_predictions
+
+SYNTHETIC_SIZE = (1920, 1080)
+PROBE_INTERVAL = 0.01  # seconds
+
+
+async def probe_lag(lags: list, stop: asyncio.Event):
+    """Record how late each sleep of PROBE_INTERVAL wakes up, in ms."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, loop.time() - start - PROBE_INTERVAL) * 1000)
+
+
+async def run_one(args) -> dict:
+    """Process frames on all cameras while probing the loop, in this process."""
+    images = [make_jpeg(SYNTHETIC_SIZE) for _ in range(4)]
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = HomeAssistant(config_dir)
+        config = {
+            "platform": image_processing.DOMAIN,
+            "ip_address": "127.0.0.1",
+            "source": [
+                {"entity_id": f"camera.lag_{index}"} for index in range(args.run)
+            ],
+            "roi_x_min": 0.1,
+            "roi_x_max": 0.9,
+            "crop_to_roi": True,
+            "scale": 0.5,
+            "save_file_folder": config_dir,
+            "always_save_latest_file": True,
+            "save_queue_policy": "block",
+            "targets": [{"target": "person", "confidence": 10}],
+            "image_workers": args.workers,
+            "max_concurrent_requests": args.run,
+        }
+        predictions = make_predictions(5, *SYNTHETIC_SIZE)
+        async with StubDeepstack(predictions, latency=args.latency) as server:
+            config["port"] = server.port
+            entities = []
+            await image_processing.async_setup_platform(
+                hass, image_processing.PLATFORM_SCHEMA(config), entities.extend
+            )
+            for index, entity in enumerate(entities):
+                entity.hass = hass
+                entity.entity_id = f"image_processing.lag_{index}"
+
+            async def run(entity, offset):
+                for frame in range(args.frames):
+                    await entity.async_process_image(
+                        images[(frame + offset) % len(images)]
+                    )
+
+            # Warm up, starting the worker processes
+            await asyncio.gather(
+                *(entity.async_process_image(images[0]) for entity in entities)
+            )
+            lags, stop = [], asyncio.Event()
+            probe = asyncio.create_task(probe_lag(lags, stop))
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(run(entity, index) for index, entity in enumerate(entities))
+            )
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await probe
+            await hass.async_stop(force=True)
+
+    frames = args.frames * args.run
+    return {
+        "cameras": args.run,
+        "workers": args.workers,
+        "frames_per_second": round(frames / elapsed, 1),
+        "lag_ms": {
+            "p50": round(percentile(lags, 50), 2),
+            "p95": round(percentile(lags, 95), 2),
+            "p99": round(percentile(lags, 99), 2),
+            "max": round(max(lags), 2),
+        },
+    }
+
+
+def main(args):
+    if args.run:
+        print(json.dumps(asyncio.run(run_one(args))))
+        return
+    for cameras in args.cameras:
+        for workers in (0, args.workers):
+            results = [
+                json.loads(
+                    subprocess.run(
+                        [
+                            sys.executable, "-m", "benchmarks.bench_loop_lag",
+                            "--run", str(cameras), "--workers", str(workers),
+                            "--frames", str(args.frames),
+                            "--latency", str(args.latency),
+                        ],
+                        check=True, capture_output=True, text=True,
+                    ).stdout.strip().splitlines()[-1]
+                )
+                for _ in range(args.repeat)
+            ]
+            print(
+                json.dumps(
+                    {
+                        "cameras": cameras,
+                        "pixel_work": f"{workers} processes" if workers else "threads",
+                        "frames_per_second": statistics.median(
+                            result["frames_per_second"] for result in results
+                        ),
+                        "lag_ms": {
+                            key: statistics.median(
+                                result["lag_ms"][key] for result in results
+                            )
+                            for key in ("p50", "p95", "p99", "max")
+                        },
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--cameras", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--workers", type=int, default=2, help="image_workers")
+    parser.add_argument("--frames", type=int, default=20, help="frames per camera")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="processes per run")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    main(parser.parse_args())
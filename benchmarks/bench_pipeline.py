@@ -0,0 +1,127 @@
+"""
+Benchmark preparing and annotating a camera frame, before and after the
+single decode image pipeline.
+
+Each combination runs in its own process, reading a pre-made JPEG, so the
+peak RSS only reflects the processing of that frame size.
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --frames 20
+"""
+import argparse
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from custom_components.deepstack_object.pipeline import (
+    crop_and_scale,
+    decode_image,
+    encode_jpeg,
+)
+
+SIZES = {"1080p": (1920, 1080), "4k": (3840, 2160)}
+ROI = (0.1, 0.2, 0.9, 0.8)  # y_min, x_min, y_max, x_max
+SCALE = 0.5
+
+
+def make_jpeg(size) -> bytes:
+    """Return a noisy JPEG of size, similar in weight to a camera frame."""
+    width, height = size
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (noise, gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    with io.BytesIO() as output:
+        img.save(output, format="JPEG", quality=85)
+        return output.getvalue()
+
+
+def annotate(img: Image.Image):
+    """Draw a box as save_image does."""
+    ImageDraw.Draw(img).rectangle((10, 10, img.width // 2, img.height // 2), outline=(255, 0, 0), width=3)
+
+
+def legacy(image: bytes):
+    """The previous process_image and save_image steps."""
+    img = Image.open(io.BytesIO(bytearray(image)))
+    width, height = img.size
+    img = img.crop((width * ROI[1], height * ROI[0], width * ROI[3], height * ROI[2]))
+    with io.BytesIO() as output:
+        img.save(output, format="JPEG")
+        request = output.getvalue()
+    width, height = img.size
+    img.thumbnail((width * SCALE, width * SCALE), Image.LANCZOS)
+    with io.BytesIO() as output:
+        img.save(output, format="JPEG")
+        request = output.getvalue()
+    saved = img.convert("RGB")
+    annotate(saved)
+    return request
+
+
+def pipeline(image: bytes):
+    """Decode once with draft, crop and scale in one resize, encode once."""
+    img, full_size = decode_image(image, SCALE)
+    img = crop_and_scale(img, full_size, ROI, SCALE)
+    request = encode_jpeg(img)
+    annotate(img)
+    return request
+
+
+def peak_rss_mb() -> float:
+    """Return the peak RSS of this process in MB.
+
+    VmHWM is used rather than ru_maxrss, which carries over the peak of the
+    parent process across fork and exec.
+    """
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_one(variant: str, path: str, frames: int) -> dict:
+    """Time variant on frames frames of the JPEG at path, in this process."""
+    image = Path(path).read_bytes()
+    func = legacy if variant == "legacy" else pipeline
+    func(image)  # warm up
+    start = time.perf_counter()
+    for _ in range(frames):
+        func(image)
+    elapsed = time.perf_counter() - start
+    return {
+        "variant": variant,
+        "size": Path(path).stem,
+        "ms_per_frame": round(elapsed / frames * 1000, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def main(args):
+    if args.variant:
+        print(json.dumps(run_one(args.variant, args.image, args.frames)))
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        for size, dimensions in SIZES.items():
+            path = Path(directory) / f"{size}.jpg"
+            path.write_bytes(make_jpeg(dimensions))
+            for variant in ("legacy", "pipeline"):
+                output = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_pipeline", "--variant", variant,
+                     "--image", str(path), "--frames", str(args.frames)],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                print(output.strip())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--variant", choices=["legacy", "pipeline"])
+    parser.add_argument("--image", help="JPEG to process, used with --variant")
+    main(parser.parse_args())
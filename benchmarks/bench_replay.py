@@ -0,0 +1,235 @@
+"""
+Replay a folder of images through the integration against a fake Deepstack.
+
+Each scenario sets up the platform as Home Assistant would, and the
+entities process every image in turn through async_process_image, so the
+whole path of a scan is measured: preparing the frame, the request,
+filtering the targets, events and saving. Each scenario runs in its own
+process so its peak RSS is its own. Results are written as JSON, and can
+be compared with those of another version. Run from the repository root:
+
+    python -m benchmarks.bench_replay --images /path/to/jpegs --output new.json
+    python -m benchmarks.bench_replay --compare old.json new.json
+
+Without --images, synthetic 1080p frames are replayed. Images are replayed
+in order, a folder of a single image exercises the repeated frame path.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from homeassistant.core import HomeAssistant
+
+from custom_components.deepstack_object import image_processing
+
+from .bench_pipeline import make_jpeg, peak_rss_mb
+from .stub_server import StubDeepstack, make_predictions
+
+MANIFEST = Path(image_processing.__file__).with_name("manifest.json")
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+SYNTHETIC_SIZE = (1920, 1080)
+
+SCENARIOS = {
+    "baseline": {},
+    "crop": {
+        "roi_x_min": 0.2,
+        "roi_x_max": 0.8,
+        "roi_y_min": 0.1,
+        "roi_y_max": 0.9,
+        "crop_to_roi": True,
+    },
+    "scale": {"scale": 0.5},
+    "multi_target": {
+        "targets": [
+            {"target": "person"},
+            {"target": "vehicle", "confidence": 60},
+            {"target": "car", "confidence": 40},
+            {"target": "animal", "confidence": 50},
+            {"target": "dog", "confidence": 30},
+            {"target": "bicycle"},
+            {"target": "chair", "confidence": 20},
+        ]
+    },
+    "save": {
+        "roi_x_min": 0.2,
+        "roi_x_max": 0.8,
+        "save_timestamped_file": True,
+        "always_save_latest_file": True,
+        # Low thresholds, so snapshots are annotated with boxes
+        "targets": [
+            {"target": "person", "confidence": 10},
+            {"target": "car", "confidence": 10},
+        ],
+    },
+}
+
+
+def load_images(folder: str, frames: int) -> list:
+    """Return the bytes of the images in folder, or synthetic frames."""
+    if folder:
+        paths = sorted(
+            path
+            for path in Path(folder).iterdir()
+            if path.suffix.lower() in IMAGE_SUFFIXES
+        )
+        if not paths:
+            raise SystemExit(f"No images in {folder}")
+        return [path.read_bytes() for path in paths]
+    return [make_jpeg(SYNTHETIC_SIZE) for _ in range(min(frames, 8))]
+
+
+async def replay(args) -> dict:
+    """Run one scenario, in this process."""
+    images = load_images(args.images, args.frames)
+    with tempfile.TemporaryDirectory() as config_dir:
+        hass = HomeAssistant(config_dir)
+        config = {
+            "platform": image_processing.DOMAIN,
+            "ip_address": "127.0.0.1",
+            "source": [
+                {"entity_id": f"camera.replay_{index}"} for index in range(args.cameras)
+            ],
+            "stage_timings": True,
+            "max_concurrent_requests": args.max_concurrent_requests,
+            **SCENARIOS[args.scenario],
+        }
+        if args.scenario == "save":
+            config["save_file_folder"] = config_dir
+        predictions = make_predictions(args.predictions, *SYNTHETIC_SIZE)
+        async with StubDeepstack(predictions, latency=args.latency) as server:
+            config["port"] = server.port
+            entities = []
+            await image_processing.async_setup_platform(
+                hass, image_processing.PLATFORM_SCHEMA(config), entities.extend
+            )
+            for index, entity in enumerate(entities):
+                entity.hass = hass
+                entity.entity_id = f"image_processing.replay_{index}"
+
+            async def run(entity):
+                for frame in range(args.frames):
+                    await entity.async_process_image(images[frame % len(images)])
+
+            await entities[0].async_process_image(images[0])  # warm up
+            start = time.perf_counter()
+            await asyncio.gather(*(run(entity) for entity in entities))
+            elapsed = time.perf_counter() - start
+            await hass.async_stop(force=True)  # waits for the queued snapshots
+
+        attributes = entities[0].extra_state_attributes
+        frames = args.frames * args.cameras
+        return {
+            "scenario": args.scenario,
+            "frames": frames,
+            "seconds": round(elapsed, 3),
+            "frames_per_second": round(frames / elapsed, 1),
+            "requests": server.requests,
+            "targets_found": entities[0].state,
+            "stage_timings_ms": attributes["stage_timings_ms"],
+            "scan_copies": attributes["scan_copies"],
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+
+
+def run_scenarios(args) -> dict:
+    """Run each scenario in a subprocess, returning the results with metadata."""
+    results = {}
+    for scenario in args.scenarios:
+        command = [
+            sys.executable, "-m", "benchmarks.bench_replay", "--scenario", scenario,
+            "--frames", str(args.frames), "--cameras", str(args.cameras),
+            "--latency", str(args.latency), "--predictions", str(args.predictions),
+            "--max-concurrent-requests", str(args.max_concurrent_requests),
+        ]
+        if args.images:
+            command += ["--images", args.images]
+        output = subprocess.run(command, check=True, capture_output=True, text=True)
+        results[scenario] = json.loads(output.stdout.strip().splitlines()[-1])
+        print(
+            f"{scenario}: {results[scenario]['frames_per_second']} frames/s, "
+            f"total p95 {results[scenario]['stage_timings_ms']['total']['p95']} ms, "
+            f"peak RSS {results[scenario]['peak_rss_mb']} MB"
+        )
+    return {
+        "version": json.loads(MANIFEST.read_text())["version"],
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "options": {
+            key: getattr(args, key)
+            for key in ("frames", "cameras", "latency", "predictions", "images")
+        },
+        "results": results,
+    }
+
+
+def git_commit() -> str:
+    """Return the short hash of the checked out commit, if in a git repository."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(old_path: str, new_path: str):
+    """Print the change in throughput and latency of each scenario."""
+    old = json.loads(Path(old_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+    print(f"{old['version']} ({old['commit']}) -> {new['version']} ({new['commit']})")
+    for scenario, result in new["results"].items():
+        previous = old["results"].get(scenario)
+        if previous is None:
+            continue
+        changes = []
+        for name, before, after in (
+            ("frames/s", previous["frames_per_second"], result["frames_per_second"]),
+            (
+                "total p95 ms",
+                previous["stage_timings_ms"]["total"]["p95"],
+                result["stage_timings_ms"]["total"]["p95"],
+            ),
+            ("peak RSS MB", previous["peak_rss_mb"], result["peak_rss_mb"]),
+        ):
+            change = (after - before) / before * 100 if before else 0.0
+            changes.append(f"{name} {before} -> {after} ({change:+.1f}%)")
+        print(f"{scenario}: " + ", ".join(changes))
+
+
+def main(args):
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.scenario:
+        print(json.dumps(asyncio.run(replay(args))))
+        return
+    report = run_scenarios(args)
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--images", help="folder of images to replay")
+    parser.add_argument("--frames", type=int, default=50, help="frames per camera")
+    parser.add_argument("--cameras", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--predictions", type=int, default=10)
+    parser.add_argument("--max-concurrent-requests", type=int, default=4)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--scenario", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument("--output", default="bench_replay.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    main(parser.parse_args())
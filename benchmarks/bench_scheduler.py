@@ -0,0 +1,103 @@
+"""
+Benchmark the detection scheduler against direct requests during a scan storm.
+
+Every camera triggers a scan at a fixed interval without waiting for the
+previous scan, as happens when automations call image_processing.scan on
+many entities. Run from the repository root:
+
+    python -m benchmarks.bench_scheduler --cameras 20 --interval 0.2
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+
+from custom_components.deepstack_object.client import DeepstackClient
+from custom_components.deepstack_object.scheduler import (
+    DetectionDropped,
+    DetectionScheduler,
+)
+
+from .stub_server import StubDeepstack
+
+IMAGE = b"\xff\xd8" + bytes(50_000) + b"\xff\xd9"
+
+
+def percentile(values, percent):
+    """Return the percent percentile of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+async def run_storm(detect, cameras: int, interval: float, duration: float) -> dict:
+    """Scan every camera each interval for duration and collect latencies."""
+    latencies = []
+    dropped = 0
+
+    async def scan(key):
+        nonlocal dropped
+        start = time.monotonic()
+        try:
+            await detect(key)
+        except DetectionDropped:
+            dropped += 1
+            return
+        latencies.append(time.monotonic() - start)
+
+    tasks = []
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        tasks.extend(
+            asyncio.create_task(scan(f"camera_{index}")) for index in range(cameras)
+        )
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+    return {
+        "scans": len(tasks),
+        "completed": len(latencies),
+        "dropped": dropped,
+        "frames_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+async def main(args):
+    async with StubDeepstack(latency=args.latency, workers=args.workers) as server:
+        async with aiohttp.ClientSession() as session:
+            for name in ("direct", "scheduler"):
+                client = DeepstackClient(
+                    session, "127.0.0.1", server.port, args.max_concurrent_requests
+                )
+                if name == "direct":
+                    async def detect(key):
+                        return await client.async_detect(IMAGE)
+                else:
+                    scheduler = DetectionScheduler(
+                        client, args.max_concurrent_requests, args.max_wait
+                    )
+
+                    async def detect(key):
+                        return await scheduler.async_detect(key, IMAGE)
+
+                result = await run_storm(detect, args.cameras, args.interval, args.duration)
+                print(name, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cameras", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="server seconds per image")
+    parser.add_argument("--workers", type=int, default=2, help="images the server works on at once")
+    parser.add_argument("--max-concurrent-requests", type=int, default=4)
+    parser.add_argument("--max-wait", type=float, default=1.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,118 @@
+"""
+Benchmark the startup cost of the integration: importing the platform, and
+setting it up for many cameras.
+
+Each measurement runs in a fresh process. Modules that Home Assistant has
+always loaded by the time the platform is imported (the core, config
+validation and the image_processing component) are imported first, so only
+the cost of the integration itself is measured, and the heavy modules it
+loaded are listed. Run from the repository root:
+
+    python -m benchmarks.bench_startup --cameras 1 10 50
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HA_MODULES = (
+    "homeassistant.core",
+    "homeassistant.helpers.config_validation",
+    "homeassistant.helpers.aiohttp_client",
+    "homeassistant.helpers.event",
+    "homeassistant.components.image_processing",
+)
+HEAVY_MODULES = ("PIL.Image", "requests", "deepstack.core", "sqlite3", "glob")
+PLATFORM = "custom_components.deepstack_object.image_processing"
+
+
+def run_one(cameras: int) -> dict:
+    """Import and set up the platform for cameras, in this process."""
+    import importlib  # pylint: disable=import-outside-toplevel
+
+    for module in HA_MODULES:
+        importlib.import_module(module)
+    start = time.perf_counter()
+    image_processing = importlib.import_module(PLATFORM)
+    import_seconds = time.perf_counter() - start
+    heavy_modules = [module for module in HEAVY_MODULES if module in sys.modules]
+
+    from homeassistant.core import HomeAssistant  # pylint: disable=import-outside-toplevel
+
+    async def setup() -> float:
+        with tempfile.TemporaryDirectory() as config_dir:
+            hass = HomeAssistant(config_dir)
+            config = {
+                "platform": image_processing.DOMAIN,
+                "ip_address": "127.0.0.1",
+                "port": 5000,
+                "source": [
+                    {"entity_id": f"camera.startup_{index}"} for index in range(cameras)
+                ],
+                "targets": [
+                    {"target": "person"},
+                    {"target": "vehicle", "confidence": 60},
+                    {"target": "dog", "confidence": 40},
+                ],
+                "zones": [
+                    {"name": "drive", "x_max": 0.5},
+                    {"name": "path", "polygon": [[0.5, 0], [1, 0], [1, 1], [0.5, 1]]},
+                ],
+            }
+            entities = []
+            start = time.perf_counter()
+            await image_processing.async_setup_platform(
+                hass, image_processing.PLATFORM_SCHEMA(config), entities.extend
+            )
+            elapsed = time.perf_counter() - start
+            assert len(entities) == cameras
+            await hass.async_stop(force=True)
+            return elapsed
+
+    setup_seconds = asyncio.run(setup())
+    return {
+        "cameras": cameras,
+        "import_ms": round(import_seconds * 1000, 1),
+        "setup_ms": round(setup_seconds * 1000, 1),
+        "heavy_modules": heavy_modules,
+    }
+
+
+def main(args):
+    if args.run:
+        print(json.dumps(run_one(args.run)))
+        return
+    for cameras in args.cameras:
+        results = [
+            json.loads(
+                subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_startup", "--run", str(cameras)],
+                    check=True, capture_output=True, text=True,
+                ).stdout.strip().splitlines()[-1]
+            )
+            for _ in range(args.repeat)
+        ]
+        print(
+            json.dumps(
+                {
+                    "cameras": cameras,
+                    "import_ms": statistics.median(r["import_ms"] for r in results),
+                    "setup_ms": statistics.median(r["setup_ms"] for r in results),
+                    "heavy_modules": results[0]["heavy_modules"],
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--cameras", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--repeat", type=int, default=5, help="processes per count")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    main(parser.parse_args())
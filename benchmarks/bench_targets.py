@@ -0,0 +1,73 @@
+"""
+Micro-benchmark target matching for large custom models.
+
+Compares resolving each object's confidence threshold by scanning the
+configured targets, as process_image used to, with the TargetMatcher
+built when the entity is created. Run from the repository root:
+
+    python -m benchmarks.bench_targets --classes 500 --targets 200
+"""
+import argparse
+import random
+import timeit
+
+from custom_components.deepstack_object.image_processing import (
+    CONF_CONFIDENCE,
+    CONF_TARGET,
+    OBJECT_TYPES,
+    TargetMatcher,
+    get_object_arrays,
+    get_object_type,
+    get_target_thresholds,
+)
+
+from .stub_server import make_predictions
+
+
+def scan_targets(objects, targets):
+    """Resolve thresholds by scanning the targets for every object."""
+    targets_names = [target[CONF_TARGET] for target in targets]
+    thresholds = []
+    for name in objects.names:
+        object_type = get_object_type(name)
+        confidence = None
+        if name in targets_names or object_type in targets_names:
+            for target in targets:
+                if object_type == target[CONF_TARGET]:
+                    confidence = target[CONF_CONFIDENCE]
+            for target in targets:
+                if name == target[CONF_TARGET]:
+                    confidence = target[CONF_CONFIDENCE]
+        thresholds.append(confidence)
+    return thresholds
+
+
+def main(args):
+    rand = random.Random(0)
+    classes = [f"class_{index}" for index in range(args.classes)]
+    targets = [
+        {CONF_TARGET: name, CONF_CONFIDENCE: rand.uniform(10, 90)}
+        for name in rand.sample(classes, args.targets)
+    ] + [{CONF_TARGET: object_type, CONF_CONFIDENCE: 50.0} for object_type in OBJECT_TYPES]
+    predictions = make_predictions(args.objects)
+    for pred in predictions:
+        pred["label"] = rand.choice(classes)
+    objects = get_object_arrays(predictions, 960, 640)
+    matcher = TargetMatcher(targets)
+
+    for name, func in (
+        ("scan", lambda: scan_targets(objects, targets)),
+        ("matcher", lambda: get_target_thresholds(objects, matcher)),
+        ("build matcher", lambda: TargetMatcher(targets)),
+    ):
+        seconds = min(timeit.repeat(func, number=args.number, repeat=5)) / args.number
+        print(f"{name}: {seconds * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--classes", type=int, default=500)
+    parser.add_argument("--targets", type=int, default=200)
+    parser.add_argument("--objects", type=int, default=300)
+    parser.add_argument("--number", type=int, default=20)
+    main(parser.parse_args())
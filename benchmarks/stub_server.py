@@ -0,0 +1,72 @@
+"""
+A fake Deepstack server for benchmarks.
+
+The server answers the object detection endpoints with a fixed number of
+predictions after a configurable latency. The workers option models the
+CPU bound Deepstack container, which only works on a few images at once.
+"""
+import asyncio
+import random
+from typing import Dict, List
+
+from aiohttp import web
+
+LABELS = ["person", "car", "dog", "bicycle", "truck", "cat", "chair", "bench"]
+
+
+def make_predictions(count: int, width: int = 960, height: int = 640, seed: int = 0) -> List[Dict]:
+    """Return count random predictions in Deepstack format."""
+    rand = random.Random(seed)
+    predictions = []
+    for index in range(count):
+        x_min = rand.randint(0, width - 50)
+        y_min = rand.randint(0, height - 50)
+        predictions.append(
+            {
+                "confidence": round(rand.uniform(0.1, 1.0), 6),
+                "label": LABELS[index % len(LABELS)],
+                "x_min": x_min,
+                "y_min": y_min,
+                "x_max": rand.randint(x_min + 10, min(width, x_min + 400)),
+                "y_max": rand.randint(y_min + 10, min(height, y_min + 400)),
+            }
+        )
+    return predictions
+
+
+class StubDeepstack:
+    """Serve predictions on 127.0.0.1, use as an async context manager."""
+
+    def __init__(self, predictions: List[Dict] = None, latency: float = 0.0, workers: int = 0):
+        self.predictions = predictions if predictions is not None else make_predictions(3)
+        self.latency = latency
+        self.requests = 0
+        self.bytes_received = 0
+        self.port = None
+        self._workers = asyncio.Semaphore(workers) if workers else None
+        self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        self.requests += 1
+        self.bytes_received += len(form["image"].file.read())
+        if self._workers:
+            async with self._workers:
+                await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"success": True, "predictions": self.predictions})
+
+    async def __aenter__(self) -> "StubDeepstack":
+        app = web.Application(client_max_size=256 * 1024 ** 2)
+        app.router.add_post("/v1/vision/detection", self._handle)
+        app.router.add_post("/v1/vision/custom/{model}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        await self._runner.cleanup()
@@ -0,0 +1,320 @@
+"""
+Batch detection over a folder of images, as configured for a camera entity.
+
+Running detection over a backlog of recordings or snapshots, for example
+to audit false negatives, goes through the detect_folder service rather
+than one frame per scan. Each image is prepared and its targets filtered
+as the entity does for its camera, leaving the entity state as is, with a
+bounded number of requests in flight. Results are appended to a JSON Lines
+or CSV file as each image is done, then the image is appended to a
+checkpoint file next to it, so a batch that is interrupted resumes where
+it stopped when the service is called again.
+
+The modules for reading folders and writing results are imported when a
+batch starts, rather than with the integration.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+import homeassistant.helpers.config_validation as cv
+import voluptuous as vol
+from homeassistant.const import ATTR_ENTITY_ID
+from homeassistant.core import ServiceCall
+from homeassistant.exceptions import HomeAssistantError
+
+from .client import DeepstackException, ServerUnavailable
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = "deepstack_object"
+DATA_BATCH_ENTITIES = "deepstack_object_batch_entities"
+DATA_BATCH_TASKS = "deepstack_object_batch_tasks"
+SERVICE_DETECT_FOLDER = "detect_folder"
+EVENT_BATCH_FINISHED = "deepstack.batch_finished"
+FORMAT_JSONL = "jsonl"
+FORMAT_CSV = "csv"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+DEFAULT_MAX_PARALLEL = 4
+MAX_PARALLEL = 32
+CHECKPOINT_SUFFIX = ".checkpoint"
+GLOB_CHARACTERS = frozenset("*?[")
+
+CSV_COLUMNS = (
+    "file",
+    "name",
+    "confidence",
+    "y_min",
+    "x_min",
+    "y_max",
+    "x_max",
+    "zones",
+    "error",
+)
+
+BATCH_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+        # A folder, or a glob such as recordings/**/*.jpg
+        vol.Required("path"): cv.string,
+        vol.Required("output"): cv.string,
+        # By default CSV if the output ends in .csv, else JSON Lines
+        vol.Optional("format"): vol.In([FORMAT_JSONL, FORMAT_CSV]),
+        vol.Optional("max_parallel", default=DEFAULT_MAX_PARALLEL): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_PARALLEL)
+        ),
+        vol.Optional("resume", default=True): cv.boolean,
+    }
+)
+
+
+def get_base_folder(path: str) -> Path:
+    """Return the folder of path up to its first glob pattern."""
+    parts = []
+    for part in Path(path).parts:
+        if GLOB_CHARACTERS.intersection(part):
+            return Path(*parts)
+        parts.append(part)
+    return Path(path)
+
+
+def list_images(path: str) -> List[Path]:
+    """Return the images in the folder path, or matching the glob path, sorted."""
+    import glob  # pylint: disable=import-outside-toplevel
+
+    if Path(path).is_dir():
+        paths = Path(path).iterdir()
+    else:
+        paths = (Path(match) for match in glob.iglob(path, recursive=True))
+    return sorted(
+        path
+        for path in paths
+        if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file()
+    )
+
+
+class BatchOutput:
+    """Append the results of each image, then add it to the checkpoint.
+
+    write is called from executor threads, one image at a time. An image
+    interrupted between the two is written again when resuming.
+    """
+
+    def __init__(self, path: Path, output_format: Optional[str] = None):
+        self.path = path
+        self.checkpoint_path = path.with_name(path.name + CHECKPOINT_SUFFIX)
+        if output_format is None:
+            is_csv = path.suffix.lower() == ".csv"
+            output_format = FORMAT_CSV if is_csv else FORMAT_JSONL
+        self.format = output_format
+        self._lock = threading.Lock()
+        self._output = None
+        self._checkpoint = None
+        self._csv = None
+        self._encode = None
+
+    def open(self, resume: bool = True) -> Set[str]:
+        """Open the files, returning the images done if resuming a batch.
+
+        Without a checkpoint to resume from, the output is started over.
+        """
+        done = set()
+        resume = resume and self.checkpoint_path.exists()
+        if resume:
+            done = set(self.checkpoint_path.read_text(encoding="utf-8").splitlines())
+        mode = "a" if resume else "w"
+        self._output = open(self.path, mode, newline="", encoding="utf-8")
+        self._checkpoint = open(self.checkpoint_path, mode, encoding="utf-8")
+        if self.format == FORMAT_CSV:
+            import csv  # pylint: disable=import-outside-toplevel
+
+            self._csv = csv.writer(self._output)
+            if not self._output.tell():
+                self._csv.writerow(CSV_COLUMNS)
+        else:
+            import json  # pylint: disable=import-outside-toplevel
+
+            self._encode = json.dumps
+        return done
+
+    def close(self):
+        """Close the files."""
+        self._output.close()
+        self._checkpoint.close()
+
+    def write(
+        self,
+        image: str,
+        targets: List[Dict],
+        target_zones: List[List[str]],
+        error: Optional[str] = None,
+    ):
+        """Append the targets found in image, with the zones of each if any."""
+        with self._lock:
+            if self.format == FORMAT_CSV:
+                self._write_csv(image, targets, target_zones, error)
+            else:
+                result = {"file": image, "targets": targets}
+                if target_zones:
+                    for target, zones in zip(targets, target_zones):
+                        target["zones"] = zones
+                if error is not None:
+                    result["error"] = error
+                self._output.write(self._encode(result) + "\n")
+            self._output.flush()
+            self._checkpoint.write(image + "\n")
+            self._checkpoint.flush()
+
+    def _write_csv(self, image, targets, target_zones, error):
+        if not targets:  # A row for every image, to find false negatives
+            self._csv.writerow([image, "", "", "", "", "", "", "", error or ""])
+        for index, target in enumerate(targets):
+            box = target["bounding_box"]
+            self._csv.writerow(
+                [
+                    image,
+                    target["name"],
+                    target["confidence"],
+                    box["y_min"],
+                    box["x_min"],
+                    box["y_max"],
+                    box["x_max"],
+                    ",".join(target_zones[index]) if target_zones else "",
+                    "",
+                ]
+            )
+
+
+async def async_run_batch(
+    hass,
+    entity,
+    images: List[Path],
+    output: BatchOutput,
+    max_parallel: int = DEFAULT_MAX_PARALLEL,
+) -> Dict:
+    """Detect the targets in images with the entity, writing them to output.
+
+    Images that cannot be read or decoded are written with the error.
+    Images whose request fails are left out of the checkpoint, to be
+    retried on resume, and the batch stops if the server is unavailable.
+    """
+    stats = {"images": len(images), "done": 0, "failed": 0, "targets_found": 0}
+    pending = iter(images)
+    stopped = False
+
+    async def detect(image: Path):
+        nonlocal stopped
+        error = None
+        try:
+            frame = await hass.async_add_executor_job(image.read_bytes)
+            targets, target_zones = await entity.async_detect_frame(frame)
+        except OSError as exc:  # Unreadable, or not an image
+            targets, target_zones = [], []
+            error = exc.strerror or type(exc).__name__
+        except ServerUnavailable as exc:
+            _LOGGER.warning("Deepstack batch stopped, resume it later: %s", exc)
+            stopped = True
+            return
+        except DeepstackException as exc:
+            _LOGGER.warning("Deepstack batch error on %s: %s", image, exc)
+            stats["failed"] += 1
+            return
+        await hass.async_add_executor_job(
+            output.write, str(image), targets, target_zones, error
+        )
+        stats["done"] += 1
+        stats["targets_found"] += len(targets)
+
+    async def run():
+        for image in pending:
+            if stopped:
+                return
+            await detect(image)
+
+    try:
+        await asyncio.gather(*(run() for _ in range(max_parallel)))
+    finally:
+        output.close()
+    stats["stopped"] = stopped
+    return stats
+
+
+def register_batch_entity(hass, entity):
+    """Make the entity available to the detect_folder service."""
+    hass.data.setdefault(DATA_BATCH_ENTITIES, {})[entity.entity_id] = entity
+
+
+def unregister_batch_entity(hass, entity):
+    """Remove the entity from the detect_folder service."""
+    hass.data.get(DATA_BATCH_ENTITIES, {}).pop(entity.entity_id, None)
+
+
+def async_setup_batch(hass):
+    """Register the detect_folder service, once."""
+    if hass.services.has_service(DOMAIN, SERVICE_DETECT_FOLDER):
+        return
+    hass.data.setdefault(DATA_BATCH_ENTITIES, {})
+    hass.data.setdefault(DATA_BATCH_TASKS, {})
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_DETECT_FOLDER,
+        functools.partial(async_start_batch, hass),
+        schema=BATCH_SCHEMA,
+    )
+
+
+async def async_start_batch(hass, call: ServiceCall):
+    """Start a batch in the background, EVENT_BATCH_FINISHED is fired when done."""
+    entity_id = call.data[ATTR_ENTITY_ID]
+    entity = hass.data[DATA_BATCH_ENTITIES].get(entity_id)
+    if entity is None:
+        raise HomeAssistantError(f"{entity_id} is not a Deepstack object entity")
+    tasks = hass.data[DATA_BATCH_TASKS]
+    if entity_id in tasks:
+        raise HomeAssistantError(f"A batch is already running for {entity_id}")
+    path = hass.config.path(call.data["path"])
+    output = BatchOutput(
+        Path(hass.config.path(call.data["output"])), call.data.get("format")
+    )
+    for folder in (get_base_folder(path), output.path.parent):
+        if not hass.config.is_allowed_path(str(folder)):
+            raise HomeAssistantError(
+                f"Deepstack cannot access {folder}, add it to allowlist_external_dirs"
+            )
+
+    images = await hass.async_add_executor_job(list_images, path)
+    done = await hass.async_add_executor_job(output.open, call.data["resume"])
+    images = [image for image in images if str(image) not in done]
+    _LOGGER.info(
+        "Deepstack batch of %s images for %s, %s already done",
+        len(images),
+        entity_id,
+        len(done),
+    )
+
+    async def async_run():
+        start = time.monotonic()
+        try:
+            stats = await async_run_batch(
+                hass, entity, images, output, call.data["max_parallel"]
+            )
+        finally:
+            tasks.pop(entity_id, None)
+        hass.bus.async_fire(
+            EVENT_BATCH_FINISHED,
+            {
+                ATTR_ENTITY_ID: entity_id,
+                "path": path,
+                "output": str(output.path),
+                "seconds": round(time.monotonic() - start, 1),
+                **stats,
+            },
+        )
+
+    tasks[entity_id] = hass.async_create_background_task(
+        async_run(), f"deepstack_object batch {entity_id}"
+    )
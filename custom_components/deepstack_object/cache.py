@@ -0,0 +1,131 @@
+"""
+Cache of Deepstack predictions keyed on the image content.
+
+Entities that share a camera, or repeated scans of the same snapshot,
+produce identical image bytes. The cache is shared by all entities so the
+predictions for those bytes are only requested from Deepstack once, also
+when the entities are scanned at the same moment.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+DATA_CACHE = "deepstack_object_cache"
+DEFAULT_CACHE_SIZE = 0  # entries, 0 disables the cache
+DEFAULT_CACHE_TTL = 10  # seconds
+
+
+def get_cache_key(image: bytes, *settings) -> str:
+    """Return a key for image and the settings that change its predictions."""
+    digest = hashlib.blake2b(image, digest_size=16).hexdigest()
+    return f"{digest}:{settings!r}"
+
+
+class DetectionCache:
+    """A LRU cache of predictions, entries expire after ttl seconds."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        """Return the cached predictions for key, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        stored, predictions = entry
+        if time.monotonic() - stored > self.ttl:
+            del self._entries[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return predictions
+
+    def put(self, key: str, predictions: List[Dict]):
+        """Store predictions for key, evicting the least recently used entries."""
+        self._entries[key] = (time.monotonic(), predictions)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def async_get_or_detect(
+        self,
+        key: str,
+        async_detect: Callable[[], Awaitable[List[Dict]]],
+        async_prefilter: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> List[Dict]:
+        """Return the cached predictions for key, else await async_detect().
+
+        Callers asking for a key that is already being detected wait for
+        that request instead of sending their own. If the caller that sent
+        it is cancelled, a waiter sends the request in its place.
+
+        On a miss, async_prefilter() is awaited first if given, and if it
+        returns False no predictions are returned without detecting. That
+        result depends on the caller, so it is not cached.
+        """
+        predictions = await self._async_wait_pending(key)
+        if predictions is None:
+            predictions = self.get(key)
+        if predictions is not None:
+            return predictions
+        if async_prefilter is not None:
+            if not await async_prefilter():
+                return []
+            # Another caller may have sent the request meanwhile
+            predictions = await self._async_wait_pending(key)
+            if predictions is not None:
+                return predictions
+
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            predictions = await async_detect()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # waiters re-raise it, don't log it as unretrieved
+            raise
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        self.put(key, predictions)
+        future.set_result(predictions)
+        return predictions
+
+    async def _async_wait_pending(self, key: str) -> Optional[List[Dict]]:
+        """Return the predictions of the pending request for key, if any."""
+        while (pending := self._pending.get(key)) is not None:
+            try:
+                predictions = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # This caller was cancelled
+                continue
+            self.stats["hits"] += 1
+            return predictions
+        return None
+
+
+def get_cache(hass, max_entries: int, ttl: float) -> DetectionCache:
+    """Return the shared cache, growing it to max_entries and ttl if needed."""
+    cache = hass.data.get(DATA_CACHE)
+    if cache is None:
+        cache = hass.data[DATA_CACHE] = DetectionCache(max_entries, ttl)
+    else:
+        cache.max_entries = max(cache.max_entries, max_entries)
+        cache.ttl = max(cache.ttl, ttl)
+    return cache
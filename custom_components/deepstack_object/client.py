@@ -0,0 +1,327 @@
+"""
+Asyncio client for the Deepstack object detection API.
+
+A single client is shared by all entities that talk to the same Deepstack
+server, so requests reuse the keep-alive connections of one aiohttp session
+and the number of requests in flight against the server is bounded.
+
+The client also tracks the health of the server. After repeated failures a
+circuit breaker opens and requests fail immediately, until a single probe
+request is let through after an exponentially growing backoff.
+
+Requests are made with aiohttp rather than deepstack-python, whose import
+of requests and PIL slowed down startup. Its constants and exception are
+kept here, so errors are handled as before.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import aiohttp
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_CLIENTS = "deepstack_object_clients"
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_BACKOFF = 5  # seconds
+MAX_BACKOFF = 300  # seconds
+LATENCY_SMOOTHING = 0.2
+HEALTH_CHECK_TIMEOUT = 5  # seconds
+
+DEFAULT_API_KEY = ""
+DEFAULT_TIMEOUT = 10  # seconds
+DEFAULT_MIN_CONFIDENCE = 0.45
+HTTP_OK = 200
+BAD_URL = 404
+HTTP_SERVER_ERROR = 500
+URL_BASE_VISION = "http://{ip}:{port}/v1/vision"
+URL_CUSTOM = "/custom/{custom_model}"
+URL_OBJECT_DETECTION = "/detection"
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class DeepstackException(Exception):
+    """A Deepstack request failed."""
+
+
+class ServerUnavailable(DeepstackException):
+    """The server is failing, the request was not sent."""
+
+
+class RequestRejected(DeepstackException):
+    """The server answered, but could not process the request."""
+
+
+def is_server_failure(status: int) -> bool:
+    """Return True if the status means the server is failing, not the request.
+
+    Connection errors, timeouts and these statuses count towards opening
+    the circuit breaker, any other answer shows the server is up.
+    """
+    return status >= HTTP_SERVER_ERROR
+
+
+def get_detect_url(ip_address: str, port: int, custom_model: str = "") -> str:
+    """Return the detection url, for the default or a custom model."""
+    url = URL_BASE_VISION.format(ip=ip_address, port=port)
+    if custom_model:
+        return url + URL_CUSTOM.format(custom_model=custom_model)
+    return url + URL_OBJECT_DETECTION
+
+
+class CircuitBreaker:
+    """Stop sending requests to a failing server, with exponential backoff."""
+
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        backoff: float = DEFAULT_BACKOFF,
+        max_backoff: float = MAX_BACKOFF,
+    ):
+        self.failure_threshold = failure_threshold
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self._initial_backoff = backoff
+        self._max_backoff = max_backoff
+        self._backoff = backoff
+        self._retry_at = 0.0
+
+    @property
+    def retry_in(self) -> float:
+        """Return the seconds until a request is let through, 0 if closed."""
+        if self.state == BREAKER_CLOSED:
+            return 0.0
+        return max(0.0, self._retry_at - time.monotonic())
+
+    def allow_request(self) -> bool:
+        """Return True if a request may be sent, opening a probe if the backoff passed."""
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN and time.monotonic() >= self._retry_at:
+            self.state = BREAKER_HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        """Close the breaker."""
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self._backoff = self._initial_backoff
+
+    def record_failure(self):
+        """Count a failure, opening the breaker at the threshold or if a probe failed."""
+        self.failures += 1
+        if self.state == BREAKER_HALF_OPEN:
+            self._backoff = min(self._backoff * 2, self._max_backoff)
+        elif self.failures < self.failure_threshold:
+            return
+        self.state = BREAKER_OPEN
+        self._retry_at = time.monotonic() + self._backoff
+
+
+class DeepstackClient:
+    """Send images to one Deepstack server over a shared session."""
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        ip_address: str,
+        port: int,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+    ):
+        self._session = session
+        self._ip_address = ip_address
+        self._port = port
+        self._max_concurrent_requests = max_concurrent_requests
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self.breaker = CircuitBreaker()
+        self.latency = None  # smoothed seconds per request
+        self.entities = 0
+        self.in_flight = 0  # requests sent or waiting for a free slot
+
+    @property
+    def available(self) -> bool:
+        """Return False while the circuit breaker rejects requests."""
+        if self.breaker.state == BREAKER_OPEN:
+            return self.breaker.retry_in == 0
+        return self.breaker.state == BREAKER_CLOSED
+
+    @property
+    def min_scan_interval(self) -> float:
+        """Return the seconds between scans of each entity the server can keep up with."""
+        if self.latency is None:
+            return 0.0
+        return self.latency * self.entities / self._max_concurrent_requests
+
+    def register_entity(self):
+        """Count an entity using this server, for min_scan_interval."""
+        self.entities += 1
+
+    def unregister_entity(self):
+        """Stop counting an entity removed from Home Assistant."""
+        self.entities -= 1
+
+    def record_latency(self, seconds: float):
+        """Update the smoothed latency."""
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    @property
+    def server(self) -> str:
+        """Return the server as ip:port."""
+        return f"{self._ip_address}:{self._port}"
+
+    @property
+    def max_concurrent_requests(self) -> int:
+        """Return the maximum number of requests in flight to the server."""
+        return self._max_concurrent_requests
+
+    @property
+    def status(self) -> Dict:
+        """Return the health of the server, for the entity attributes."""
+        return {
+            "state": self.breaker.state,
+            "retry_in": round(self.breaker.retry_in, 1),
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 1),
+        }
+
+    async def async_check_health(self):
+        """Probe a failing server once its backoff has passed, without sending a frame.
+
+        The breaker is closed again if the server answers with a status
+        that is not is_server_failure, the same rule as for detections.
+        """
+        if self.breaker.state == BREAKER_CLOSED or not self.breaker.allow_request():
+            return
+        url = URL_BASE_VISION.format(ip=self._ip_address, port=self._port)
+        try:
+            async with self._session.get(
+                url, timeout=aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+            ) as response:
+                if is_server_failure(response.status):
+                    raise aiohttp.ClientError(f"status code {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            _LOGGER.debug("Deepstack %s health check failed: %s", self.server, exc)
+            self.breaker.record_failure()
+            return
+        _LOGGER.info("Deepstack %s is available again", self.server)
+        self.breaker.record_success()
+
+    async def async_detect(
+        self,
+        image: bytes,
+        api_key: str = DEFAULT_API_KEY,
+        timeout: int = DEFAULT_TIMEOUT,
+        min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+        custom_model: str = "",
+    ) -> List[Dict]:
+        """Return the raw predictions for image, raising DeepstackException on error.
+
+        The timeout applies to the request itself, time spent waiting for a
+        free slot on the server is not counted.
+        """
+        url = get_detect_url(self._ip_address, self._port, custom_model)
+        data = aiohttp.FormData()
+        data.add_field("image", image, filename="image.jpg")
+        data.add_field("api_key", api_key)
+        data.add_field("min_confidence", str(min_confidence))
+
+        self.in_flight += 1
+        try:
+            return await self._async_detect(url, data, timeout)
+        finally:
+            self.in_flight -= 1
+
+    async def _async_detect(self, url: str, data: aiohttp.FormData, timeout: int):
+        async with self._semaphore:
+            if not self.breaker.allow_request():
+                raise ServerUnavailable(
+                    f"Deepstack {self.server} is unavailable, retrying in {self.breaker.retry_in:.0f} seconds"
+                )
+            start = time.monotonic()
+            try:
+                response_json = await self._async_post(url, data, timeout)
+            except RequestRejected:
+                self.breaker.record_success()  # the server answered
+                raise
+            except DeepstackException:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                if self.breaker.state == BREAKER_HALF_OPEN:
+                    self.breaker.record_failure()  # the probe was cancelled
+                raise
+            self.breaker.record_success()
+            self.record_latency(time.monotonic() - start)
+
+        if not response_json.get("success", True):
+            raise RequestRejected(
+                f"Deepstack request failed: {response_json.get('error')}"
+            )
+        return response_json.get("predictions", [])
+
+    async def _async_post(self, url: str, data: aiohttp.FormData, timeout: int) -> Dict:
+        """Post the request, returning the json response.
+
+        A status other than is_server_failure raises RequestRejected, a body
+        that is not json raises DeepstackException.
+        """
+        try:
+            async with self._session.post(
+                url, data=data, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status == BAD_URL:
+                    raise RequestRejected(
+                        f"Bad url supplied, url {url} raised error {BAD_URL}"
+                    )
+                if response.status != HTTP_OK:
+                    if not is_server_failure(response.status):
+                        raise RequestRejected(
+                            f"Deepstack rejected the request, status code: {response.status}"
+                        )
+                    raise DeepstackException(
+                        f"Error from Deepstack request, status code: {response.status}"
+                    )
+                try:
+                    return await response.json(content_type=None)
+                except ValueError as exc:
+                    raise DeepstackException(
+                        f"Deepstack returned an invalid response: {exc}"
+                    )
+        except asyncio.TimeoutError:
+            raise DeepstackException(
+                f"Timeout connecting to Deepstack, the current timeout is {timeout} seconds, try increasing this value"
+            )
+        except aiohttp.ClientError as exc:
+            raise DeepstackException(
+                f"Deepstack connection error, check your IP and port: {exc}"
+            )
+
+
+def get_client(
+    hass,
+    ip_address: str,
+    port: int,
+    max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+) -> DeepstackClient:
+    """Return the client for ip_address:port, creating it on first use."""
+    clients: Dict[Tuple[str, int], DeepstackClient] = hass.data.setdefault(
+        DATA_CLIENTS, {}
+    )
+    key = (ip_address, port)
+    if key not in clients:
+        clients[key] = DeepstackClient(
+            async_get_clientsession(hass),
+            ip_address,
+            port,
+            max_concurrent_requests=max_concurrent_requests,
+        )
+    return clients[key]
@@ -0,0 +1,26 @@
+"""
+Geometry of the boxes of detected objects.
+
+Boxes are rows of (y_min, x_min, y_max, x_max), in pixels or relative to
+the frame, and are compared all at once with numpy.
+"""
+import numpy as np
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Return the intersection over union of each of boxes_a with each of boxes_b."""
+    boxes_a = boxes_a[:, None, :]
+    boxes_b = boxes_b[None, :, :]
+    heights = np.minimum(boxes_a[..., 2], boxes_b[..., 2]) - np.maximum(
+        boxes_a[..., 0], boxes_b[..., 0]
+    )
+    widths = np.minimum(boxes_a[..., 3], boxes_b[..., 3]) - np.maximum(
+        boxes_a[..., 1], boxes_b[..., 1]
+    )
+    intersection = np.clip(heights, 0, None) * np.clip(widths, 0, None)
+    areas_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    areas_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    union = areas_a + areas_b - intersection
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
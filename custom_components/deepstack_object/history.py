@@ -0,0 +1,293 @@
+"""
+Persistent log of the targets found, in SQLite.
+
+Targets are otherwise only in the entity state and in events, so finding
+"all persons on the driveway camera in the last hour" means searching the
+recorder or the save folder. Each target found is appended as a row to a
+SQLite database in WAL mode, indexed on time and label. Rows are queued and
+inserted in batches by a background thread, so scans never wait on disk,
+and queries read through their own connection without blocking inserts.
+sqlite3 is imported when the store is started, only if history is enabled.
+"""
+import functools
+import logging
+import queue
+import threading
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence
+
+import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
+import voluptuous as vol
+from homeassistant.const import ATTR_ENTITY_ID, EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import ServiceCall, SupportsResponse
+
+if TYPE_CHECKING:
+    import sqlite3
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = "deepstack_object"
+DATA_HISTORY = "deepstack_object_history"
+SERVICE_QUERY_HISTORY = "query_history"
+MAX_QUEUED_SCANS = 1000
+MAX_BATCH_SIZE = 500  # rows inserted in one transaction
+DEFAULT_QUERY_LIMIT = 100
+MAX_QUERY_LIMIT = 10000
+
+COLUMNS = (
+    "entity_id",
+    "timestamp",
+    "label",
+    "confidence",
+    "y_min",
+    "x_min",
+    "y_max",
+    "x_max",
+    "zones",
+    "track_id",
+    "saved_file",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    entity_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    y_min REAL,
+    x_min REAL,
+    y_max REAL,
+    x_max REAL,
+    zones TEXT,
+    track_id INTEGER,
+    saved_file TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_timestamp ON detections (timestamp);
+CREATE INDEX IF NOT EXISTS detections_label ON detections (label, timestamp);
+CREATE INDEX IF NOT EXISTS detections_entity ON detections (entity_id, timestamp);
+"""
+
+QUERY_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_ENTITY_ID, default=[]): cv.entity_ids,
+        vol.Optional("label", default=[]): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional("zone"): cv.string,
+        # The period before now, or from start to end
+        vol.Exclusive("last", "period"): cv.time_period,
+        vol.Exclusive("start", "period"): cv.datetime,
+        vol.Optional("end"): cv.datetime,
+        vol.Optional("min_confidence"): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=100)
+        ),
+        vol.Optional("limit", default=DEFAULT_QUERY_LIMIT): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=MAX_QUERY_LIMIT)
+        ),
+    }
+)
+
+
+def connect(path: str) -> "sqlite3.Connection":
+    """Open the database, creating it in WAL mode if needed."""
+    import sqlite3  # pylint: disable=import-outside-toplevel
+
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL is safe from corruption, a power cut may lose the
+    # last transactions only
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class HistoryStore:
+    """Append targets to the database on a background thread, and query them."""
+
+    def __init__(self, path: str, max_queue: int = MAX_QUEUED_SCANS):
+        self.path = path
+        self._queue: "queue.Queue[Optional[List[tuple]]]" = queue.Queue(max_queue)
+        self._thread = threading.Thread(
+            target=self._run, name="deepstack_object_history", daemon=True
+        )
+        self._connection = None
+        self.stats = {"written": 0, "dropped": 0}
+
+    def start(self):
+        """Create the database and start the writer thread."""
+        self._connection = connect(self.path)
+        self._connection.executescript(SCHEMA)
+        self._thread.start()
+
+    def stop(self, *args):
+        """Write the queued rows and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+        self._connection.close()
+
+    def record(self, rows: List[tuple]):
+        """Queue the rows of a scan, in the order of COLUMNS, without blocking."""
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self.stats["dropped"] += len(rows)
+            _LOGGER.warning("Deepstack history queue is full, detections dropped")
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            stop = rows is None
+            batch = rows or []
+            # Rows queued while the last batch was written go in one transaction
+            while not stop and len(batch) < MAX_BATCH_SIZE:
+                try:
+                    rows = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if rows is None:
+                    stop = True
+                else:
+                    batch.extend(rows)
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch: List[tuple]):
+        import sqlite3  # pylint: disable=import-outside-toplevel
+
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    f"INSERT INTO detections ({', '.join(COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                    batch,
+                )
+            self.stats["written"] += len(batch)
+        except sqlite3.Error:
+            self.stats["dropped"] += len(batch)
+            _LOGGER.exception("Deepstack error writing history")
+
+    def query(
+        self,
+        entity_ids: Sequence[str] = (),
+        labels: Sequence[str] = (),
+        zone: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        min_confidence: Optional[float] = None,
+        limit: int = DEFAULT_QUERY_LIMIT,
+    ) -> List[Dict]:
+        """Return the newest targets matching all the filters given.
+
+        start and end are unix timestamps. This blocks, run it in an executor.
+        """
+        clauses, parameters = [], []
+        for column, values in (("entity_id", entity_ids), ("label", labels)):
+            if values:
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                parameters.extend(values)
+        for clause, value in (
+            ("timestamp >= ?", start),
+            ("timestamp < ?", end),
+            ("confidence >= ?", min_confidence),
+            ("instr(',' || zones || ',', ',' || ? || ',') > 0", zone),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        connection = connect(self.path)
+        try:
+            cursor = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM detections {where} "
+                "ORDER BY timestamp DESC LIMIT ?",
+                [*parameters, limit],
+            )
+            return [dict(row) for row in cursor]
+        finally:
+            connection.close()
+
+
+def get_rows(
+    entity_id: str,
+    timestamp: float,
+    targets: Iterable[Dict],
+    zones: Sequence[Sequence[str]] = (),
+    track_ids: Sequence[int] = (),
+    saved_file: Optional[str] = None,
+) -> List[tuple]:
+    """Return the rows of the targets found in a scan."""
+    rows = []
+    for index, target in enumerate(targets):
+        box = target["bounding_box"]
+        rows.append(
+            (
+                entity_id,
+                timestamp,
+                target["name"],
+                target["confidence"],
+                box["y_min"],
+                box["x_min"],
+                box["y_max"],
+                box["x_max"],
+                ",".join(zones[index]) if zones else None,
+                track_ids[index] if track_ids else None,
+                saved_file,
+            )
+        )
+    return rows
+
+
+async def async_get_history(hass, path: str) -> HistoryStore:
+    """Return the shared history store, starting it on first use."""
+    history = hass.data.get(DATA_HISTORY)
+    if history is None:
+        history = hass.data[DATA_HISTORY] = HistoryStore(path)
+        await hass.async_add_executor_job(history.start)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, history.stop)
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_QUERY_HISTORY,
+            functools.partial(async_query_history, hass, history),
+            schema=QUERY_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+    elif history.path != path:
+        _LOGGER.warning(
+            "Deepstack history is already stored in %s, not %s", history.path, path
+        )
+    return history
+
+
+def get_timestamp(value) -> Optional[float]:
+    """Return the unix timestamp of a datetime, naive ones in local time."""
+    if value is None:
+        return None
+    return dt_util.as_local(value).timestamp()
+
+
+async def async_query_history(
+    hass, history: HistoryStore, call: ServiceCall
+) -> Dict:
+    """Answer the query_history service, newest targets first."""
+    start = get_timestamp(call.data.get("start"))
+    if "last" in call.data:
+        start = (dt_util.utcnow() - call.data["last"]).timestamp()
+    detections = await hass.async_add_executor_job(
+        functools.partial(
+            history.query,
+            entity_ids=call.data[ATTR_ENTITY_ID],
+            labels=call.data["label"],
+            zone=call.data.get("zone"),
+            start=start,
+            end=get_timestamp(call.data.get("end")),
+            min_confidence=call.data.get("min_confidence"),
+            limit=call.data["limit"],
+        )
+    )
+    for detection in detections:
+        detection["timestamp"] = dt_util.as_local(
+            dt_util.utc_from_timestamp(detection["timestamp"])
+        ).isoformat()
+        detection["zones"] = detection["zones"].split(",") if detection["zones"] else []
+    return {"detections": detections}
@@ -4,23 +4,24 @@ Component that will perform object detection and identification via deepstack.
 For more details about this platform, please refer to the documentation at
 https://home-assistant.io/components/image_processing.deepstack_object
 """
-from collections import namedtuple, Counter
+from collections import Counter
+import asyncio
 import datetime
-import io
+import functools
+import itertools
 import logging
 import os
 import re
+import time
 from datetime import timedelta
-from typing import Tuple, Dict, List
+from typing import TYPE_CHECKING, Tuple, Dict, List, NamedTuple, Optional, Union
 from pathlib import Path
 
-from PIL import Image, ImageDraw
+import numpy as np
 
-import deepstack.core as ds
 import homeassistant.helpers.config_validation as cv
 import homeassistant.util.dt as dt_util
 import voluptuous as vol
-from homeassistant.util.pil import draw_box
 from homeassistant.components.image_processing import (
     ATTR_CONFIDENCE,
     CONF_CONFIDENCE,
@@ -37,28 +38,101 @@ from homeassistant.const import (
     ATTR_NAME,
     CONF_IP_ADDRESS,
     CONF_PORT,
+    EVENT_HOMEASSISTANT_STOP,
 )
-from homeassistant.core import split_entity_id
+from homeassistant.core import callback, split_entity_id
+from homeassistant.helpers.event import async_track_time_interval
+
+from .batch import (
+    async_setup_batch,
+    register_batch_entity,
+    unregister_batch_entity,
+)
+from .cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, get_cache, get_cache_key
+from .client import (
+    DEFAULT_MAX_CONCURRENT_REQUESTS,
+    DeepstackException,
+    ServerUnavailable,
+    get_client,
+)
+from .geometry import iou_matrix
+from .history import async_get_history, get_rows
+from .instrumentation import (
+    SCAN_DROPPED,
+    SCAN_ERROR,
+    SCAN_PROCESSED,
+    SCAN_UNAVAILABLE,
+    SCAN_UNCHANGED,
+    STAGE_CROP_SCALE,
+    STAGE_DECODE,
+    STAGE_DETECT,
+    STAGE_OFFLOAD,
+    STAGE_POSTPROCESS,
+    STAGE_PREFILTER,
+    STAGE_SAVE,
+    STAGE_TOTAL,
+    StageTimings,
+)
+from .pipeline import (
+    FrameOptions,
+    annotate_image,
+    crop_and_scale,
+    decode_image,
+    encode_jpeg,
+    get_hash_difference,
+    get_image_hash,
+    get_image_nbytes,
+    get_roi_box,
+    get_tiles,
+    open_image,
+    prepare_frame,
+    render_frame,
+)
+from .pool import get_pool
+from .retention import SnapshotRetention
+from .scheduler import DEFAULT_MAX_WAIT, DetectionDropped, DetectionScheduler
+from .stream import (
+    DEFAULT_STREAM_FPS,
+    FrameStream,
+    async_read_source,
+    is_live_source,
+)
+from .tracker import DEFAULT_TRACK_IOU_THRESHOLD, DEFAULT_TRACK_MAX_AGE, ObjectTracker
+from .writer import (
+    DEFAULT_SAVE_QUEUE_SIZE,
+    POLICY_DROP,
+    SAVE_QUEUE_POLICIES,
+    get_writer,
+    write_image,
+)
+from .workers import SnapshotOptions, get_workers
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 _LOGGER = logging.getLogger(__name__)
 
 ANIMAL = "animal"
-ANIMALS = [
-    "bird",
-    "cat",
-    "dog",
-    "horse",
-    "sheep",
-    "cow",
-    "elephant",
-    "bear",
-    "zebra",
-    "giraffe",
-]
+ANIMALS = frozenset(
+    [
+        "bird",
+        "cat",
+        "dog",
+        "horse",
+        "sheep",
+        "cow",
+        "elephant",
+        "bear",
+        "zebra",
+        "giraffe",
+    ]
+)
 OTHER = "other"
 PERSON = "person"
 VEHICLE = "vehicle"
-VEHICLES = ["bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck"]
+VEHICLES = frozenset(
+    ["bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck"]
+)
 OBJECT_TYPES = [ANIMAL, OTHER, PERSON, VEHICLE]
 
 
@@ -78,6 +152,35 @@ CONF_ROI_X_MAX = "roi_x_max"
 CONF_SCALE = "scale"
 CONF_CUSTOM_MODEL = "custom_model"
 CONF_CROP_ROI = "crop_to_roi"
+CONF_MAX_CONCURRENT_REQUESTS = "max_concurrent_requests"
+CONF_MAX_QUEUE_WAIT = "max_queue_wait"
+CONF_CHANGE_THRESHOLD = "change_threshold"
+CONF_CACHE_SIZE = "cache_size"
+CONF_CACHE_TTL = "cache_ttl"
+CONF_SAVE_QUEUE_SIZE = "save_queue_size"
+CONF_SAVE_QUEUE_POLICY = "save_queue_policy"
+CONF_STAGE_TIMINGS = "stage_timings"
+CONF_TIMING_EVENTS = "timing_events"
+CONF_ADAPTIVE_SCAN_INTERVAL = "adaptive_scan_interval"
+CONF_TILE_SIZE = "tile_size"
+CONF_TILE_OVERLAP = "tile_overlap"
+CONF_ZONES = "zones"
+CONF_POLYGON = "polygon"
+CONF_TRACK_OBJECTS = "track_objects"
+CONF_TRACK_IOU_THRESHOLD = "track_iou_threshold"
+CONF_TRACK_MAX_AGE = "track_max_age"
+CONF_STREAM_SOURCE = "stream_source"
+CONF_SERVERS = "servers"
+CONF_CUSTOM_MODELS = "custom_models"
+CONF_STREAM_FPS = "stream_fps"
+CONF_HISTORY_DB = "history_db"
+CONF_MAX_SAVED_FILES = "max_saved_files"
+CONF_MAX_SAVED_AGE = "max_saved_age"
+CONF_MAX_SAVED_MB = "max_saved_mb"
+CONF_PREFILTER_SCALE = "prefilter_scale"
+CONF_PREFILTER_MARGIN = "prefilter_margin"
+CONF_ALL_OBJECTS_LIMIT = "all_objects_limit"
+CONF_IMAGE_WORKERS = "image_workers"
 
 DATETIME_FORMAT = "%Y-%m-%d_%H-%M-%S-%f"
 DEFAULT_API_KEY = ""
@@ -88,6 +191,12 @@ DEFAULT_ROI_Y_MAX = 1.0
 DEFAULT_ROI_X_MIN = 0.0
 DEFAULT_ROI_X_MAX = 1.0
 DEAULT_SCALE = 1.0
+DEFAULT_CHANGE_THRESHOLD = 0.0
+DEFAULT_TILE_SIZE = 0
+DEFAULT_TILE_OVERLAP = 0.2
+RETENTION_INTERVAL = timedelta(minutes=10)
+DEFAULT_PREFILTER_SCALE = 0.0
+DEFAULT_PREFILTER_MARGIN = 0.6
 DEFAULT_ROI = (
     DEFAULT_ROI_Y_MIN,
     DEFAULT_ROI_X_MIN,
@@ -96,19 +205,21 @@ DEFAULT_ROI = (
 )
 
 EVENT_OBJECT_DETECTED = "deepstack.object_detected"
+EVENT_SCAN_TIMING = "deepstack.scan_timing"
+EVENT_OBJECT_LEFT = "deepstack.object_left"
+ATTR_ZONE = "zone"
+ATTR_TRACK_ID = "track_id"
 BOX = "box"
+NMS_IOU_THRESHOLD = 0.5
+BOX_KEYS = ("height", "width", "y_min", "x_min", "y_max", "x_max")
 FILE = "file"
 OBJECT = "object"
 SAVED_FILE = "saved_file"
 MIN_CONFIDENCE = 0.1
+DECIMAL_PLACES = 3
 JPG = "jpg"
 PNG = "png"
 
-# rgb(red, green, blue)
-RED = (255, 0, 0)  # For objects within the ROI
-GREEN = (0, 255, 0)  # For ROI box
-YELLOW = (255, 255, 0)  # Unused
-
 TARGETS_SCHEMA = {
     vol.Required(CONF_TARGET): cv.string,
     vol.Optional(CONF_CONFIDENCE): vol.All(
@@ -116,11 +227,37 @@ TARGETS_SCHEMA = {
     ),
 }
 
+SERVER_SCHEMA = {
+    vol.Required(CONF_IP_ADDRESS): cv.string,
+    vol.Required(CONF_PORT): cv.port,
+    vol.Optional(CONF_MAX_CONCURRENT_REQUESTS): vol.All(
+        vol.Coerce(int), vol.Range(min=1)
+    ),
+    # The custom models hosted by the server, by default any model
+    vol.Optional(CONF_CUSTOM_MODELS): vol.All(cv.ensure_list, [cv.string]),
+}
+
+ZONE_SCHEMA = {
+    vol.Required(CONF_NAME): cv.string,
+    # (x, y) vertices relative to the frame, in place of the box
+    vol.Optional(CONF_POLYGON): vol.All(
+        [vol.ExactSequence([cv.small_float, cv.small_float])], vol.Length(min=3)
+    ),
+    vol.Optional("y_min", default=DEFAULT_ROI_Y_MIN): cv.small_float,
+    vol.Optional("x_min", default=DEFAULT_ROI_X_MIN): cv.small_float,
+    vol.Optional("y_max", default=DEFAULT_ROI_Y_MAX): cv.small_float,
+    vol.Optional("x_max", default=DEFAULT_ROI_X_MAX): cv.small_float,
+    vol.Optional(CONF_TARGETS): vol.All(cv.ensure_list, [vol.Schema(TARGETS_SCHEMA)]),
+}
+
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
-        vol.Required(CONF_IP_ADDRESS): cv.string,
-        vol.Required(CONF_PORT): cv.port,
+        vol.Inclusive(CONF_IP_ADDRESS, "server"): cv.string,
+        vol.Inclusive(CONF_PORT, "server"): cv.port,
+        vol.Optional(CONF_SERVERS, default=[]): vol.All(
+            cv.ensure_list, [vol.Schema(SERVER_SCHEMA)]
+        ),
         vol.Optional(CONF_API_KEY, default=DEFAULT_API_KEY): cv.string,
         vol.Optional(CONF_TIMEOUT, default=DEFAULT_TIMEOUT): cv.positive_int,
         vol.Optional(CONF_CUSTOM_MODEL, default=""): cv.string,
@@ -137,34 +274,81 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Optional(CONF_SAVE_FILE_FOLDER): cv.isdir,
         vol.Optional(CONF_SAVE_FILE_FORMAT, default=JPG): vol.In([JPG, PNG]),
         vol.Optional(CONF_SAVE_TIMESTAMPTED_FILE, default=False): cv.boolean,
+        vol.Optional(CONF_MAX_SAVED_FILES): vol.All(
+            vol.Coerce(int), vol.Range(min=1)
+        ),
+        vol.Optional(CONF_MAX_SAVED_AGE): cv.positive_time_period,
+        vol.Optional(CONF_MAX_SAVED_MB): vol.All(
+            vol.Coerce(float), vol.Range(min=0, min_included=False)
+        ),
         vol.Optional(CONF_ALWAYS_SAVE_LATEST_FILE, default=False): cv.boolean,
         vol.Optional(CONF_SHOW_BOXES, default=True): cv.boolean,
+        vol.Optional(CONF_ALL_OBJECTS_LIMIT, default=0): cv.positive_int,
+        vol.Optional(CONF_IMAGE_WORKERS, default=0): cv.positive_int,
         vol.Optional(CONF_CROP_ROI, default=False): cv.boolean,
+        vol.Optional(CONF_ZONES, default=[]): vol.All(
+            cv.ensure_list, [vol.Schema(ZONE_SCHEMA)]
+        ),
+        vol.Optional(CONF_TRACK_OBJECTS, default=False): cv.boolean,
+        vol.Optional(CONF_STREAM_SOURCE): cv.string,
+        vol.Optional(CONF_HISTORY_DB): cv.string,
+        vol.Optional(CONF_STREAM_FPS, default=DEFAULT_STREAM_FPS): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1, max=30)
+        ),
+        vol.Optional(
+            CONF_TRACK_IOU_THRESHOLD, default=DEFAULT_TRACK_IOU_THRESHOLD
+        ): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+        vol.Optional(
+            CONF_TRACK_MAX_AGE, default=DEFAULT_TRACK_MAX_AGE
+        ): cv.positive_int,
+        vol.Optional(
+            CONF_SAVE_QUEUE_SIZE, default=DEFAULT_SAVE_QUEUE_SIZE
+        ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_SAVE_QUEUE_POLICY, default=POLICY_DROP): vol.In(
+            SAVE_QUEUE_POLICIES
+        ),
+        vol.Optional(CONF_STAGE_TIMINGS, default=False): cv.boolean,
+        vol.Optional(CONF_TIMING_EVENTS, default=False): cv.boolean,
+        vol.Optional(CONF_ADAPTIVE_SCAN_INTERVAL, default=False): cv.boolean,
+        vol.Optional(CONF_TILE_SIZE, default=DEFAULT_TILE_SIZE): vol.Any(
+            0, vol.All(vol.Coerce(int), vol.Range(min=64))
+        ),
+        vol.Optional(CONF_TILE_OVERLAP, default=DEFAULT_TILE_OVERLAP): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=0.5)
+        ),
+        vol.Optional(CONF_PREFILTER_SCALE, default=DEFAULT_PREFILTER_SCALE): vol.Any(
+            0, vol.All(vol.Coerce(float), vol.Range(min=0.05, max=0.5))
+        ),
+        vol.Optional(
+            CONF_PREFILTER_MARGIN, default=DEFAULT_PREFILTER_MARGIN
+        ): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=1)),
+        vol.Optional(
+            CONF_MAX_CONCURRENT_REQUESTS, default=DEFAULT_MAX_CONCURRENT_REQUESTS
+        ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_MAX_QUEUE_WAIT, default=DEFAULT_MAX_WAIT): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional(
+            CONF_CHANGE_THRESHOLD, default=DEFAULT_CHANGE_THRESHOLD
+        ): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+        vol.Optional(CONF_CACHE_SIZE, default=DEFAULT_CACHE_SIZE): cv.positive_int,
+        vol.Optional(CONF_CACHE_TTL, default=DEFAULT_CACHE_TTL): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
     }
 )
 
-Box = namedtuple("Box", "y_min x_min y_max x_max")
-Point = namedtuple("Point", "y x")
-
-
-def point_in_box(box: Box, point: Point) -> bool:
-    """Return true if point lies in box"""
-    if (box.x_min <= point.x <= box.x_max) and (box.y_min <= point.y <= box.y_max):
-        return True
-    return False
-
-
-def object_in_roi(roi: dict, centroid: dict) -> bool:
-    """Convenience to convert dicts to the Point and Box."""
-    target_center_point = Point(centroid["y"], centroid["x"])
-    roi_box = Box(roi["y_min"], roi["x_min"], roi["y_max"], roi["x_max"])
-    return point_in_box(roi_box, target_center_point)
-
-
 def get_valid_filename(name: str) -> str:
     return re.sub(r"(?u)[^-\w.]", "", str(name).strip().replace(" ", "_"))
 
 
+def get_body_size(body: Union[bytes, List]) -> int:
+    """Return the bytes of a request body, or of all tiles."""
+    if isinstance(body, bytes):
+        return len(body)
+    return sum(len(tile) for _, tile in body)
+
+
 def get_object_type(object_name: str) -> str:
     if object_name == PERSON:
         return PERSON
@@ -176,58 +360,367 @@ def get_object_type(object_name: str) -> str:
         return OTHER
 
 
+class ObjectArrays(NamedTuple):
+    """Objects as arrays with one row per object, values are rounded as in get_objects."""
+
+    names: List[str]
+    object_types: List[str]
+    confidences: np.ndarray  # in %
+    boxes: np.ndarray  # height, width, y_min, x_min, y_max, x_max relative to the image
+    box_areas: np.ndarray
+    centroids: np.ndarray  # x, y relative to the image
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+class ScanFrame(NamedTuple):
+    """A frame prepared for a scan, with all the scan needs to save its snapshot.
+
+    Scans of an entity can overlap, so this is passed through the scan
+    rather than kept on the entity.
+    """
+
+    body: Union[bytes, List]  # The request body, or the offsets and bodies of tiles
+    frame: bytes  # As received from the camera
+    image: Optional["Image.Image"]  # As sent, None to render it from frame
+    width: int
+    height: int
+    cache_key: Optional[str] = None
+    prefilter_body: Optional[bytes] = None  # The first pass, and its size
+    prefilter_size: Optional[Tuple[int, int]] = None
+
+
+def round_array(values: np.ndarray, decimal_places: int = DECIMAL_PLACES) -> np.ndarray:
+    """Round values as the builtin round() does.
+
+    np.round scales by a power of ten first, which can land exactly on a tie
+    and round the other way, so values near a tie are rounded one by one.
+    """
+    rounded = np.round(values, decimal_places)
+    scaled = values * 10 ** decimal_places
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [
+            round(value, decimal_places) for value in values[near_tie].tolist()
+        ]
+    return rounded
+
+
+def get_object_arrays(
+    predictions: list, img_width: int, img_height: int
+) -> ObjectArrays:
+    """Return the predictions as ObjectArrays, parsing all of them in one pass."""
+    names = [pred["label"] for pred in predictions]
+    coords = np.array(
+        [
+            (pred["y_min"], pred["x_min"], pred["y_max"], pred["x_max"])
+            for pred in predictions
+        ],
+        dtype=float,
+    ).reshape(-1, 4)
+    confidences = np.array([pred["confidence"] for pred in predictions], dtype=float)
+
+    boxes = np.empty((len(names), 6))
+    boxes[:, 0] = round_array((coords[:, 2] - coords[:, 0]) / img_height)
+    boxes[:, 1] = round_array((coords[:, 3] - coords[:, 1]) / img_width)
+    boxes[:, 2:] = round_array(
+        coords / np.array([img_height, img_width, img_height, img_width], dtype=float)
+    )
+    centroids = np.empty((len(names), 2))
+    centroids[:, 0] = round_array(boxes[:, 3] + (boxes[:, 1] / 2))
+    centroids[:, 1] = round_array(boxes[:, 2] + (boxes[:, 0] / 2))
+    return ObjectArrays(
+        names=names,
+        object_types=[get_object_type(name) for name in names],
+        confidences=round_array(confidences * 100),
+        boxes=boxes,
+        box_areas=round_array(boxes[:, 0] * boxes[:, 1]),
+        centroids=centroids,
+    )
+
+
+EMPTY_OBJECTS = get_object_arrays([], 1, 1)
+
+
+def get_object_dicts(objects: ObjectArrays, indices=None) -> List[Dict]:
+    """Return the objects at indices, or all objects, in the get_objects format."""
+    if indices is None:
+        indices = range(len(objects))
+    boxes = objects.boxes.tolist()
+    box_areas = objects.box_areas.tolist()
+    centroids = objects.centroids.tolist()
+    confidences = objects.confidences.tolist()
+    return [
+        {
+            "bounding_box": dict(zip(BOX_KEYS, boxes[index])),
+            "box_area": box_areas[index],
+            "centroid": {"x": centroids[index][0], "y": centroids[index][1]},
+            "name": objects.names[index],
+            "object_type": objects.object_types[index],
+            "confidence": confidences[index],
+        }
+        for index in indices
+    ]
+
+
 def get_objects(predictions: list, img_width: int, img_height: int) -> List[Dict]:
     """Return objects with formatting and extra info."""
-    objects = []
-    decimal_places = 3
-    for pred in predictions:
-        box_width = pred["x_max"] - pred["x_min"]
-        box_height = pred["y_max"] - pred["y_min"]
-        box = {
-            "height": round(box_height / img_height, decimal_places),
-            "width": round(box_width / img_width, decimal_places),
-            "y_min": round(pred["y_min"] / img_height, decimal_places),
-            "x_min": round(pred["x_min"] / img_width, decimal_places),
-            "y_max": round(pred["y_max"] / img_height, decimal_places),
-            "x_max": round(pred["x_max"] / img_width, decimal_places),
-        }
-        box_area = round(box["height"] * box["width"], decimal_places)
-        centroid = {
-            "x": round(box["x_min"] + (box["width"] / 2), decimal_places),
-            "y": round(box["y_min"] + (box["height"] / 2), decimal_places),
+    return get_object_dicts(get_object_arrays(predictions, img_width, img_height))
+
+
+def merge_tile_predictions(
+    tile_predictions: List[Tuple[Tuple[int, int], List[Dict]]],
+    iou_threshold: float = NMS_IOU_THRESHOLD,
+) -> List[Dict]:
+    """Return the predictions of overlapping tiles in frame coordinates.
+
+    tile_predictions holds the (left, top) offset of each tile and its
+    predictions. Boxes are shifted by the offset, and where boxes of the same
+    label overlap by more than iou_threshold, only the most confident is kept
+    (non-maximum suppression).
+    """
+    predictions = [
+        dict(
+            pred,
+            x_min=pred["x_min"] + left,
+            x_max=pred["x_max"] + left,
+            y_min=pred["y_min"] + top,
+            y_max=pred["y_max"] + top,
+        )
+        for (left, top), preds in tile_predictions
+        for pred in preds
+    ]
+    if not predictions:
+        return []
+    boxes = np.array(
+        [
+            (pred["y_min"], pred["x_min"], pred["y_max"], pred["x_max"])
+            for pred in predictions
+        ],
+        dtype=float,
+    )
+    labels = np.array([pred["label"] for pred in predictions])
+    order = np.argsort([-pred["confidence"] for pred in predictions], kind="stable")
+    overlapping = (iou_matrix(boxes, boxes) > iou_threshold) & (
+        labels[:, None] == labels[None, :]
+    )
+    keep = []
+    suppressed = np.zeros(len(predictions), dtype=bool)
+    for index in order:
+        if suppressed[index]:
+            continue
+        keep.append(index)
+        suppressed |= overlapping[index]
+    return [predictions[index] for index in keep]
+
+
+def get_objects_in_roi(objects: ObjectArrays, roi: dict) -> np.ndarray:
+    """Return a mask of the objects with their centroid in the roi."""
+    x_values = objects.centroids[:, 0]
+    y_values = objects.centroids[:, 1]
+    return (
+        (roi["x_min"] <= x_values)
+        & (x_values <= roi["x_max"])
+        & (roi["y_min"] <= y_values)
+        & (y_values <= roi["y_max"])
+    )
+
+
+class TargetMatcher:
+    """Confidence thresholds of the targets, looked up by object name.
+
+    A target can be an object name or an object type, and the confidence of
+    a target for the name takes precedence over one for its type. Names are
+    resolved once, those of the default model when the matcher is built.
+    """
+
+    def __init__(self, targets: List[Dict]):
+        self._confidences = {
+            target[CONF_TARGET]: target[CONF_CONFIDENCE] for target in targets
         }
-        name = pred["label"]
-        object_type = get_object_type(name)
-        confidence = round(pred["confidence"] * 100, decimal_places)
-
-        objects.append(
-            {
-                "bounding_box": box,
-                "box_area": box_area,
-                "centroid": centroid,
-                "name": name,
-                "object_type": object_type,
-                "confidence": confidence,
-            }
+        self._thresholds = {}
+        for name in ANIMALS | VEHICLES | {PERSON}:
+            self.get_threshold(name)
+
+    def get_threshold(self, name: str) -> float:
+        """Return the confidence threshold for name, NaN if it is not a target."""
+        threshold = self._thresholds.get(name)
+        if threshold is None:
+            threshold = self._confidences.get(name)
+            if threshold is None:
+                threshold = self._confidences.get(get_object_type(name), np.nan)
+            self._thresholds[name] = threshold
+        return threshold
+
+
+@functools.lru_cache(maxsize=None)
+def _get_target_matcher(confidences: Tuple[Tuple[str, float], ...]) -> TargetMatcher:
+    return TargetMatcher(
+        [
+            {CONF_TARGET: target, CONF_CONFIDENCE: confidence}
+            for target, confidence in confidences
+        ]
+    )
+
+
+def get_target_matcher(targets: List[Dict]) -> TargetMatcher:
+    """Return the matcher of targets, shared by the entities and zones with them."""
+    return _get_target_matcher(
+        tuple((target[CONF_TARGET], target[CONF_CONFIDENCE]) for target in targets)
+    )
+
+
+def get_target_thresholds(objects: ObjectArrays, matcher: TargetMatcher) -> np.ndarray:
+    """Return the confidence threshold of each object, NaN if it is not a target."""
+    return np.fromiter(
+        map(matcher.get_threshold, objects.names), dtype=float, count=len(objects)
+    )
+
+
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """Return a mask of the (x, y) points inside polygon, by ray casting.
+
+    Every point is tested against every edge of the polygon at once, a point
+    is inside if a ray from it crosses an odd number of edges.
+    """
+    x_values = points[:, 0:1]
+    y_values = points[:, 1:2]
+    x_1, y_1 = polygon[:, 0], polygon[:, 1]
+    x_2, y_2 = np.roll(x_1, -1), np.roll(y_1, -1)
+    spans = (y_1 > y_values) != (y_2 > y_values)
+    # Horizontal edges never span a point, so their NaN crossings are unused
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_crossings = x_1 + (y_values - y_1) * (x_2 - x_1) / (y_2 - y_1)
+    crossings = np.count_nonzero(spans & (x_values < x_crossings), axis=1)
+    return crossings % 2 == 1
+
+
+class Zone:
+    """A named area of the frame, with the targets to find in it."""
+
+    def __init__(self, name: str, polygon: np.ndarray, targets: List[Dict]):
+        self.name = name
+        self.polygon = polygon  # (x, y) vertices relative to the frame
+        self.targets = targets
+        self.target_matcher = get_target_matcher(targets)
+
+    @classmethod
+    def from_config(cls, config: Dict, default_targets: List[Dict], confidence: float):
+        """Return the zone for its config, a box is converted to a polygon."""
+        polygon = config.get(CONF_POLYGON)
+        if polygon is None:
+            x_min, x_max = config["x_min"], config["x_max"]
+            y_min, y_max = config["y_min"], config["y_max"]
+            polygon = [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max)]
+        targets = [
+            {CONF_CONFIDENCE: confidence, **target}
+            for target in config.get(CONF_TARGETS, default_targets)
+        ]
+        return cls(config[CONF_NAME], np.array(polygon, dtype=float), targets)
+
+    def get_targets_found(
+        self, objects: ObjectArrays, centroids: np.ndarray
+    ) -> np.ndarray:
+        """Return a mask of the target objects with their centroid in the zone."""
+        thresholds = get_target_thresholds(objects, self.target_matcher)
+        return (objects.confidences > thresholds) & points_in_polygon(
+            centroids, self.polygon
         )
-    return objects
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the classifier."""
+    stream_source = config.get(CONF_STREAM_SOURCE)
+    if stream_source and len(config[CONF_SOURCE]) > 1:
+        _LOGGER.error("Deepstack %s requires a single source", CONF_STREAM_SOURCE)
+        return
+    server_configs = list(config[CONF_SERVERS])
+    if CONF_IP_ADDRESS in config:
+        server_configs.insert(0, config)
+    servers = [
+        (
+            server[CONF_IP_ADDRESS],
+            server[CONF_PORT],
+            server.get(
+                CONF_MAX_CONCURRENT_REQUESTS, config[CONF_MAX_CONCURRENT_REQUESTS]
+            ),
+            server.get(CONF_CUSTOM_MODELS),
+        )
+        for server in server_configs
+    ]
+    if not servers:
+        _LOGGER.error(
+            "Deepstack requires an %s and %s, or %s",
+            CONF_IP_ADDRESS,
+            CONF_PORT,
+            CONF_SERVERS,
+        )
+        return
+    if len(servers) == 1:
+        ip_address, port, max_concurrent_requests, _ = servers[0]
+        client = get_client(
+            hass, ip_address, port, max_concurrent_requests=max_concurrent_requests
+        )
+    else:
+        client = get_pool(hass, servers)
+    scheduler = DetectionScheduler(
+        client,
+        max_in_flight=client.max_concurrent_requests,
+        max_wait=config[CONF_MAX_QUEUE_WAIT],
+    )
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, scheduler.async_stop)
+    cache = None
+    if config[CONF_CACHE_SIZE]:
+        cache = get_cache(hass, config[CONF_CACHE_SIZE], config[CONF_CACHE_TTL])
+    writer = None
     save_file_folder = config.get(CONF_SAVE_FILE_FOLDER)
     if save_file_folder:
         save_file_folder = Path(save_file_folder)
+        writer = get_writer(hass, config[CONF_SAVE_QUEUE_SIZE])
+    history = None
+    if config.get(CONF_HISTORY_DB):
+        history = await async_get_history(
+            hass, hass.config.path(config[CONF_HISTORY_DB])
+        )
+    workers = None
+    if config[CONF_IMAGE_WORKERS]:
+        workers = get_workers(hass, config[CONF_IMAGE_WORKERS])
+    async_setup_batch(hass)
 
+    # Targets and zones are compiled once, and shared by the entities
+    targets = [
+        {CONF_CONFIDENCE: config[CONF_CONFIDENCE], **target}
+        for target in config[CONF_TARGETS]
+    ]
+    zones = [
+        Zone.from_config(zone, targets, config[CONF_CONFIDENCE])
+        for zone in config[CONF_ZONES]
+    ]
+
+    live = False
+    if stream_source:
+        live = await hass.async_add_executor_job(is_live_source, stream_source)
     entities = []
     for camera in config[CONF_SOURCE]:
+        stream = None
+        if stream_source:
+            stream = FrameStream(
+                functools.partial(async_read_source, hass, stream_source),
+                config[CONF_STREAM_FPS],
+                live=live,
+            )
+        tracker = None
+        if config[CONF_TRACK_OBJECTS]:
+            tracker = ObjectTracker(
+                config[CONF_TRACK_IOU_THRESHOLD], config[CONF_TRACK_MAX_AGE]
+            )
         object_entity = ObjectClassifyEntity(
-            ip_address=config.get(CONF_IP_ADDRESS),
-            port=config.get(CONF_PORT),
+            scheduler=scheduler,
             api_key=config.get(CONF_API_KEY),
             timeout=config.get(CONF_TIMEOUT),
             custom_model=config.get(CONF_CUSTOM_MODEL),
-            targets=config.get(CONF_TARGETS),
+            targets=targets,
             confidence=config.get(CONF_CONFIDENCE),
             roi_y_min=config[CONF_ROI_Y_MIN],
             roi_x_min=config[CONF_ROI_X_MIN],
@@ -238,13 +731,33 @@ def setup_platform(hass, config, add_devices, discovery_info=None):
             save_file_folder=save_file_folder,
             save_file_format=config[CONF_SAVE_FILE_FORMAT],
             save_timestamped_file=config.get(CONF_SAVE_TIMESTAMPTED_FILE),
+            max_saved_files=config.get(CONF_MAX_SAVED_FILES),
+            max_saved_age=config.get(CONF_MAX_SAVED_AGE),
+            max_saved_mb=config.get(CONF_MAX_SAVED_MB),
             always_save_latest_file=config.get(CONF_ALWAYS_SAVE_LATEST_FILE),
             crop_roi=config[CONF_CROP_ROI],
+            change_threshold=config[CONF_CHANGE_THRESHOLD],
+            cache=cache,
+            writer=writer,
+            save_queue_policy=config[CONF_SAVE_QUEUE_POLICY],
+            stage_timings=config[CONF_STAGE_TIMINGS],
+            timing_events=config[CONF_TIMING_EVENTS],
+            adaptive_scan_interval=config[CONF_ADAPTIVE_SCAN_INTERVAL],
+            tile_size=config[CONF_TILE_SIZE],
+            tile_overlap=config[CONF_TILE_OVERLAP],
+            prefilter_scale=config[CONF_PREFILTER_SCALE],
+            prefilter_margin=config[CONF_PREFILTER_MARGIN],
+            all_objects_limit=config[CONF_ALL_OBJECTS_LIMIT],
+            zones=zones,
+            tracker=tracker,
+            stream=stream,
+            history=history,
+            workers=workers,
             camera_entity=camera.get(CONF_ENTITY_ID),
             name=camera.get(CONF_NAME),
         )
         entities.append(object_entity)
-    add_devices(entities)
+    async_add_entities(entities)
 
 
 class ObjectClassifyEntity(ImageProcessingEntity):
@@ -252,8 +765,7 @@ class ObjectClassifyEntity(ImageProcessingEntity):
 
     def __init__(
         self,
-        ip_address,
-        port,
+        scheduler,
         api_key,
         timeout,
         custom_model,
@@ -272,17 +784,32 @@ class ObjectClassifyEntity(ImageProcessingEntity):
         crop_roi,
         camera_entity,
         name=None,
+        change_threshold=DEFAULT_CHANGE_THRESHOLD,
+        cache=None,
+        writer=None,
+        save_queue_policy=POLICY_DROP,
+        stage_timings=False,
+        timing_events=False,
+        adaptive_scan_interval=False,
+        tile_size=DEFAULT_TILE_SIZE,
+        tile_overlap=DEFAULT_TILE_OVERLAP,
+        prefilter_scale=DEFAULT_PREFILTER_SCALE,
+        prefilter_margin=DEFAULT_PREFILTER_MARGIN,
+        all_objects_limit=0,
+        zones=(),
+        tracker=None,
+        stream=None,
+        history=None,
+        workers=None,
+        max_saved_files=None,
+        max_saved_age=None,
+        max_saved_mb=None,
     ):
         """Init with the API key and model id."""
         super().__init__()
-        self._dsobject = ds.DeepstackObject(
-            ip=ip_address,
-            port=port,
-            api_key=api_key,
-            timeout=timeout,
-            min_confidence=MIN_CONFIDENCE,
-            custom_model=custom_model,
-        )
+        self._scheduler = scheduler
+        self._api_key = api_key
+        self._timeout = timeout
         self._custom_model = custom_model
         self._confidence = confidence
         self._summary = {}
@@ -290,9 +817,13 @@ class ObjectClassifyEntity(ImageProcessingEntity):
         for target in self._targets:
             if CONF_CONFIDENCE not in target.keys():
                 target.update({CONF_CONFIDENCE: self._confidence})
-        self._targets_names = [
-            target[CONF_TARGET] for target in targets
-        ]  # can be a name or a type
+        self._target_matcher = get_target_matcher(self._targets)
+        self._zones = zones
+        self._zone_summaries = {zone.name: {} for zone in self._zones}
+        self._target_zones = []  # The zones of each target found
+        self._tracker = tracker
+        self._history = history
+        self._workers = workers
         self._camera = camera_entity
         if name:
             self._name = name
@@ -301,7 +832,7 @@ class ObjectClassifyEntity(ImageProcessingEntity):
             self._name = "deepstack_object_{}".format(camera_name)
 
         self._state = None
-        self._objects = []  # The parsed raw data
+        self._objects = EMPTY_OBJECTS  # The parsed raw data
         self._targets_found = []
         self._last_detection = None
 
@@ -314,85 +845,523 @@ class ObjectClassifyEntity(ImageProcessingEntity):
         self._crop_roi = crop_roi
         self._scale = scale
         self._show_boxes = show_boxes
-        self._image_width = None
-        self._image_height = None
         self._save_file_folder = save_file_folder
         self._save_file_format = save_file_format
         self._always_save_latest_file = always_save_latest_file
         self._save_timestamped_file = save_timestamped_file
+        self._retention = None
+        if (
+            save_file_folder
+            and save_timestamped_file
+            and (max_saved_files or max_saved_age or max_saved_mb)
+        ):
+            self._retention = SnapshotRetention(
+                save_file_folder,
+                self._name,
+                max_count=max_saved_files,
+                max_age=max_saved_age.total_seconds() if max_saved_age else None,
+                max_bytes=int(max_saved_mb * 1e6) if max_saved_mb else None,
+            )
         self._always_save_latest_file = always_save_latest_file
-        self._image = None
+        self._change_threshold = change_threshold
+        self._image_hash = None
+        self._change_score = None
+        self._frames_processed = 0
+        self._frames_skipped = 0
+        self._cache = cache
+        self._writer = writer
+        self._save_queue_policy = save_queue_policy
+        self._timings = StageTimings()
+        self._show_stage_timings = stage_timings
+        self._timing_events = timing_events
+        self._client = scheduler.client
+        self._adaptive_scan_interval = adaptive_scan_interval
+        self._last_scan = None
+        self._frames_shed = 0
+        self._snapshots_dropped = 0  # The writer is shared, its count is not
+        self._tile_size = tile_size
+        self._tile_overlap = tile_overlap
+        self._stream = stream
+        self._stream_task = None
+        self._last_prepared = None  # The last frame prepared, without its image
+        self._all_objects_limit = all_objects_limit
+        self._result_attributes = None  # Built on the first state write after a scan
+        self._prefilter_scale = prefilter_scale
+        self._prefilter_margin = prefilter_margin
+        # The first pass looks for any target of the entity or of a zone
+        self._prefilter_matchers = [self._target_matcher] + [
+            zone.target_matcher for zone in self._zones
+        ]
+        self._prefilter_confidence = MIN_CONFIDENCE
+        if prefilter_scale:
+            confidences = [
+                target[CONF_CONFIDENCE]
+                for zone in self._zones
+                for target in zone.targets
+            ] + [target[CONF_CONFIDENCE] for target in self._targets]
+            # Without targets nothing is a candidate, and the default is kept
+            self._prefilter_confidence = max(
+                MIN_CONFIDENCE, min(confidences, default=0) * prefilter_margin / 100
+            )
+        self._prefilter_stats = {
+            "first_stage": 0,
+            "second_stage": 0,
+            "bytes_sent": 0,
+            "bytes_saved": 0,
+        }
 
-    def process_image(self, image):
-        """Process an image."""
-        self._image = Image.open(io.BytesIO(bytearray(image)))
-        self._image_width, self._image_height = self._image.size
-        # scale to roi
-        if self._crop_roi:
-            roi = (
-                self._image_width * self._roi_dict["x_min"],
-                self._image_height * self._roi_dict["y_min"],
-                self._image_width * (self._roi_dict["x_max"]),
-                self._image_height * (self._roi_dict["y_max"])
+    async def async_added_to_hass(self):
+        """Start processing the stream, in stream mode."""
+        await super().async_added_to_hass()
+        self._client.register_entity()
+        register_batch_entity(self.hass, self)
+        if self._stream is not None:
+            self._stream_task = self.hass.async_create_background_task(
+                self._stream.async_run(self.async_process_stream_frame),
+                f"{self._name} stream",
             )
-            self._image = self._image.crop(roi)
-            self._image_width, self._image_height = self._image.size
-            with io.BytesIO() as output:
-                self._image.save(output, format="JPEG")
-                image = output.getvalue()
-            _LOGGER.debug(
-                (
-                    f"Image cropped with : {self._roi_dict} W={self._image_width} H={self._image_height}"
+        if self._retention is not None:
+            await self.hass.async_add_executor_job(self._retention.load)
+            self.async_on_remove(
+                async_track_time_interval(
+                    self.hass, self.async_prune_snapshots, RETENTION_INTERVAL
                 )
             )
-        # resize image if different then default
-        if self._scale != DEAULT_SCALE:
-            newsize = (self._image_width * self._scale, self._image_width * self._scale)
-            self._image.thumbnail(newsize, Image.ANTIALIAS)
-            self._image_width, self._image_height = self._image.size
-            with io.BytesIO() as output:
-                self._image.save(output, format="JPEG")
-                image = output.getvalue()
+
+    @callback
+    def async_prune_snapshots(self, now=None):
+        """Prune on the writer thread, for the age limit while nothing is saved."""
+        self._writer.submit(self._retention.prune)
+
+    async def async_will_remove_from_hass(self):
+        """Stop processing the stream, and stop counting the entity."""
+        self._client.unregister_entity()
+        unregister_batch_entity(self.hass, self)
+        if self._stream_task is not None:
+            self._stream_task.cancel()
+            self._stream_task = None
+
+    async def async_update(self):
+        """Fetch and process a camera image, unless the scan is shed.
+
+        Scans are shed before the image is fetched while the Deepstack server
+        is unavailable, and if adaptive_scan_interval is set when the entity
+        was scanned more recently than the server can keep up with. In stream
+        mode frames come from the stream, so scans do nothing.
+        """
+        if self._stream is not None:
+            _LOGGER.debug("Deepstack %s processes a stream, scan ignored", self._name)
+            return
+        if self.scan_shed():
+            return
+        await super().async_update()
+
+    async def async_process_stream_frame(self, frame: bytes):
+        """Process a frame sampled from the stream, unless it is shed."""
+        if self.scan_shed():
+            return
+        await self.async_process_image(frame)
+        self.async_write_ha_state()
+
+    def scan_shed(self) -> bool:
+        """Return True if the scan should be shed, counting it."""
+        now = time.monotonic()
+        if not self._client.available:
+            self._frames_shed += 1
+            _LOGGER.debug("Deepstack %s unavailable, scan shed", self._client.server)
+            return True
+        if (
+            self._adaptive_scan_interval
+            and self._last_scan is not None
+            and now - self._last_scan < self._client.min_scan_interval
+        ):
+            self._frames_shed += 1
+            _LOGGER.debug(
+                "Scan shed, minimum scan interval is %.2f seconds",
+                self._client.min_scan_interval,
+            )
+            return True
+        self._last_scan = now
+        return False
+
+    async def async_process_image(self, image):
+        """Process an image, the pixel work runs in the executor."""
+        scan_start = time.monotonic()
+        self._timings.start_scan()
+        result = SCAN_ERROR
+        try:
+            result = await self._async_process_image(image)
+        finally:
+            self.finish_scan(scan_start, result)
+
+    async def _async_process_image(self, image) -> str:
+        scan = await self.hass.async_add_executor_job(self.prepare_image, image)
+        if scan is None:
+            self._frames_skipped += 1
             _LOGGER.debug(
-                (
-                    f"Image scaled with : {self._scale} W={self._image_width} H={self._image_height}"
-                )
+                "Frame unchanged (score %s), keeping previous results",
+                self._change_score,
             )
+            return SCAN_UNCHANGED
+        self._frames_processed += 1
 
         self._state = None
-        self._objects = []  # The parsed raw data
+        self._objects = EMPTY_OBJECTS  # The parsed raw data
         self._targets_found = []
+        self._target_zones = []
         self._summary = {}
-        saved_image_path = None
+        self._zone_summaries = {zone.name: {} for zone in self._zones}
+        self._result_attributes = None
 
         try:
-            predictions = self._dsobject.detect(image)
-        except ds.DeepstackException as exc:
+            with self._timings.measure(STAGE_DETECT):
+                if self._cache is not None:
+                    predictions = await self._cache.async_get_or_detect(
+                        scan.cache_key,
+                        lambda: self.async_detect(scan.body),
+                        (lambda: self.async_prefilter(scan))
+                        if self._prefilter_scale
+                        else None,
+                    )
+                elif self._prefilter_scale and not await self.async_prefilter(scan):
+                    predictions = []  # No target candidate, the frame is not sent
+                else:
+                    predictions = await self.async_detect(scan.body)
+        except (DetectionDropped, ServerUnavailable) as exc:
+            _LOGGER.debug("Deepstack skipped frame : %s", exc)
+            self._frames_shed += 1
+            self._image_hash = None
+            if isinstance(exc, ServerUnavailable):
+                return SCAN_UNAVAILABLE
+            return SCAN_DROPPED
+        except DeepstackException as exc:
             _LOGGER.error("Deepstack error : %s", exc)
-            return
+            self._image_hash = None
+            return SCAN_ERROR
 
-        self._objects = get_objects(predictions, self._image_width, self._image_height)
-        self._targets_found = []
+        await self.hass.async_add_executor_job(
+            self.process_predictions, predictions, scan
+        )
+        return SCAN_PROCESSED
 
-        for obj in self._objects:
-            if not (
-                (obj["name"] in self._targets_names)
-                or (obj["object_type"] in self._targets_names)
-            ):
-                continue
-            ## Then check if the type has a configured confidence, if yes assign
-            ## Then if a confidence for a named object, this takes precedence over type confidence
-            confidence = None
-            for target in self._targets:
-                if obj["object_type"] == target[CONF_TARGET]:
-                    confidence = target[CONF_CONFIDENCE]
-            for target in self._targets:
-                if obj["name"] == target[CONF_TARGET]:
-                    confidence = target[CONF_CONFIDENCE]
-            if obj["confidence"] > confidence:
-                if not self._crop_roi and not object_in_roi(self._roi_dict, obj["centroid"]):
-                    continue
-                self._targets_found.append(obj)
+    def finish_scan(self, scan_start: float, result: str = SCAN_PROCESSED):
+        """Record the time and result of the scan, fire the timing event if configured.
+
+        Saving happens after the scan, so it is only included in the rolling timings.
+        """
+        self._timings.record(STAGE_TOTAL, (time.monotonic() - scan_start) * 1000)
+        self._timings.end_scan(result)
+        if self._timing_events:
+            event_data = {
+                stage: round(milliseconds, 1)
+                for stage, milliseconds in self._timings.last_scan.items()
+            }
+            event_data.update(self._timings.last_scan_copies)
+            event_data["result"] = result
+            event_data[ATTR_ENTITY_ID] = self.entity_id
+            self.hass.bus.async_fire(EVENT_SCAN_TIMING, event_data)
+
+    async def async_detect(self, image: Union[bytes, List]) -> List[Dict]:
+        """Return the raw predictions for image, or a list of tiles, from Deepstack."""
+        if self._tile_size:
+            return await self.async_detect_tiles(image)
+        return await self._scheduler.async_detect(
+            self._name, image, **self.get_detect_options()
+        )
+
+    async def async_detect_tiles(self, tiles: List) -> List[Dict]:
+        """Detect all tiles at once, merging their predictions in frame coordinates."""
+        detect_options = self.get_detect_options()
+        results = await asyncio.gather(
+            *(
+                self._scheduler.async_detect(
+                    f"{self._name}_tile_{index}", tile, **detect_options
+                )
+                for index, (_, tile) in enumerate(tiles)
+            )
+        )
+        return merge_tile_predictions(
+            [(offset, predictions) for (offset, _), predictions in zip(tiles, results)]
+        )
+
+    async def async_detect_frame(
+        self, frame: bytes
+    ) -> Tuple[List[Dict], List[List[str]]]:
+        """Return the targets in frame, and with zones the zones of each target.
+
+        For the batch service: the frame is prepared and filtered as a scan
+        would, but in a single pass and leaving the entity state as is.
+        Raises OSError if frame is not an image.
+        """
+        options = self.get_frame_options()._replace(
+            change_threshold=0.0, last_hash=None, prefilter_scale=0.0
+        )
+        if self._workers is not None:
+            prepared = await self.hass.async_add_executor_job(
+                self._workers.prepare, frame, options
+            )
+        else:
+            prepared = await self.hass.async_add_executor_job(
+                prepare_frame, frame, options
+            )
+        body = frame if prepared.body is None else prepared.body
+        detect_options = self.get_detect_options()
+        if self._tile_size:
+            results = await asyncio.gather(
+                *(self._client.async_detect(tile, **detect_options) for _, tile in body)
+            )
+            predictions = merge_tile_predictions(
+                [(offset, result) for (offset, _), result in zip(body, results)]
+            )
+        else:
+            predictions = await self._client.async_detect(body, **detect_options)
+        objects = get_object_arrays(predictions, *prepared.size)
+        indices, zone_found = self.find_targets(objects)
+        target_zones = []
+        if zone_found is not None:
+            target_zones = self.get_target_zones(zone_found, indices)
+        return get_object_dicts(objects, indices), target_zones
+
+    async def async_prefilter(self, scan: ScanFrame) -> bool:
+        """Return True if the first pass finds a target candidate in the ROI.
+
+        A candidate is any target of the entity or of a zone with at least
+        prefilter_margin times the confidence of the target, to allow for
+        the lower confidence of detections in the smaller frame.
+        """
+        with self._timings.measure(STAGE_PREFILTER):
+            predictions = await self._scheduler.async_detect(
+                self._name,
+                scan.prefilter_body,
+                **dict(
+                    self.get_detect_options(),
+                    min_confidence=self._prefilter_confidence,
+                ),
+            )
+        objects = get_object_arrays(predictions, *scan.prefilter_size)
+        thresholds = np.fmin.reduce(
+            [
+                get_target_thresholds(objects, matcher)
+                for matcher in self._prefilter_matchers
+            ]
+        )
+        candidates = objects.confidences >= thresholds * self._prefilter_margin
+        if not self._crop_roi:
+            candidates &= get_objects_in_roi(objects, self._roi_dict)
+
+        stats = self._prefilter_stats
+        stats["first_stage"] += 1
+        stats["bytes_sent"] += len(scan.prefilter_body)
+        stats["bytes_saved"] -= len(scan.prefilter_body)
+        if candidates.any():
+            stats["second_stage"] += 1
+            stats["bytes_sent"] += get_body_size(scan.body)
+            return True
+        stats["bytes_saved"] += get_body_size(scan.body)
+        return False
+
+    def get_detect_options(self) -> Dict:
+        """Return the options of a Deepstack request."""
+        return {
+            "api_key": self._api_key,
+            "timeout": self._timeout,
+            "min_confidence": MIN_CONFIDENCE,
+            "custom_model": self._custom_model,
+        }
+
+    def prepare_image(self, image: bytes) -> Optional[ScanFrame]:
+        """Decode the image, crop and scale it, returning the body to send.
+
+        In tiling mode the body is a list of the (left, top) offset and bytes
+        of each tile instead. Returns None if the frame has not changed since
+        the last one sent.
+
+        A frame with the same bytes as the last one prepared, as cameras return
+        until they have a new snapshot, is not decoded again and the prepared
+        request body is reused.
+
+        In two stage detection the body of the first pass is prepared too.
+        With image workers all the pixel work runs in a worker process.
+        """
+        last = self._last_prepared
+        if last is not None and image == last.frame:
+            if self._change_threshold and self._image_hash is not None:
+                self._change_score = 0.0
+                return None
+            # Decoded again in the background only if a snapshot is saved
+            return last
+        if self._workers is not None:
+            scan = self.prepare_offloaded(image)
+        else:
+            scan = self._prepare_image(image)
+            if scan is not None and self._prefilter_scale:
+                with self._timings.measure(STAGE_CROP_SCALE):
+                    scan = self.prepare_prefilter(scan)
+        if scan is None:
+            return None
+        if self._cache is not None:
+            scan = scan._replace(
+                cache_key=get_cache_key(
+                    image,
+                    self._custom_model,
+                    tuple(self._roi_dict.values()) if self._crop_roi else None,
+                    self._scale,
+                    (self._tile_size, self._tile_overlap) if self._tile_size else None,
+                )
+            )
+        self._last_prepared = scan._replace(image=None)
+        return scan
+
+    def prepare_offloaded(self, image: bytes) -> Optional[ScanFrame]:
+        """Prepare the frame in a worker process, as _prepare_image does.
+
+        No decoded image is kept, a snapshot is rendered from the frame in a
+        worker too.
+        """
+        with self._timings.measure(STAGE_OFFLOAD):
+            prepared = self._workers.prepare(image, self.get_frame_options())
+        self._timings.record_copy(len(image))  # To shared memory
+        if prepared.change_score is not None:
+            self._change_score = prepared.change_score
+        if prepared.unchanged:
+            return None
+        if prepared.image_hash is not None:
+            self._image_hash = prepared.image_hash
+        return ScanFrame(
+            image if prepared.body is None else prepared.body,
+            image,
+            None,
+            *prepared.size,
+            prefilter_body=prepared.prefilter_body,
+            prefilter_size=prepared.prefilter_size,
+        )
+
+    def get_frame_options(self) -> FrameOptions:
+        """Return how frames are prepared, for prepare_frame."""
+        return FrameOptions(
+            roi=tuple(self._roi_dict.values()) if self._crop_roi else None,
+            scale=self._scale,
+            tile_size=self._tile_size,
+            tile_overlap=self._tile_overlap,
+            change_threshold=self._change_threshold,
+            last_hash=self._image_hash,
+            prefilter_scale=self._prefilter_scale,
+        )
+
+    def prepare_prefilter(self, scan: ScanFrame) -> ScanFrame:
+        """Prepare the first pass, the frame as sent but scaled by prefilter_scale.
+
+        It is scaled from the decoded frame. A frame sent as is is not
+        otherwise decoded, so it is decoded in draft mode at a fraction of
+        its size instead.
+        """
+        if self.frame_sent_as_is():
+            img = render_frame(scan.frame, None, self._prefilter_scale)
+        else:
+            img = crop_and_scale(
+                scan.image, scan.image.size, None, self._prefilter_scale
+            )
+        body = encode_jpeg(img)
+        self._timings.record_copy(get_image_nbytes(img))
+        self._timings.record_copy(len(body))
+        return scan._replace(prefilter_body=body, prefilter_size=img.size)
+
+    def frame_sent_as_is(self) -> bool:
+        """Return True if frames are sent without being decoded."""
+        resize = self._crop_roi or self._scale != DEAULT_SCALE
+        return not (resize or self._change_threshold or self._tile_size)
+
+    def _prepare_image(self, image: bytes) -> Optional[ScanFrame]:
+        resize = self._crop_roi or self._scale != DEAULT_SCALE
+        if self.frame_sent_as_is():
+            # The image is sent as is, and only decoded if it is saved
+            img = open_image(image)
+            return ScanFrame(image, image, img, *img.size)
+
+        with self._timings.measure(STAGE_DECODE):
+            img, full_size = decode_image(
+                image, DEAULT_SCALE if self._tile_size else self._scale
+            )
+            self._timings.record_copy(get_image_nbytes(img))
+            if self._change_threshold and self.frame_unchanged(img):
+                return None
+        if self._tile_size:
+            with self._timings.measure(STAGE_CROP_SCALE):
+                img, tiles = self.prepare_tiles(img, full_size)
+            return ScanFrame(tiles, image, img, *img.size)
+        if not resize:
+            return ScanFrame(image, image, img, *img.size)
+
+        with self._timings.measure(STAGE_CROP_SCALE):
+            roi = tuple(self._roi_dict.values()) if self._crop_roi else None
+            scaled = crop_and_scale(img, full_size, roi, self._scale)
+            if scaled is not img:
+                self._timings.record_copy(get_image_nbytes(scaled))
+            img = scaled
+            body = encode_jpeg(img)
+            self._timings.record_copy(len(body))
+        _LOGGER.debug(
+            "Image cropped to %s and scaled by %s, W=%s H=%s",
+            roi,
+            self._scale,
+            img.width,
+            img.height,
+        )
+        return ScanFrame(body, image, img, *img.size)
+
+    def prepare_tiles(
+        self, img: "Image.Image", full_size: Tuple[int, int]
+    ) -> Tuple["Image.Image", List]:
+        """Crop img to the roi if configured, and split it into tiles.
+
+        Returns the cropped image and the tiles. Tiles are sent at full
+        resolution, so the scale is not applied.
+        """
+        if self._crop_roi:
+            roi = tuple(self._roi_dict.values())
+            img = crop_and_scale(img, full_size, roi)
+            self._timings.record_copy(get_image_nbytes(img))
+        tiles = get_tiles(img.width, img.height, self._tile_size, self._tile_overlap)
+        _LOGGER.debug(
+            "Image W=%s H=%s split into %s tiles",
+            img.width,
+            img.height,
+            len(tiles),
+        )
+        prepared = []
+        for box in tiles:
+            tile = img.crop(box)
+            body = encode_jpeg(tile)
+            self._timings.record_copy(get_image_nbytes(tile))
+            self._timings.record_copy(len(body))
+            prepared.append((box[:2], body))
+        return img, prepared
+
+    def render_snapshot(self, frame: bytes) -> "Image.Image":
+        """Decode, crop and scale frame as it was sent, to save a reused frame."""
+        scale = DEAULT_SCALE if self._tile_size else self._scale
+        roi = tuple(self._roi_dict.values()) if self._crop_roi else None
+        return render_frame(frame, roi, scale)
+
+    def process_predictions(self, predictions: List[Dict], scan: ScanFrame):
+        """Filter the predictions for targets, save the image and fire events."""
+        with self._timings.measure(STAGE_POSTPROCESS):
+            self._process_predictions(predictions, scan)
+        self._result_attributes = None
+
+    def _process_predictions(self, predictions: List[Dict], scan: ScanFrame):
+        saved_image_path = None
+        self._objects = get_object_arrays(predictions, scan.width, scan.height)
+        indices, zone_found = self.find_targets(self._objects)
+        if zone_found is not None:
+            for zone, found in zip(self._zones, zone_found):
+                self._zone_summaries[zone.name] = dict(
+                    Counter(
+                        self._objects.names[index] for index in np.flatnonzero(found)
+                    )
+                )
+            self._target_zones = self.get_target_zones(zone_found, indices)
+        self._targets_found = get_object_dicts(self._objects, indices)
 
         self._state = len(self._targets_found)
         if self._state > 0:
@@ -403,20 +1372,145 @@ class ObjectClassifyEntity(ImageProcessingEntity):
         ]  # Just the list of target names, e.g. [car, car, person]
         self._summary = dict(Counter(targets_found))  # e.g. {'car':2, 'person':1}
 
+        updates = expired = None
+        if self._tracker is not None:
+            updates, expired = self._tracker.update(
+                targets_found, self._objects.boxes[indices, 2:], self._target_zones
+            )
+            # Only new objects, or objects entering a zone, are reported
+            notify = any(update.new or update.entered for update in updates)
+        else:
+            notify = self._state > 0
+
+        save_paths = None
         if self._save_file_folder:
-            if self._state > 0 or self._always_save_latest_file:
-                saved_image_path = self.save_image(
+            if notify or self._always_save_latest_file:
+                save_paths = self.get_save_paths(self._targets_found if notify else [])
+                saved_image_path = str(save_paths[1] or save_paths[0])
+
+        self.fire_events(saved_image_path, updates, expired)
+        if self._history is not None and self._targets_found:
+            self._history.record(
+                get_rows(
+                    self.entity_id,
+                    time.time(),
                     self._targets_found,
-                    self._save_file_folder,
+                    self._target_zones if self._zones else (),
+                    [update.track_id for update in updates] if updates else (),
+                    saved_image_path,
                 )
+            )
 
-        # Fire events
-        for target in self._targets_found:
+        # Annotate and save in the background, to the paths reserved above
+        if save_paths:
+            image = scan.image
+            if self._workers is not None:  # Rendered from the frame in a worker
+                image = scan.frame
+            elif image is None:  # A reused frame, decode it in the background
+                image = functools.partial(self.render_snapshot, scan.frame)
+            if not self._writer.submit(
+                functools.partial(
+                    self.save_image, image, self._targets_found, *save_paths
+                ),
+                self._save_queue_policy,
+            ):
+                self._snapshots_dropped += 1
+
+    def fire_events(self, saved_image_path, updates=None, expired=None):
+        """Fire an event for each target found, or with tracking for each change.
+
+        With zones, an event is fired for each zone the target is in, and
+        with tracking only for the zones it entered.
+        """
+        for index, target in enumerate(self._targets_found):
             target_event_data = target.copy()
             target_event_data[ATTR_ENTITY_ID] = self.entity_id
             if saved_image_path:
                 target_event_data[SAVED_FILE] = saved_image_path
-            self.hass.bus.fire(EVENT_OBJECT_DETECTED, target_event_data)
+            if updates is None:
+                zone_names = self._target_zones[index] if self._zones else [None]
+            else:
+                update = updates[index]
+                target_event_data[ATTR_TRACK_ID] = update.track_id
+                if self._zones:
+                    zone_names = update.entered
+                else:
+                    zone_names = [None] if update.new else []
+                for zone_name in update.left:
+                    self.fire_object_left(target["name"], update.track_id, zone_name)
+            for zone_name in zone_names:
+                if zone_name is not None:
+                    target_event_data[ATTR_ZONE] = zone_name
+                self.hass.bus.fire(EVENT_OBJECT_DETECTED, dict(target_event_data))
+
+        for track in expired or ():
+            for zone_name in sorted(track.zones) or [None]:
+                self.fire_object_left(track.name, track.track_id, zone_name)
+
+    def fire_object_left(self, name: str, track_id: int, zone_name: Optional[str]):
+        """Fire the event for a tracked object leaving a zone, or the frame."""
+        event_data = {
+            ATTR_ENTITY_ID: self.entity_id,
+            "name": name,
+            ATTR_TRACK_ID: track_id,
+        }
+        if zone_name is not None:
+            event_data[ATTR_ZONE] = zone_name
+        self.hass.bus.fire(EVENT_OBJECT_LEFT, event_data)
+
+    def find_targets(
+        self, objects: ObjectArrays
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Return the indices of the targets among objects.
+
+        With zones, the mask of the targets in each zone is returned too, with
+        a row per zone and a column per object, else None.
+        """
+        if self._zones:
+            zone_found = self.find_zone_targets(objects)
+            return np.flatnonzero(zone_found.any(axis=0)), zone_found
+        thresholds = get_target_thresholds(objects, self._target_matcher)
+        # NaN thresholds, for objects that are not targets, compare as False
+        found = objects.confidences > thresholds
+        if not self._crop_roi:
+            found &= get_objects_in_roi(objects, self._roi_dict)
+        return np.flatnonzero(found), None
+
+    def find_zone_targets(self, objects: ObjectArrays) -> np.ndarray:
+        """Match the objects against every zone, return a mask with a row per zone."""
+        centroids = objects.centroids
+        if self._crop_roi:  # Zones are relative to the full frame
+            y_min, x_min, y_max, x_max = self._roi_dict.values()
+            centroids = centroids * [x_max - x_min, y_max - y_min] + [x_min, y_min]
+        zone_found = np.array(
+            [zone.get_targets_found(objects, centroids) for zone in self._zones]
+        ).reshape(len(self._zones), len(objects))
+        if not self._crop_roi:
+            zone_found &= get_objects_in_roi(objects, self._roi_dict)
+        return zone_found
+
+    def get_target_zones(
+        self, zone_found: np.ndarray, indices: np.ndarray
+    ) -> List[List[str]]:
+        """Return the names of the zones each target is in."""
+        zone_names = [zone.name for zone in self._zones]
+        return [
+            list(itertools.compress(zone_names, zone_found[:, index]))
+            for index in indices
+        ]
+
+    def frame_unchanged(self, img: "Image.Image") -> bool:
+        """Compare the hash of the new image with the last image sent."""
+        box = None
+        if self._crop_roi:
+            box = get_roi_box(img, tuple(self._roi_dict.values()))
+        image_hash = get_image_hash(img, box)
+        if self._image_hash is not None:
+            self._change_score = get_hash_difference(self._image_hash, image_hash)
+            if self._change_score < self._change_threshold:
+                return True
+        self._image_hash = image_hash
+        return False
 
     @property
     def camera_entity(self):
@@ -445,20 +1539,79 @@ class ObjectClassifyEntity(ImageProcessingEntity):
 
     @property
     def extra_state_attributes(self) -> Dict:
-        """Return device specific state attributes."""
+        """Return device specific state attributes.
+
+        The attributes of the detection results are only built again after a
+        scan, the counters are read on every state write.
+        """
+        if self._result_attributes is None:
+            self._result_attributes = self.get_result_attributes()
+        attr = dict(self._result_attributes)
+        if self._save_file_folder:
+            attr["snapshots_dropped"] = self._snapshots_dropped
+        if self._retention is not None:
+            attr["saved_files"] = {
+                "count": len(self._retention),
+                "mb": round(self._retention.bytes / 1e6, 1),
+                "pruned": self._retention.pruned,
+            }
+        if self._history is not None:
+            attr["history_dropped"] = self._history.stats["dropped"]
+        if self._change_threshold:
+            attr["frames_processed"] = self._frames_processed
+            attr["frames_skipped"] = self._frames_skipped
+            attr["change_score"] = self._change_score
+        attr["server"] = self._client.status
+        if self._adaptive_scan_interval:
+            attr["min_scan_interval"] = round(self._client.min_scan_interval, 2)
+        attr["frames_shed"] = self._frames_shed
+        if self._stream is not None:
+            attr["stream"] = dict(self._stream.stats)
+        if self._show_stage_timings:
+            attr["stage_timings_ms"] = self._timings.summary()
+            attr["scan_copies"] = self._timings.copy_summary()
+            attr["scan_results"] = self._timings.result_counts()
+        if self._prefilter_scale:
+            stats = self._prefilter_stats
+            attr["two_stage"] = dict(
+                stats,
+                second_stage_rate=round(
+                    stats["second_stage"] / max(1, stats["first_stage"]), 3
+                ),
+            )
+        if self._cache is not None:
+            attr["detection_cache"] = dict(self._cache.stats, size=len(self._cache))
+        return attr
+
+    def get_result_attributes(self) -> Dict:
+        """Return the attributes of the detection results and configuration."""
         attr = {}
         attr["targets"] = self._targets
         attr["targets_found"] = [
             {obj["name"]: obj["confidence"]} for obj in self._targets_found
         ]
         attr["summary"] = self._summary
+        if self._tracker is not None:
+            attr["active_tracks"] = len(self._tracker.tracks)
+        if self._zones:
+            attr[CONF_ZONES] = {
+                name: {"count": sum(summary.values()), "summary": summary}
+                for name, summary in self._zone_summaries.items()
+            }
         if self._last_detection:
             attr["last_target_detection"] = self._last_detection
         if self._custom_model:
             attr["custom_model"] = self._custom_model
-        attr["all_objects"] = [
-            {obj["name"]: obj["confidence"]} for obj in self._objects
-        ]
+        names = self._objects.names
+        confidences = self._objects.confidences.tolist()
+        indices = range(len(names))
+        if self._all_objects_limit:
+            # The most confident objects, in order of confidence
+            indices = np.argsort(-self._objects.confidences, kind="stable")[
+                : self._all_objects_limit
+            ].tolist()
+            attr["all_objects_count"] = len(names)
+        attr["all_objects"] = [{names[index]: confidences[index]} for index in indices]
         if self._save_file_folder:
             attr[CONF_SAVE_FILE_FOLDER] = str(self._save_file_folder)
             attr[CONF_SAVE_FILE_FORMAT] = self._save_file_format
@@ -466,69 +1619,78 @@ class ObjectClassifyEntity(ImageProcessingEntity):
             attr[CONF_ALWAYS_SAVE_LATEST_FILE] = self._always_save_latest_file
         return attr
 
-    def save_image(self, targets, directory) -> str:
-        """Draws the actual bounding box of the detected objects.
-
-        Returns: saved_image_path, which is the path to the saved timestamped file if configured, else the default saved image.
-        """
-        try:
-            img = self._image.convert("RGB")
-        except UnidentifiedImageError:
-            _LOGGER.warning("Deepstack unable to process image, bad data")
-            return
-        draw = ImageDraw.Draw(img)
-
-        roi_tuple = tuple(self._roi_dict.values())
-        if roi_tuple != DEFAULT_ROI and self._show_boxes and not self._crop_roi:
-            draw_box(
-                draw,
-                roi_tuple,
-                img.width,
-                img.height,
-                text="ROI",
-                color=GREEN,
-            )
-
-        for obj in targets:
-            if not self._show_boxes:
-                break
-            name = obj["name"]
-            confidence = obj["confidence"]
-            box = obj["bounding_box"]
-            centroid = obj["centroid"]
-            box_label = f"{name}: {confidence:.1f}%"
-
-            draw_box(
-                draw,
-                (box["y_min"], box["x_min"], box["y_max"], box["x_max"]),
-                img.width,
-                img.height,
-                text=box_label,
-                color=RED,
-            )
-
-            # draw bullseye
-            draw.text(
-                (centroid["x"] * img.width, centroid["y"] * img.height),
-                text="X",
-                fill=RED,
-            )
-
-        # Save images, returning the path of saved image as str
+    def get_save_paths(self, targets) -> Tuple[Path, Optional[Path]]:
+        """Return the paths of the latest file and of the timestamped file, if configured."""
         latest_save_path = (
-            directory
+            self._save_file_folder
             / f"{get_valid_filename(self._name).lower()}_latest.{self._save_file_format}"
         )
-        img.save(latest_save_path)
-        _LOGGER.info("Deepstack saved file %s", latest_save_path)
-        saved_image_path = latest_save_path
-
-        if self._save_timestamped_file:
+        timestamp_save_path = None
+        if self._save_timestamped_file and targets:
+            # In a folder per day, named from the date of the timestamp
             timestamp_save_path = (
-                directory
+                self._save_file_folder
+                / self._last_detection[:10]
                 / f"{self._name}_{self._last_detection}.{self._save_file_format}"
             )
-            img.save(timestamp_save_path)
-            _LOGGER.info("Deepstack saved file %s", timestamp_save_path)
-            saved_image_path = timestamp_save_path
-        return str(saved_image_path)
+        return latest_save_path, timestamp_save_path
+
+    def get_snapshot_options(self) -> SnapshotOptions:
+        """Return how snapshots are rendered and annotated, for the image workers."""
+        return SnapshotOptions(
+            roi=tuple(self._roi_dict.values()),
+            crop_roi=self._crop_roi,
+            scale=DEAULT_SCALE if self._tile_size else self._scale,
+            show_boxes=self._show_boxes,
+            zones=[(zone.name, zone.polygon) for zone in self._zones],
+            save_format=self._save_file_format,
+        )
+
+    def save_image(self, image, targets, latest_save_path, timestamp_save_path=None):
+        """Draws the actual bounding box of the detected objects and saves the image.
+
+        The latest file is replaced atomically, and the timestamped file is a hardlink to it.
+        """
+        with self._timings.measure(STAGE_SAVE, in_scan=False):
+            self._save_image(image, targets, latest_save_path, timestamp_save_path)
+
+    def _save_image(self, image, targets, latest_save_path, timestamp_save_path):
+        link_paths = [timestamp_save_path] if timestamp_save_path else []
+        if self._workers is not None:
+            if not self._workers.save(
+                image,
+                self.get_snapshot_options(),
+                targets,
+                latest_save_path,
+                link_paths,
+            ):
+                _LOGGER.warning("Deepstack unable to process image, bad data")
+                return
+        else:
+            # Imported on the first save, as PIL is slow to import
+            # pylint: disable=import-outside-toplevel
+            from PIL import UnidentifiedImageError
+
+            # Annotate the decoded frame in place, it is not used after saving
+            try:
+                img = image() if callable(image) else image
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+                img.load()  # A frame sent as is is only decoded here
+            except (UnidentifiedImageError, OSError):
+                _LOGGER.warning("Deepstack unable to process image, bad data")
+                return
+            if self._show_boxes:
+                annotate_image(
+                    img,
+                    targets,
+                    tuple(self._roi_dict.values()),
+                    self._crop_roi,
+                    [(zone.name, zone.polygon) for zone in self._zones],
+                )
+            write_image(img, latest_save_path, self._save_file_format, link_paths)
+        _LOGGER.info("Deepstack saved file %s", latest_save_path)
+        for path in link_paths:
+            _LOGGER.info("Deepstack saved file %s", path)
+        if self._retention is not None and timestamp_save_path:
+            self._retention.add(timestamp_save_path)
@@ -0,0 +1,125 @@
+"""
+Timings of the stages of processing a scan.
+
+Each stage of a scan (decoding, crop/scale or all the pixel work when it
+runs in a worker process, the Deepstack request and its first pass in two
+stage detection, post-processing and saving) is timed with a monotonic
+clock, and the last few hundred timings of each stage are kept to report
+rolling percentiles.
+The pixel and JPEG buffers allocated for a scan are counted the same way,
+and so is how each scan ended.
+"""
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict, List
+
+DEFAULT_WINDOW = 200
+STAGE_DECODE = "decode"
+STAGE_CROP_SCALE = "crop_scale"
+STAGE_OFFLOAD = "offload"
+STAGE_DETECT = "detect"
+STAGE_PREFILTER = "prefilter"
+STAGE_POSTPROCESS = "postprocess"
+STAGE_SAVE = "save"
+STAGE_TOTAL = "total"
+ALLOCATIONS = "allocations"
+BYTES_COPIED = "bytes_copied"
+SCAN_PROCESSED = "processed"
+SCAN_UNCHANGED = "unchanged"  # The frame was not sent
+SCAN_DROPPED = "dropped"  # Superseded by a newer frame, or shed
+SCAN_UNAVAILABLE = "unavailable"  # The server is marked unavailable
+SCAN_ERROR = "error"
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Return the nearest rank percentile of values."""
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class StageTimings:
+    """Rolling timings in milliseconds, by stage.
+
+    Stages can be recorded from the event loop, the executor and the
+    snapshot writer thread.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._lock = threading.Lock()
+        self._timings: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self.last_scan: Dict[str, float] = {}
+        self._copies: Dict[str, deque] = {
+            ALLOCATIONS: deque(maxlen=window),
+            BYTES_COPIED: deque(maxlen=window),
+        }
+        self.last_scan_copies = {ALLOCATIONS: 0, BYTES_COPIED: 0}
+        self.last_scan_result = None
+        self._results: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, milliseconds: float, in_scan: bool = True):
+        """Record a timing of stage, in_scan if it is part of the current scan."""
+        with self._lock:
+            self._timings[stage].append(milliseconds)
+        if in_scan:
+            self.last_scan[stage] = milliseconds
+
+    @contextmanager
+    def measure(self, stage: str, in_scan: bool = True):
+        """Time the body of the with statement as stage."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.monotonic() - start) * 1000, in_scan)
+
+    def record_copy(self, nbytes: int):
+        """Record a buffer of nbytes allocated and filled for the current scan."""
+        self.last_scan_copies[ALLOCATIONS] += 1
+        self.last_scan_copies[BYTES_COPIED] += nbytes
+
+    def start_scan(self):
+        """Clear the timings and copies of the last scan."""
+        self.last_scan = {}
+        self.last_scan_copies = {ALLOCATIONS: 0, BYTES_COPIED: 0}
+
+    def end_scan(self, result: str = SCAN_PROCESSED):
+        """Add the copies of the current scan to the rolling copies, count result."""
+        self.last_scan_result = result
+        with self._lock:
+            for key, value in self.last_scan_copies.items():
+                self._copies[key].append(value)
+            self._results[result] += 1
+
+    def result_counts(self) -> Dict[str, int]:
+        """Return the number of scans by how they ended."""
+        with self._lock:
+            return dict(self._results)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return the p50, p95 and max of each stage."""
+        with self._lock:
+            timings = {stage: list(values) for stage, values in self._timings.items()}
+        return summarize(timings)
+
+    def copy_summary(self) -> Dict[str, Dict[str, float]]:
+        """Return the p50, p95 and max per scan of allocations and bytes copied."""
+        with self._lock:
+            copies = {key: list(values) for key, values in self._copies.items()}
+        return summarize(copies)
+
+
+def summarize(samples: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    """Return the p50, p95 and max of each list of samples."""
+    return {
+        key: {
+            "p50": round(percentile(values, 50), 1),
+            "p95": round(percentile(values, 95), 1),
+            "max": round(max(values), 1),
+        }
+        for key, values in samples.items()
+        if values
+    }
@@ -0,0 +1,330 @@
+"""
+Image pipeline for preparing camera frames for Deepstack.
+
+A frame is decoded once, cropped to the ROI and scaled in a single resize,
+and encoded once for the request. JPEG frames that are scaled down are
+decoded at reduced size using draft mode, which skips most of the work of
+a full resolution decode. The decoded image is kept for annotation.
+
+prepare_frame does all the work of preparing a frame in one call, for a
+worker process, which keeps nothing between frames.
+
+PIL is imported on first use rather than with the integration, as frames
+are only prepared once Home Assistant has started.
+"""
+import io
+import math
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+JPEG = "JPEG"
+HASH_SIZE = 8  # difference hash of HASH_SIZE x HASH_SIZE bits
+
+# rgb(red, green, blue)
+RED = (255, 0, 0)  # For objects within the ROI
+GREEN = (0, 255, 0)  # For ROI box
+YELLOW = (255, 255, 0)  # Unused
+
+# (y_min, x_min, y_max, x_max) in the range [0.0, 1.0]
+RelativeBox = Tuple[float, float, float, float]
+
+
+class FrameOptions(NamedTuple):
+    """How prepare_frame prepares a frame, as configured on the entity."""
+
+    roi: Optional[RelativeBox]  # The ROI to crop to, if any
+    scale: float = 1.0
+    tile_size: int = 0
+    tile_overlap: float = 0.0
+    change_threshold: float = 0.0
+    last_hash: Optional[int] = None  # Of the last frame sent
+    prefilter_scale: float = 0.0  # Relative to the frame as sent
+
+
+class PreparedFrame(NamedTuple):
+    """A frame prepared by prepare_frame."""
+
+    body: Union[bytes, List, None]  # None when the frame is sent as is
+    size: Tuple[int, int]  # Of the frame as sent
+    image_hash: Optional[int] = None
+    change_score: Optional[float] = None
+    unchanged: bool = False  # The frame is not sent
+    prefilter_body: Optional[bytes] = None
+    prefilter_size: Optional[Tuple[int, int]] = None
+
+
+def open_image(image: bytes) -> "Image.Image":
+    """Open image without decoding it, the pixels are decoded on first use.
+
+    A BytesIO shares the buffer of the bytes it is created from, so the
+    frame is not copied.
+    """
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    return Image.open(io.BytesIO(image))
+
+
+def get_image_nbytes(img: "Image.Image") -> int:
+    """Return the size of the pixel buffer of img."""
+    return img.width * img.height * len(img.getbands())
+
+
+def decode_image(
+    image: bytes, scale: float = 1.0
+) -> Tuple["Image.Image", Tuple[int, int]]:
+    """Decode image to RGB, returning it with the full size of the frame.
+
+    When scale is below 1 a JPEG is decoded at the smallest of 1/2, 1/4 or
+    1/8 size that is still at least scale times the full size.
+    """
+    img = open_image(image)
+    full_size = img.size
+    if scale < 1 and img.format == JPEG:
+        img.draft(
+            "RGB", (math.ceil(full_size[0] * scale), math.ceil(full_size[1] * scale))
+        )
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    else:
+        img.load()
+    return img, full_size
+
+
+def get_output_size(
+    full_size: Tuple[int, int], roi: Optional[RelativeBox], scale: float
+) -> Tuple[int, int]:
+    """Return the size of the frame after cropping to roi and scaling."""
+    y_min, x_min, y_max, x_max = roi or (0.0, 0.0, 1.0, 1.0)
+    return (
+        max(1, round(full_size[0] * (x_max - x_min) * scale)),
+        max(1, round(full_size[1] * (y_max - y_min) * scale)),
+    )
+
+
+def crop_and_scale(
+    img: "Image.Image",
+    full_size: Tuple[int, int],
+    roi: Optional[RelativeBox] = None,
+    scale: float = 1.0,
+) -> "Image.Image":
+    """Crop img to roi and scale it, relative to the full size of the frame.
+
+    img may be smaller than full_size if it was decoded in draft mode.
+    """
+    size = get_output_size(full_size, roi, scale)
+    if roi is None and size == img.size:
+        return img
+    y_min, x_min, y_max, x_max = roi or (0.0, 0.0, 1.0, 1.0)
+    box = (
+        img.width * x_min,
+        img.height * y_min,
+        img.width * x_max,
+        img.height * y_max,
+    )
+    if scale == 1 and img.size == full_size:
+        return img.crop(tuple(round(value) for value in box))
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=2.0)
+
+
+def get_tiles(
+    width: int, height: int, tile_size: int, overlap: float
+) -> List[Tuple[int, int, int, int]]:
+    """Return the (left, top, right, bottom) boxes of overlapping square tiles.
+
+    Tiles are tile_size pixels, or the image size if that is smaller, and
+    neighbouring tiles overlap by at least the overlap fraction of a tile.
+    """
+
+    def starts(length: int) -> List[int]:
+        size = min(tile_size, length)
+        if size == length:
+            return [0]
+        count = math.ceil((length - size) / (size * (1 - overlap))) + 1
+        step = (length - size) / (count - 1)
+        return [round(index * step) for index in range(count)]
+
+    tile_width = min(tile_size, width)
+    tile_height = min(tile_size, height)
+    return [
+        (left, top, left + tile_width, top + tile_height)
+        for top in starts(height)
+        for left in starts(width)
+    ]
+
+
+def encode_jpeg(img: "Image.Image") -> bytes:
+    """Encode img as a JPEG."""
+    with io.BytesIO() as output:
+        img.save(output, format=JPEG)
+        return output.getvalue()
+
+
+def render_frame(
+    image: bytes, roi: Optional[RelativeBox] = None, scale: float = 1.0
+) -> "Image.Image":
+    """Decode image, crop it to roi and scale it in one call."""
+    img, full_size = decode_image(image, scale)
+    return crop_and_scale(img, full_size, roi, scale)
+
+
+def get_image_hash(image: "Image.Image", box: Optional[Tuple] = None) -> int:
+    """Return the difference hash of image, or of the box region of image.
+
+    The image is shrunk to (HASH_SIZE + 1) x HASH_SIZE greyscale pixels and each
+    bit records whether a pixel is brighter than its right hand neighbour.
+    """
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    small = image.resize(
+        (HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, box=box, reducing_gap=2.0
+    ).convert("L")
+    pixels = small.tobytes()
+    image_hash = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            image_hash = (image_hash << 1) | (left > right)
+    return image_hash
+
+
+def get_hash_difference(hash_a: int, hash_b: int) -> float:
+    """Return the fraction of bits that differ between two image hashes."""
+    return bin(hash_a ^ hash_b).count("1") / (HASH_SIZE * HASH_SIZE)
+
+
+def get_roi_box(img: "Image.Image", roi: RelativeBox) -> Tuple:
+    """Return roi in pixels of img, as a (left, top, right, bottom) box."""
+    y_min, x_min, y_max, x_max = roi
+    return (
+        img.width * x_min,
+        img.height * y_min,
+        img.width * x_max,
+        img.height * y_max,
+    )
+
+
+def prepare_frame(image: bytes, options: FrameOptions) -> PreparedFrame:
+    """Prepare image for a request as the entity configured by options does.
+
+    The frame is decoded, compared with the last frame sent, cropped and
+    scaled or split into tiles, and encoded, then the body of the first
+    pass is scaled from it for two stage detection.
+    """
+    resize = options.roi is not None or options.scale != 1
+    image_hash = change_score = None
+    if not (resize or options.change_threshold or options.tile_size):
+        body, size = None, open_image(image).size
+    else:
+        img, full_size = decode_image(
+            image, 1.0 if options.tile_size else options.scale
+        )
+        if options.change_threshold:
+            box = get_roi_box(img, options.roi) if options.roi else None
+            image_hash = get_image_hash(img, box)
+            if options.last_hash is not None:
+                change_score = get_hash_difference(options.last_hash, image_hash)
+                if change_score < options.change_threshold:
+                    return PreparedFrame(
+                        None, img.size, image_hash, change_score, unchanged=True
+                    )
+        if options.tile_size:
+            if options.roi:
+                img = crop_and_scale(img, full_size, options.roi)
+            body = [
+                (box[:2], encode_jpeg(img.crop(box)))
+                for box in get_tiles(
+                    img.width, img.height, options.tile_size, options.tile_overlap
+                )
+            ]
+        elif resize:
+            img = crop_and_scale(img, full_size, options.roi, options.scale)
+            body = encode_jpeg(img)
+        else:
+            body = None
+        size = img.size
+
+    prefilter_body = prefilter_size = None
+    if options.prefilter_scale:
+        if body is None and not options.change_threshold:
+            # Not otherwise decoded, decode it in draft mode at a fraction of its size
+            img = render_frame(image, None, options.prefilter_scale)
+        else:
+            img = crop_and_scale(img, img.size, None, options.prefilter_scale)
+        prefilter_body, prefilter_size = encode_jpeg(img), img.size
+    return PreparedFrame(
+        body,
+        size,
+        image_hash,
+        change_score,
+        prefilter_body=prefilter_body,
+        prefilter_size=prefilter_size,
+    )
+
+
+def annotate_image(
+    img: "Image.Image",
+    targets: List[Dict],
+    roi: RelativeBox,
+    crop_roi: bool,
+    zones: Sequence[Tuple[str, "np.ndarray"]] = (),
+):
+    """Draw the ROI, the (name, polygon) of each zone and the targets on img.
+
+    img is drawn on in place. Zones are relative to the full frame, and img
+    is the frame cropped to the ROI if crop_roi is set, in which case the
+    ROI is not drawn.
+    """
+    # Imported on the first save, as PIL and its drawing are slow to import
+    # pylint: disable=import-outside-toplevel
+    from homeassistant.util.pil import draw_box
+    from PIL import ImageDraw
+
+    draw = ImageDraw.Draw(img)
+    if roi != (0.0, 0.0, 1.0, 1.0) and not crop_roi:
+        draw_box(draw, roi, img.width, img.height, text="ROI", color=GREEN)
+
+    for name, polygon in zones:
+        if crop_roi:
+            y_min, x_min, y_max, x_max = roi
+            polygon = (polygon - [x_min, y_min]) / [x_max - x_min, y_max - y_min]
+        points = [(x * img.width, y * img.height) for x, y in polygon.tolist()]
+        draw.line(points + points[:1], fill=GREEN, width=3)
+        draw.text(points[0], text=name, fill=GREEN)
+
+    for obj in targets:
+        name = obj["name"]
+        confidence = obj["confidence"]
+        box = obj["bounding_box"]
+        centroid = obj["centroid"]
+        box_label = f"{name}: {confidence:.1f}%"
+
+        draw_box(
+            draw,
+            (box["y_min"], box["x_min"], box["y_max"], box["x_max"]),
+            img.width,
+            img.height,
+            text=box_label,
+            color=RED,
+        )
+
+        # draw bullseye
+        draw.text(
+            (centroid["x"] * img.width, centroid["y"] * img.height),
+            text="X",
+            fill=RED,
+        )
@@ -0,0 +1,187 @@
+"""
+A pool of Deepstack servers that detection requests are balanced across.
+
+Deepstack is CPU bound, so detection scales by running it on several
+machines. Each request goes to the server with the lowest expected wait,
+the number of its outstanding requests times its smoothed latency, among
+those hosting the custom model and not failing. When a request to a server
+fails it is retried on the next server, and failing servers are probed in
+the background until they answer again. The pool has the interface of a
+single DeepstackClient, so the scheduler and entities use either.
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from homeassistant.helpers.event import async_track_time_interval
+
+from .client import (
+    DeepstackClient,
+    DeepstackException,
+    RequestRejected,
+    ServerUnavailable,
+    get_client,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_POOLS = "deepstack_object_pools"
+HEALTH_CHECK_INTERVAL = timedelta(seconds=15)
+DEFAULT_LATENCY = 1.0  # seconds, until any server of the pool has answered
+
+
+class PoolServer:
+    """A server of the pool, and the custom models it hosts."""
+
+    def __init__(self, client: DeepstackClient, custom_models: Optional[List[str]]):
+        self.client = client
+        self.custom_models = None if custom_models is None else set(custom_models)
+
+    def hosts(self, custom_model: str) -> bool:
+        """Return True if the server can run custom_model, or the default model."""
+        return (
+            not custom_model
+            or self.custom_models is None
+            or custom_model in self.custom_models
+        )
+
+    def get_expected_wait(self, default_latency: float) -> float:
+        """Return the time a new request can expect to take, to rank servers.
+
+        Servers that have not answered yet are assumed to be as fast as
+        default_latency, so they are tried.
+        """
+        latency = self.client.latency
+        if latency is None:
+            latency = default_latency
+        slots = self.client.max_concurrent_requests
+        return latency * (self.client.in_flight + 1) / slots
+
+
+class DeepstackPool:
+    """Balance requests across servers, failing over to the next server on error."""
+
+    def __init__(self, servers: List[PoolServer]):
+        self._servers = servers
+        self.entities = 0
+
+    @property
+    def server(self) -> str:
+        """Return the servers, for logging."""
+        return ", ".join(server.client.server for server in self._servers)
+
+    @property
+    def max_concurrent_requests(self) -> int:
+        """Return the maximum number of requests in flight to all servers."""
+        return sum(server.client.max_concurrent_requests for server in self._servers)
+
+    @property
+    def available(self) -> bool:
+        """Return True if any server accepts requests."""
+        return any(server.client.available for server in self._servers)
+
+    @property
+    def min_scan_interval(self) -> float:
+        """Return the seconds between scans of each entity the pool can keep up with."""
+        throughput = sum(
+            server.client.max_concurrent_requests / server.client.latency
+            for server in self._servers
+            if server.client.latency and server.client.available
+        )
+        if not throughput:
+            return 0.0
+        return self.entities / throughput
+
+    @property
+    def status(self) -> Dict:
+        """Return the health of each server, for the entity attributes."""
+        return {server.client.server: server.client.status for server in self._servers}
+
+    def register_entity(self):
+        """Count an entity using the pool, for min_scan_interval."""
+        self.entities += 1
+
+    def unregister_entity(self):
+        """Stop counting an entity removed from Home Assistant."""
+        self.entities -= 1
+
+    def get_servers(self, custom_model: str) -> List[PoolServer]:
+        """Return the available servers hosting custom_model, best first."""
+        servers = [
+            server
+            for server in self._servers
+            if server.hosts(custom_model) and server.client.available
+        ]
+        default_latency = min(
+            (server.client.latency for server in servers if server.client.latency),
+            default=DEFAULT_LATENCY,
+        )
+        return sorted(
+            servers, key=lambda server: server.get_expected_wait(default_latency)
+        )
+
+    async def async_detect(self, image: bytes, custom_model: str = "", **kwargs):
+        """Return the raw predictions for image from the best server.
+
+        A request that fails on a server is retried on the next best one.
+        Raises ServerUnavailable if no server can take the request.
+        """
+        if not any(server.hosts(custom_model) for server in self._servers):
+            raise DeepstackException(
+                f"No Deepstack server hosts the custom model {custom_model}"
+            )
+        error = None
+        for server in self.get_servers(custom_model):
+            try:
+                return await server.client.async_detect(
+                    image, custom_model=custom_model, **kwargs
+                )
+            except RequestRejected:
+                raise  # the image or api key would be rejected by any server
+            except DeepstackException as exc:
+                _LOGGER.debug(
+                    "Deepstack %s failed, trying the next server: %s",
+                    server.client.server,
+                    exc,
+                )
+                error = exc
+        if error is not None:
+            raise error
+        raise ServerUnavailable("No Deepstack server is available")
+
+    async def async_check_health(self, *args):
+        """Probe the failing servers."""
+        for server in self._servers:
+            await server.client.async_check_health()
+
+
+def get_pool(
+    hass, servers: List[Tuple[str, int, int, Optional[List[str]]]]
+) -> DeepstackPool:
+    """Return the pool of servers, given as (ip, port, max requests, custom models).
+
+    Custom models are None for a server that hosts any model. Clients are
+    shared with other pools and platforms using the same server.
+    """
+    pools: Dict[tuple, DeepstackPool] = hass.data.setdefault(DATA_POOLS, {})
+    key = tuple(
+        (ip_address, port, None if custom_models is None else tuple(custom_models))
+        for ip_address, port, _, custom_models in servers
+    )
+    if key not in pools:
+        pool = pools[key] = DeepstackPool(
+            [
+                PoolServer(
+                    get_client(
+                        hass,
+                        ip_address,
+                        port,
+                        max_concurrent_requests=max_concurrent_requests,
+                    ),
+                    custom_models,
+                )
+                for ip_address, port, max_concurrent_requests, custom_models in servers
+            ]
+        )
+        async_track_time_interval(hass, pool.async_check_health, HEALTH_CHECK_INTERVAL)
+    return pools[key]
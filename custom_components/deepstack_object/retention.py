@@ -0,0 +1,132 @@
+"""
+Retention of the timestamped snapshots of an entity.
+
+Timestamped snapshots are saved in a subfolder per day, so no folder grows
+without limit. Each entity keeps an index of its snapshots, oldest first,
+loaded once from the save folder and then updated as snapshots are written,
+so pruning by count, age and total size never lists the folder again.
+Snapshots are only deleted on the writer thread, after each save and
+periodically for the age limit, so a day folder is never removed while a
+snapshot is written to it.
+"""
+import collections
+import logging
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Deque, NamedTuple, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+DATE_FOLDER_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+# The timestamp of a snapshot name, see DATETIME_FORMAT
+TIMESTAMP_PATTERN = r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}-\d{6}\.(jpg|png)"
+
+
+class Snapshot(NamedTuple):
+    """A timestamped snapshot on disk."""
+
+    path: Path
+    mtime: float
+    size: int
+
+
+class SnapshotRetention:
+    """Delete the oldest snapshots of an entity beyond the configured limits.
+
+    Any limit can be None. add and prune are called on the writer thread,
+    load can run concurrently in an executor.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        name: str,
+        max_count: Optional[int] = None,
+        max_age: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.folder = folder
+        self.max_count = max_count
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._pattern = re.compile(re.escape(name) + "_" + TIMESTAMP_PATTERN)
+        self._snapshots: Deque[Snapshot] = collections.deque()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.pruned = 0
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def load(self):
+        """Index the snapshots already saved, in the date folders or the folder.
+
+        They are pruned with the next save, or the next periodic prune.
+        """
+        folders = [self.folder] + sorted(
+            path
+            for path in self.folder.iterdir()
+            if path.is_dir() and DATE_FOLDER_PATTERN.fullmatch(path.name)
+        )
+        snapshots = []
+        for folder in folders:
+            for path in folder.iterdir():
+                if self._pattern.fullmatch(path.name):
+                    stat = path.stat()
+                    snapshots.append(Snapshot(path, stat.st_mtime, stat.st_size))
+        snapshots.sort(key=lambda snapshot: snapshot.mtime)
+        with self._lock:
+            # Snapshots added while loading are newer, and may have been listed
+            added = {snapshot.path for snapshot in self._snapshots}
+            snapshots = [
+                snapshot for snapshot in snapshots if snapshot.path not in added
+            ]
+            self._snapshots.extendleft(reversed(snapshots))
+            self.bytes += sum(snapshot.size for snapshot in snapshots)
+
+    def add(self, path: Path):
+        """Index a snapshot just written, and prune."""
+        stat = path.stat()
+        with self._lock:
+            self._snapshots.append(Snapshot(path, stat.st_mtime, stat.st_size))
+            self.bytes += stat.st_size
+        self.prune()
+
+    def prune(self, *args):
+        """Delete the oldest snapshots until all limits are met."""
+        min_mtime = time.time() - self.max_age if self.max_age else None
+        while True:
+            with self._lock:
+                if not self._snapshots:
+                    return
+                oldest = self._snapshots[0]
+                if not self._exceeds_limits(oldest, min_mtime):
+                    return
+                self._snapshots.popleft()
+                self.bytes -= oldest.size
+            self._delete(oldest.path)
+
+    def _exceeds_limits(self, oldest: Snapshot, min_mtime: Optional[float]) -> bool:
+        if self.max_count is not None and len(self._snapshots) > self.max_count:
+            return True
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            return True
+        return min_mtime is not None and oldest.mtime < min_mtime
+
+    def _delete(self, path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            _LOGGER.warning("Deepstack unable to delete snapshot %s: %s", path, exc)
+            return
+        self.pruned += 1
+        _LOGGER.debug("Deepstack deleted snapshot %s", path)
+        if path.parent != self.folder:
+            try:
+                path.parent.rmdir()  # only succeeds once the day folder is empty
+            except OSError:
+                pass
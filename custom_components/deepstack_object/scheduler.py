@@ -0,0 +1,159 @@
+"""
+Platform level scheduler for Deepstack detection requests.
+
+Frames submitted by all entities of a platform are queued here and
+dispatched to the Deepstack client, with at most max_in_flight requests
+outstanding. Deepstack only accepts a single image per request, so rather
+than batching images into one request the scheduler keeps the server busy
+without overloading it during scan storms:
+
+* each entity has at most one frame queued, a newer frame replaces the
+  queued one and keeps its place in the queue,
+* frames that waited longer than max_wait are shed instead of being sent.
+
+The tasks sending requests are kept by the scheduler, and cancelled when
+Home Assistant stops.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+from .client import DeepstackException
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_WAIT = 0  # seconds, 0 to never shed queued frames
+
+
+class DetectionDropped(DeepstackException):
+    """A queued frame was not sent to Deepstack."""
+
+
+class _Request:
+    """A queued frame and the future for its predictions."""
+
+    def __init__(self, image: bytes, kwargs: Dict):
+        self.image = image
+        self.kwargs = kwargs
+        self.queued = time.monotonic()
+        self.sent = False
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class DetectionScheduler:
+    """Dispatch queued frames to a Deepstack client."""
+
+    def __init__(self, client, max_in_flight: int, max_wait: float = DEFAULT_MAX_WAIT):
+        self._client = client
+        self._max_in_flight = max_in_flight
+        self._max_wait = max_wait
+        self._queue: "OrderedDict[str, _Request]" = OrderedDict()
+        self._in_flight = 0
+        self._tasks: Dict[asyncio.Task, _Request] = {}
+        self._stopped = False
+        self.stats = {"dispatched": 0, "superseded": 0, "expired": 0}
+
+    @property
+    def client(self):
+        """Return the client requests are dispatched to."""
+        return self._client
+
+    @property
+    def queue_depth(self) -> int:
+        """Return the number of frames waiting to be dispatched."""
+        return len(self._queue)
+
+    async def async_detect(self, key: str, image: bytes, **kwargs) -> List[Dict]:
+        """Queue image for key and return its predictions.
+
+        Raises DetectionDropped if the frame is superseded by a newer frame
+        from the same key, or expires in the queue. A frame whose caller is
+        cancelled is removed from the queue.
+        """
+        if self._stopped:
+            raise DetectionDropped(f"Frame from {key} dropped, stopping")
+        request = _Request(image, kwargs)
+        previous = self._queue.get(key)
+        if previous is not None and not previous.future.done():
+            self.stats["superseded"] += 1
+            previous.future.set_exception(
+                DetectionDropped(f"Frame from {key} superseded by a newer frame")
+            )
+        self._queue[key] = request
+        self._dispatch()
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if self._queue.get(key) is request:
+                del self._queue[key]
+            raise
+
+    def _dispatch(self):
+        """Start queued requests while there is capacity."""
+        while self._queue and self._in_flight < self._max_in_flight:
+            key, request = self._queue.popitem(last=False)
+            if request.future.done():  # the caller was cancelled
+                continue
+            waited = time.monotonic() - request.queued
+            if self._max_wait and waited > self._max_wait:
+                self.stats["expired"] += 1
+                request.future.set_exception(
+                    DetectionDropped(
+                        f"Frame from {key} expired after waiting {waited:.2f} seconds"
+                    )
+                )
+                continue
+            self._in_flight += 1
+            self.stats["dispatched"] += 1
+            task = asyncio.create_task(self._async_send(request))
+            self._tasks[task] = request
+            task.add_done_callback(self._tasks.pop)
+
+    async def async_stop(self, *args):
+        """Drop the queued frames, and cancel the requests in flight."""
+        self._stopped = True
+        for key, request in self._queue.items():
+            if not request.future.done():
+                request.future.set_exception(
+                    DetectionDropped(f"Frame from {key} dropped, stopping")
+                )
+        self._queue.clear()
+        tasks = dict(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # A task cancelled before it started never ran _async_send
+        for request in tasks.values():
+            if request.sent:
+                continue
+            self._in_flight -= 1
+            if not request.future.done():
+                request.future.set_exception(
+                    DetectionDropped("Request cancelled, stopping")
+                )
+
+    async def _async_send(self, request: _Request):
+        """Send one request and resolve its future."""
+        request.sent = True
+        try:
+            predictions = await self._client.async_detect(
+                request.image, **request.kwargs
+            )
+        except asyncio.CancelledError:
+            if not request.future.done():
+                request.future.set_exception(
+                    DetectionDropped("Request cancelled, stopping")
+                )
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            if not request.future.done():
+                request.future.set_exception(exc)
+        else:
+            if not request.future.done():
+                request.future.set_result(predictions)
+        finally:
+            self._in_flight -= 1
+            if not self._stopped:
+                self._dispatch()
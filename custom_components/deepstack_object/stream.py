@@ -0,0 +1,249 @@
+"""
+Continuous detection on the frames of an MJPEG stream.
+
+Instead of requesting a snapshot from the camera on every scan, frames are
+read from an MJPEG stream over HTTP, or from a local file or pipe, for
+example one written by ffmpeg from an RTSP camera. Frames are sampled at a
+target rate: while a frame is being processed only the newest frame
+received is kept, older ones are dropped, so detection never falls behind
+the stream. Frames of a regular file are all processed, at the target rate,
+so a recording can be replayed.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, List
+
+import aiohttp
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_STREAM_FPS = 1.0
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RETRY_DELAY = 10  # seconds before reconnecting a live stream
+READ_TIMEOUT = 30  # seconds without data before a live stream is reconnected
+
+SOI = b"\xff\xd8"  # JPEG start of image
+EOI = b"\xff\xd9"  # JPEG end of image
+DELIMITER = b"--"  # Starts the boundary line of a multipart part
+HEADERS_END = b"\r\n\r\n"
+CONTENT_LENGTH = b"content-length"
+
+
+class MjpegParser:
+    """Split a byte stream into JPEG frames.
+
+    Multipart MJPEG is split on its parts, whatever its boundary. A frame is
+    the Content-Length bytes after the part headers, or without one runs up
+    to the next boundary, so a frame with an embedded EXIF thumbnail, which
+    has its own start and end of image markers, is kept whole. Concatenated
+    JPEG files, without part headers, are split on the start and end of
+    image markers.
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._searched = 0  # bytes of the frame already searched for its end
+        self._max_frame_size = max_frame_size
+        self._boundary = DELIMITER  # The boundary line, once a part is seen
+        self._in_frame = False
+        self._in_part = False
+        self._length = None  # The Content-Length of the part, if any
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Add data from the stream, returning the frames it completes."""
+        self._buffer += data
+        frames = []
+        while True:
+            if not self._in_frame and not self._find_frame():
+                return frames
+            end = self._find_part_end() if self._in_part else self._find_jpeg_end()
+            if end < 0:
+                if len(self._buffer) > self._max_frame_size:
+                    _LOGGER.warning("Deepstack stream frame too large, skipped")
+                    self._buffer.clear()
+                    self._in_frame = False
+                return frames
+            frames.append(bytes(self._buffer[:end]))
+            del self._buffer[:end]
+            self._in_frame = False
+
+    def flush(self) -> List[bytes]:
+        """Return the frame of a part ended by the end of the stream, if any."""
+        frames = []
+        if self._in_frame and self._in_part and self._length is None:
+            frame = bytes(self._buffer)
+            frames.append(frame[:-2] if frame.endswith(b"\r\n") else frame)
+        self._buffer.clear()
+        self._in_frame = False
+        return frames
+
+    def _find_frame(self) -> bool:
+        """Drop the bytes before the next part or JPEG, True if one starts."""
+        start = self._buffer.find(SOI)
+        delimiter = self._buffer.find(self._boundary)
+        if delimiter >= 0 and (start < 0 or delimiter < start):
+            headers_end = self._buffer.find(HEADERS_END, delimiter)
+            if headers_end < 0:
+                del self._buffer[:delimiter]
+                return False
+            lines = bytes(self._buffer[delimiter:headers_end]).split(b"\r\n")
+            self._boundary = lines[0].strip()
+            self._length = None
+            for line in lines[1:]:
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == CONTENT_LENGTH and value.strip().isdigit():
+                    self._length = int(value)
+            del self._buffer[: headers_end + len(HEADERS_END)]
+            self._in_part = True
+        elif start >= 0:
+            del self._buffer[:start]
+            self._in_part = False
+        else:
+            # Keep a trailing byte, it may start the next marker or boundary
+            del self._buffer[: max(0, len(self._buffer) - 1)]
+            return False
+        self._in_frame = True
+        self._searched = 0
+        return True
+
+    def _find_part_end(self) -> int:
+        """Return the end of the frame of the part, or -1 if it is incomplete."""
+        if self._length is not None:
+            return self._length if len(self._buffer) >= self._length else -1
+        boundary = b"\r\n" + self._boundary
+        end = self._buffer.find(boundary, max(0, self._searched - len(boundary) + 1))
+        if end < 0:
+            self._searched = len(self._buffer)
+        return end
+
+    def _find_jpeg_end(self) -> int:
+        """Return the end of the JPEG, or -1 if it is incomplete."""
+        end = self._buffer.find(EOI, max(len(SOI), self._searched - 1))
+        if end < 0:
+            self._searched = len(self._buffer)
+            return -1
+        return end + len(EOI)
+
+
+def is_live_source(source: str) -> bool:
+    """Return False for a regular file, which is replayed rather than sampled."""
+    return not os.path.isfile(source)
+
+
+async def async_read_source(hass, source: str) -> AsyncIterator[bytes]:
+    """Yield the bytes of an MJPEG url, or of a file or pipe."""
+    if source.startswith(("http://", "https://")):
+        session = async_get_clientsession(hass)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)
+        async with session.get(source, timeout=timeout) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+        return
+
+    stream = await hass.async_add_executor_job(open, source, "rb")
+    try:
+        while True:
+            chunk = await hass.async_add_executor_job(stream.read, CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        await hass.async_add_executor_job(stream.close)
+
+
+class FrameStream:
+    """Feed the newest frame of a stream to a callback, at most fps times a second.
+
+    A live stream drops frames received while a frame is processed, and is
+    reconnected when it ends or fails. A stream that is not live waits for
+    each frame to be processed, and ends with its source.
+    """
+
+    def __init__(
+        self,
+        open_source: Callable[[], AsyncIterator[bytes]],
+        fps: float = DEFAULT_STREAM_FPS,
+        live: bool = True,
+        retry_delay: float = RETRY_DELAY,
+    ):
+        self._open_source = open_source
+        self._interval = 1 / fps
+        self._live = live
+        self._retry_delay = retry_delay
+        self._frame = None
+        self._ended = False
+        self._frame_ready = None
+        self._frame_taken = None
+        self.stats = {"received": 0, "dropped": 0, "processed": 0}
+
+    async def async_run(self, process: Callable[[bytes], Awaitable[None]]):
+        """Process frames until the stream ends, or the task is cancelled."""
+        self._frame_ready = asyncio.Event()
+        self._frame_taken = asyncio.Event()
+        self._frame_taken.set()
+        reader = asyncio.create_task(self._async_read())
+        try:
+            next_frame = time.monotonic()
+            while True:
+                await self._frame_ready.wait()
+                if self._frame is None:  # the stream ended
+                    return
+                frame, self._frame = self._frame, None
+                if not self._ended:
+                    self._frame_ready.clear()
+                self._frame_taken.set()
+                try:
+                    await process(frame)
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.exception("Deepstack error processing stream frame")
+                self.stats["processed"] += 1
+
+                next_frame += self._interval
+                delay = next_frame - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:  # processing is slower than the target rate
+                    next_frame = time.monotonic()
+        finally:
+            reader.cancel()
+
+    async def _async_read(self):
+        """Read frames into the newest frame slot."""
+        try:
+            while True:
+                parser = MjpegParser()
+                try:
+                    async with contextlib.aclosing(self._open_source()) as chunks:
+                        async for chunk in chunks:
+                            for frame in parser.feed(chunk):
+                                await self._put(frame)
+                    for frame in parser.flush():
+                        await self._put(frame)
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as exc:
+                    _LOGGER.warning("Deepstack stream error : %s", exc)
+                if not self._live:
+                    return
+                _LOGGER.debug(
+                    "Deepstack stream ended, reconnecting in %s seconds",
+                    self._retry_delay,
+                )
+                await asyncio.sleep(self._retry_delay)
+        finally:
+            self._ended = True
+            self._frame_ready.set()
+
+    async def _put(self, frame: bytes):
+        self.stats["received"] += 1
+        if not self._live:
+            await self._frame_taken.wait()
+            self._frame_taken.clear()
+        elif self._frame is not None:
+            self.stats["dropped"] += 1
+        self._frame = frame
+        self._frame_ready.set()
@@ -1,5 +1,63 @@
 """The tests for the Deepstack object component."""
-from .image_processing import get_objects
+import asyncio
+import functools
+import os
+from types import SimpleNamespace
+
+import aiohttp
+import numpy as np
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image, ImageDraw
+
+from .client import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
+    CircuitBreaker,
+    DeepstackClient,
+    DeepstackException,
+    RequestRejected,
+    ServerUnavailable,
+)
+from .batch import BatchOutput, async_run_batch, list_images
+from .cache import DetectionCache, get_cache_key
+from .history import HistoryStore, get_rows
+from .image_processing import (
+    get_hash_difference,
+    get_image_hash,
+    get_object_arrays,
+    get_object_dicts,
+    get_objects,
+    get_objects_in_roi,
+    get_target_matcher,
+    get_target_thresholds,
+    merge_tile_predictions,
+    points_in_polygon,
+    round_array,
+    MIN_CONFIDENCE,
+    ObjectClassifyEntity,
+    ScanFrame,
+    TargetMatcher,
+    Zone,
+)
+from .instrumentation import StageTimings, percentile
+from .pipeline import (
+    FrameOptions,
+    crop_and_scale,
+    decode_image,
+    encode_jpeg,
+    get_tiles,
+    prepare_frame,
+)
+from .pool import DeepstackPool, PoolServer
+from .retention import SnapshotRetention
+from .scheduler import DetectionDropped, DetectionScheduler
+from .stream import FrameStream, MjpegParser, async_read_source, is_live_source
+from .tracker import ObjectTracker
+from .workers import ImageWorkers, SnapshotOptions
+from .writer import SnapshotWriter, write_image
 
 TARGET = "person"
 IMG_WIDTH = 960
@@ -45,6 +103,7 @@ PARSED_PREDICTIONS = [
         "box_area": 0.109,
         "centroid": {"x": 0.389, "y": 0.483},
         "name": "person",
+        "object_type": "person",
         "confidence": 99.954,
     },
     {
@@ -59,6 +118,7 @@ PARSED_PREDICTIONS = [
         "box_area": 0.118,
         "centroid": {"x": 0.545, "y": 0.493},
         "name": "person",
+        "object_type": "person",
         "confidence": 99.949,
     },
     {
@@ -73,6 +133,7 @@ PARSED_PREDICTIONS = [
         "box_area": 0.044,
         "centroid": {"x": 0.752, "y": 0.701},
         "name": "dog",
+        "object_type": "animal",
         "confidence": 99.904,
     },
 ]
@@ -82,3 +143,990 @@ def test_get_objects():
     objects = get_objects(MOCK_PREDICTIONS, IMG_WIDTH, IMG_HEIGHT)
     assert len(objects) == 3
     assert objects[0] == PARSED_PREDICTIONS[0]
+    assert objects == PARSED_PREDICTIONS
+
+
+def test_round_array_matches_round():
+    values = np.array([0.0125, 0.0135, 2.675, 0.3335, 1 / 3, 0.0])
+    assert round_array(values).tolist() == [round(value, 3) for value in values.tolist()]
+
+
+def test_target_matcher_precedence():
+    matcher = TargetMatcher(
+        [
+            {"target": "vehicle", "confidence": 60.0},
+            {"target": "car", "confidence": 40.0},
+            {"target": "other", "confidence": 90.0},
+            {"target": "animal", "confidence": 70.0},
+        ]
+    )
+    assert matcher.get_threshold("car") == 40.0
+    assert matcher.get_threshold("truck") == 60.0
+    assert matcher.get_threshold("dog") == 70.0
+    assert matcher.get_threshold("mask") == 90.0  # a custom model label
+    assert np.isnan(TargetMatcher([]).get_threshold("person"))
+
+
+def test_target_matcher_shared():
+    targets = [{"target": "person", "confidence": 60.0}]
+    matcher = get_target_matcher(targets)
+    assert get_target_matcher([dict(targets[0])]) is matcher
+    assert get_target_matcher([{"target": "person", "confidence": 70.0}]) is not (
+        matcher
+    )
+    zone_config = {"name": "all", "y_min": 0, "x_min": 0, "y_max": 1, "x_max": 1}
+    zone = Zone.from_config(zone_config, targets, 80.0)
+    assert zone.target_matcher is matcher
+
+
+def test_target_filtering():
+    targets = [
+        {"target": "animal", "confidence": 99.95},
+        {"target": "person", "confidence": 99.95},
+        {"target": "dog", "confidence": 60.0},
+    ]
+    objects = get_object_arrays(MOCK_PREDICTIONS, IMG_WIDTH, IMG_HEIGHT)
+    thresholds = get_target_thresholds(objects, TargetMatcher(targets))
+    assert thresholds.tolist() == [99.95, 99.95, 60.0]
+
+    found = objects.confidences > thresholds
+    assert get_object_dicts(objects, np.flatnonzero(found)) == [
+        PARSED_PREDICTIONS[0],
+        PARSED_PREDICTIONS[2],
+    ]
+    roi = {"y_min": 0.0, "x_min": 0.0, "y_max": 1.0, "x_max": 0.5}
+    assert get_objects_in_roi(objects, roi).tolist() == [True, False, False]
+
+
+def test_points_in_polygon():
+    # An L shaped zone, the top right quarter is outside
+    polygon = np.array([(0, 0), (0.5, 0), (0.5, 0.5), (1, 0.5), (1, 1), (0, 1)])
+    points = np.array([(0.25, 0.25), (0.75, 0.25), (0.75, 0.75), (0.25, 0.75), (1.5, 0.5)])
+    assert points_in_polygon(points, polygon).tolist() == [True, False, True, True, False]
+    assert points_in_polygon(np.empty((0, 2)), polygon).shape == (0,)
+
+
+def test_zone_targets_found():
+    objects = get_object_arrays(MOCK_PREDICTIONS, IMG_WIDTH, IMG_HEIGHT)
+    config = {
+        "name": "left",
+        "y_min": 0.0,
+        "x_min": 0.0,
+        "y_max": 1.0,
+        "x_max": 0.5,
+        "targets": [{"target": "person"}, {"target": "dog"}],
+    }
+    zone = Zone.from_config(config, [], confidence=80)
+    found = zone.get_targets_found(objects, objects.centroids)
+    assert [objects.names[index] for index in np.flatnonzero(found)] == ["person"]
+
+
+def test_object_tracker():
+    tracker = ObjectTracker(iou_threshold=0.3, max_age=1)
+    car = np.array([[0.5, 0.1, 0.7, 0.3]])
+    person = np.array([[0.1, 0.6, 0.5, 0.7]])
+
+    updates, expired = tracker.update(["car", "person"], np.vstack([car, person]), [])
+    assert [(update.track_id, update.new) for update in updates] == [(1, True), (2, True)]
+
+    # The person moves into a zone, the car stays put
+    updates, expired = tracker.update(
+        ["person", "car"], np.vstack([person + 0.02, car]), [["porch"], []]
+    )
+    assert [update.track_id for update in updates] == [2, 1]
+    assert not any(update.new for update in updates)
+    assert updates[0].entered == ["porch"]
+
+    # A car elsewhere is a new track, the others expire after max_age scans
+    updates, expired = tracker.update(["car"], car + 0.3, [])
+    assert updates[0].new and not expired
+    updates, expired = tracker.update(["car"], car + 0.3, [])
+    assert [track.track_id for track in expired] == [1, 2]
+
+
+def test_image_hash_difference():
+    image = Image.new("RGB", (IMG_WIDTH, IMG_HEIGHT), (40, 40, 40))
+    ImageDraw.Draw(image).rectangle((100, 100, 400, 500), fill=(200, 200, 200))
+    changed = image.copy()
+    ImageDraw.Draw(changed).rectangle((500, 50, 900, 600), fill=(250, 10, 10))
+
+    image_hash = get_image_hash(image)
+    assert get_hash_difference(image_hash, get_image_hash(image.copy())) == 0
+    assert get_hash_difference(image_hash, get_image_hash(changed)) > 0.1
+    # Changes outside the box are ignored
+    box = (0, 0, 450, IMG_HEIGHT)
+    assert get_image_hash(image, box) == get_image_hash(changed, box)
+
+
+def test_pipeline_crop_and_scale():
+    image = encode_jpeg(Image.new("RGB", (1920, 1080), (40, 40, 40)))
+    img, full_size = decode_image(image, scale=0.5)
+    assert full_size == (1920, 1080)
+    assert img.size == (960, 540)  # decoded in draft mode
+    roi = (0.0, 0.2, 1.0, 0.8)
+    assert crop_and_scale(img, full_size, roi, 0.5).size == (576, 540)
+
+    img, full_size = decode_image(image)
+    assert crop_and_scale(img, full_size, roi).size == (1152, 1080)
+    assert crop_and_scale(img, full_size) is img
+
+
+def test_get_tiles_cover_image():
+    tiles = get_tiles(1920, 1080, 640, 0.2)
+    assert {tile[2] - tile[0] for tile in tiles} == {640}
+    assert max(tile[2] for tile in tiles) == 1920
+    assert max(tile[3] for tile in tiles) == 1080
+    lefts = sorted({tile[0] for tile in tiles})
+    assert all(b - a <= 640 * 0.8 for a, b in zip(lefts, lefts[1:]))
+    assert get_tiles(500, 400, 640, 0.2) == [(0, 0, 500, 400)]
+
+
+def test_merge_tile_predictions():
+    person = {"label": "person", "y_min": 10, "x_min": 500, "y_max": 200, "x_max": 600}
+    tile_predictions = [
+        ((0, 0), [dict(person, confidence=0.8)]),
+        # The same person seen by the next tile, offset by 400 pixels
+        ((400, 0), [dict(person, confidence=0.9, x_min=105, x_max=205)]),
+        ((400, 0), [dict(person, label="dog", confidence=0.7, x_min=105, x_max=205)]),
+    ]
+    merged = merge_tile_predictions(tile_predictions)
+    assert [(pred["label"], pred["confidence"]) for pred in merged] == [
+        ("person", 0.9),
+        ("dog", 0.7),
+    ]
+    assert merged[0]["x_min"] == 505
+    assert merge_tile_predictions([((0, 0), [])]) == []
+
+
+def test_write_image_links_timestamped_file(tmp_path):
+    latest = tmp_path / "camera_latest.jpg"
+    timestamped = tmp_path / "camera_2021-01-01_00-00-00-000000.jpg"
+    write_image(Image.new("RGB", (64, 48)), latest, "jpg", [timestamped])
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        timestamped.name,
+        latest.name,
+    ]
+    assert latest.stat().st_ino == timestamped.stat().st_ino
+    assert Image.open(latest).size == (64, 48)
+
+
+def test_history_store_query(tmp_path):
+    history = HistoryStore(str(tmp_path / "history.db"))
+    history.start()
+    targets = get_objects(MOCK_PREDICTIONS, IMG_WIDTH, IMG_HEIGHT)
+    history.record(get_rows("image_processing.front", 100.0, targets[:2]))
+    history.record(
+        get_rows("image_processing.back", 200.0, targets, [["drive"]] * len(targets))
+    )
+    history.stop()
+
+    assert history.stats == {"written": 5, "dropped": 0}
+    people = history.query(entity_ids=["image_processing.front"], labels=["person"])
+    assert [row["timestamp"] for row in people] == [100.0, 100.0]
+    assert sorted(row["x_min"] for row in people) == [
+        target["bounding_box"]["x_min"] for target in targets[:2]
+    ]
+    recent = history.query(start=150.0, zone="drive", limit=2)
+    assert len(recent) == 2
+    assert {row["entity_id"] for row in recent} == {"image_processing.back"}
+    assert history.query(end=100.0) == []
+
+
+def test_snapshot_retention(tmp_path):
+    def save(folder, timestamp, size=100):
+        path = tmp_path / folder / f"camera_{timestamp}-000000.jpg"
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(bytes(size))
+        return path
+
+    old = save("2020-01-01", "2020-01-01_10-00-00")
+    os.utime(old, (0, 0))
+    save(".", "2020-01-02_10-00-00")
+    other = tmp_path / "2020-01-01" / "camera_2_2020-01-01_10-00-00-000000.jpg"
+    other.write_bytes(b"")
+    retention = SnapshotRetention(tmp_path, "camera", max_count=3, max_bytes=250)
+    retention.load()
+    assert len(retention) == 2 and retention.bytes == 200
+
+    retention.max_age = 3600
+    retention.add(save("2020-01-03", "2020-01-03_10-00-00"))
+    # The old snapshot is over the age limit, its day folder is kept for other
+    assert not old.exists() and other.exists()
+    retention.add(save("2020-01-03", "2020-01-03_11-00-00"))
+    assert len(retention) == 2 and retention.bytes == 200
+    assert retention.pruned == 2
+    assert sorted(path.name for path in tmp_path.glob("2020-01-03/*")) == [
+        "camera_2020-01-03_10-00-00-000000.jpg",
+        "camera_2020-01-03_11-00-00-000000.jpg",
+    ]
+
+
+def test_snapshot_retention_requires_save_folder(tmp_path):
+    options = dict(save_timestamped_file=True, max_saved_files=5)
+    assert make_entity(MockScheduler([]), **options)._retention is None
+    entity = make_entity(MockScheduler([]), save_file_folder=tmp_path, **options)
+    assert entity._retention.folder == tmp_path
+
+
+def test_stage_timings_summary():
+    assert percentile([5, 1, 4, 2, 3], 50) == 3
+    assert percentile(list(range(1, 101)), 95) == 95
+
+    timings = StageTimings(window=3)
+    for milliseconds in (100.0, 1.0, 2.0, 3.0):  # the first falls out of the window
+        timings.record("detect", milliseconds)
+    timings.record("save", 5.0, in_scan=False)
+    assert timings.summary()["detect"] == {"p50": 2.0, "p95": 3.0, "max": 3.0}
+    assert timings.last_scan == {"detect": 3.0}
+
+
+def test_stage_timings_copies():
+    timings = StageTimings()
+    for nbytes in ((1000, 200), (), (500,)):
+        timings.start_scan()
+        for value in nbytes:
+            timings.record_copy(value)
+        timings.end_scan()
+    assert timings.last_scan_copies == {"allocations": 1, "bytes_copied": 500}
+    summary = timings.copy_summary()
+    assert summary["allocations"] == {"p50": 1, "p95": 2, "max": 2}
+    assert summary["bytes_copied"]["max"] == 1200
+
+
+class MockClient:
+    """Return MOCK_PREDICTIONS after a short delay, recording the images sent."""
+
+    def __init__(self):
+        self.images = []
+
+    async def async_detect(self, image, **kwargs):
+        self.images.append(image)
+        await asyncio.sleep(0.01)
+        return MOCK_PREDICTIONS
+
+
+def test_scheduler_supersedes_queued_frame():
+    async def run():
+        client = MockClient()
+        scheduler = DetectionScheduler(client, max_in_flight=1)
+        first = asyncio.create_task(scheduler.async_detect("camera_a", b"1"))
+        queued = asyncio.create_task(scheduler.async_detect("camera_b", b"2"))
+        newest = asyncio.create_task(scheduler.async_detect("camera_b", b"3"))
+        assert await first == MOCK_PREDICTIONS
+        assert await newest == MOCK_PREDICTIONS
+        with pytest.raises(DetectionDropped):
+            await queued
+        return client.images
+
+    assert asyncio.run(run()) == [b"1", b"3"]
+
+
+def test_scheduler_cancelled_caller():
+    async def run():
+        client = MockClient()
+        scheduler = DetectionScheduler(client, max_in_flight=1)
+        first = asyncio.create_task(scheduler.async_detect("camera_a", b"1"))
+        cancelled = asyncio.create_task(scheduler.async_detect("camera_b", b"2"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 0
+        # Queued again after a cancelled scan, and while one is still queued
+        queued = asyncio.create_task(scheduler.async_detect("camera_b", b"3"))
+        await asyncio.sleep(0)
+        queued.cancel()  # Its future is done before its task handles it
+        assert await scheduler.async_detect("camera_b", b"4") == MOCK_PREDICTIONS
+        assert await first == MOCK_PREDICTIONS
+        return client.images, scheduler.stats["superseded"]
+
+    assert asyncio.run(run()) == ([b"1", b"4"], 0)
+
+
+def test_scheduler_stop_cancels_requests():
+    async def run():
+        scheduler = DetectionScheduler(MockClient(), max_in_flight=1)
+        sent = asyncio.create_task(scheduler.async_detect("camera_a", b"1"))
+        queued = asyncio.create_task(scheduler.async_detect("camera_b", b"2"))
+        await asyncio.sleep(0)
+        assert len(scheduler._tasks) == 1  # Held until the request is done
+        await scheduler.async_stop()
+        for task in (sent, queued):
+            with pytest.raises(DetectionDropped):
+                await task
+        with pytest.raises(DetectionDropped):
+            await scheduler.async_detect("camera_a", b"3")
+        return scheduler._tasks, scheduler._in_flight, scheduler.queue_depth
+
+    assert asyncio.run(run()) == ({}, 0, 0)
+
+
+def mjpeg_part(frame: bytes) -> bytes:
+    header = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+    return header + frame + b"\r\n"
+
+
+def test_mjpeg_parser_splits_frames():
+    frames = [b"\xff\xd8frame%d\xff\xd9" % index for index in range(3)]
+    stream = b"".join(mjpeg_part(frame) for frame in frames)
+    parser = MjpegParser()
+    # Feed in chunks that split the markers
+    parsed = []
+    for start in range(0, len(stream), 7):
+        parsed.extend(parser.feed(stream[start : start + 7]))
+    # Without a Content-Length the last frame ends with the stream
+    assert parsed + parser.flush() == frames
+
+
+def test_mjpeg_parser_keeps_frames_with_thumbnail():
+    thumbnail = b"\xff\xd8thumbnail\xff\xd9"
+    frames = [
+        b"\xff\xd8\xff\xe1" + thumbnail + b"frame%d\xff\xd9" % index
+        for index in range(3)
+    ]
+    parts = [
+        b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+        % len(frame)
+        + frame
+        + b"\r\n"
+        for frame in frames
+    ]
+    for stream in (b"".join(parts), b"".join(mjpeg_part(frame) for frame in frames)):
+        parser = MjpegParser()
+        parsed = []
+        for start in range(0, len(stream), 7):
+            parsed.extend(parser.feed(stream[start : start + 7]))
+        assert parsed + parser.flush() == frames
+
+
+def test_frame_stream_drops_stale_frames():
+    frames = [b"\xff\xd8%d\xff\xd9" % index for index in range(20)]
+
+    async def open_source():
+        for frame in frames:
+            yield mjpeg_part(frame)
+            await asyncio.sleep(0.005)
+
+    async def run(live):
+        processed = []
+
+        async def process(frame):
+            processed.append(frame)
+            await asyncio.sleep(0.02)
+
+        stream = FrameStream(open_source, fps=1000, live=live, retry_delay=10)
+        if live:  # reconnects until cancelled
+            task = asyncio.create_task(stream.async_run(process))
+            await asyncio.sleep(0.3)
+            task.cancel()
+        else:
+            await stream.async_run(process)
+        return processed, stream.stats
+
+    processed, stats = asyncio.run(run(live=True))
+    assert processed[0] == frames[0]
+    assert stats["dropped"] > 0
+    assert len(processed) < stats["received"]
+
+    # A recording is replayed without dropping frames
+    processed, stats = asyncio.run(run(live=False))
+    assert processed == frames
+    assert stats["dropped"] == 0
+
+
+def test_detection_cache_lru_and_ttl():
+    cache = DetectionCache(max_entries=2, ttl=60)
+    key_a = get_cache_key(b"a", "", None, 1.0)
+    key_b = get_cache_key(b"b", "", None, 1.0)
+    key_c = get_cache_key(b"c", "", None, 1.0)
+    assert key_a != get_cache_key(b"a", "mask", None, 1.0)
+
+    cache.put(key_a, MOCK_PREDICTIONS)
+    cache.put(key_b, [])
+    assert cache.get(key_a) == MOCK_PREDICTIONS
+    cache.put(key_c, [])  # evicts key_b, the least recently used
+    assert cache.get(key_b) is None
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 1, "expired": 0}
+
+    cache.ttl = 0
+    assert cache.get(key_a) is None
+    assert cache.stats["expired"] == 1
+
+
+def test_detection_cache_shares_pending_request():
+    async def run():
+        client = MockClient()
+        cache = DetectionCache(max_entries=4, ttl=60)
+        results = await asyncio.gather(
+            *(
+                cache.async_get_or_detect("key", lambda: client.async_detect(b"1"))
+                for _ in range(3)
+            )
+        )
+        assert results == [MOCK_PREDICTIONS] * 3
+        return client.images
+
+    assert asyncio.run(run()) == [b"1"]
+
+
+def test_detection_cache_waiter_detects_if_owner_cancelled():
+    async def run():
+        client = MockClient()
+        cache = DetectionCache(max_entries=4, ttl=60)
+        owner = asyncio.create_task(
+            cache.async_get_or_detect("key", lambda: client.async_detect(b"1"))
+        )
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.create_task(
+                cache.async_get_or_detect("key", lambda: client.async_detect(b"2"))
+            )
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        owner.cancel()
+        assert await asyncio.gather(*waiters) == [MOCK_PREDICTIONS] * 2
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        return client.images
+
+    # The first waiter sends its own request, the other waits for it
+    assert asyncio.run(run()) == [b"1", b"2"]
+
+
+def test_detection_cache_prefilter_only_on_miss():
+    async def run():
+        client = MockClient()
+        cache = DetectionCache(max_entries=4, ttl=60)
+        first_passes = []
+
+        async def prefilter(found):
+            first_passes.append(found)
+            return found
+
+        detect = lambda: client.async_detect(b"1")
+        assert await cache.async_get_or_detect(
+            "key", detect, lambda: prefilter(False)
+        ) == []
+        assert len(cache) == 0  # Specific to the caller, not cached
+        assert await cache.async_get_or_detect(
+            "key", detect, lambda: prefilter(True)
+        ) == MOCK_PREDICTIONS
+        assert await cache.async_get_or_detect(
+            "key", detect, lambda: prefilter(True)
+        ) == MOCK_PREDICTIONS
+        return first_passes, client.images
+
+    assert asyncio.run(run()) == ([False, True], [b"1"])
+
+
+def test_circuit_breaker_backoff():
+    breaker = CircuitBreaker(failure_threshold=2, backoff=0)
+    breaker.record_failure()
+    assert breaker.state == BREAKER_CLOSED
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN
+
+    assert breaker.allow_request()  # the backoff has passed, a probe is let through
+    assert breaker.state == BREAKER_HALF_OPEN
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN
+
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == BREAKER_CLOSED
+    assert breaker.failures == 0
+
+    breaker = CircuitBreaker(failure_threshold=1, backoff=60)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    assert 59 < breaker.retry_in <= 60
+
+
+class StubDeepstack:
+    """A local Deepstack server, answering with status and json after delay.
+
+    If body is set it is answered instead of json.
+    """
+
+    def __init__(self, status=200, json=None, delay=0.0):
+        self.status = status
+        self.json = json or {"success": True, "predictions": MOCK_PREDICTIONS}
+        self.body = None
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await request.read()
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if self.body is not None:
+            return web.Response(body=self.body, status=self.status)
+        return web.json_response(self.json, status=self.status)
+
+
+def run_client(stub, test, **kwargs):
+    """Run test with a DeepstackClient of the stub server, with kwargs set."""
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", stub.handle)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            return await test(
+                DeepstackClient(session, server.host, server.port, **kwargs)
+            )
+
+    return asyncio.run(run())
+
+
+def test_client_breaker_counts_only_server_failures():
+    stub = StubDeepstack(status=404)
+
+    async def test(client):
+        client.breaker = CircuitBreaker(failure_threshold=2, backoff=0)
+        for _ in range(2):  # An unknown custom model
+            with pytest.raises(RequestRejected):
+                await client.async_detect(b"image", custom_model="unknown")
+        assert client.breaker.state == BREAKER_CLOSED
+        stub.status = 503
+        for _ in range(2):
+            with pytest.raises(DeepstackException):
+                await client.async_detect(b"image")
+        assert client.breaker.state == BREAKER_OPEN
+
+        await client.async_check_health()
+        assert client.breaker.state == BREAKER_OPEN
+        stub.status = 404  # The server is up
+        await client.async_check_health()
+        assert client.breaker.state == BREAKER_CLOSED
+
+    run_client(stub, test)
+
+
+def test_client_maps_errors():
+    stub = StubDeepstack()
+
+    async def test(client):
+        client.breaker = CircuitBreaker(failure_threshold=3, backoff=60)
+        assert await client.async_detect(b"image") == MOCK_PREDICTIONS
+        assert client.latency is not None
+
+        predictions, stub.json = stub.json, {"success": False, "error": "Bad image"}
+        with pytest.raises(RequestRejected, match="Bad image"):
+            await client.async_detect(b"image")
+        stub.json = predictions
+
+        stub.body = b"<html>Bad gateway</html>"
+        with pytest.raises(DeepstackException, match="invalid response") as error:
+            await client.async_detect(b"image")
+        assert not isinstance(error.value, RequestRejected)
+        stub.body = None
+
+        stub.status = 500
+        with pytest.raises(DeepstackException, match="status code: 500") as error:
+            await client.async_detect(b"image")
+        assert not isinstance(error.value, RequestRejected)
+
+        stub.status, stub.delay = 200, 1.0
+        with pytest.raises(DeepstackException, match="Timeout"):
+            await client.async_detect(b"image", timeout=0.05)
+
+        unused_port = DeepstackClient(client._session, "127.0.0.1", 1)
+        with pytest.raises(DeepstackException, match="connection error"):
+            await unused_port.async_detect(b"image")
+
+        # The invalid response, the 500 and the timeout opened the breaker
+        with pytest.raises(ServerUnavailable):
+            await client.async_detect(b"image")
+        assert client.breaker.state == BREAKER_OPEN
+        assert client.in_flight == 0
+
+    run_client(stub, test)
+
+
+def test_client_limits_concurrent_requests():
+    stub = StubDeepstack(delay=0.05)
+
+    async def test(client):
+        results = await asyncio.gather(
+            *(client.async_detect(b"image") for _ in range(6))
+        )
+        assert results == [MOCK_PREDICTIONS] * 6
+        assert client.in_flight == 0
+
+    run_client(stub, test, max_concurrent_requests=2)
+    assert stub.max_in_flight == 2
+
+
+class MockServer:
+    """A Deepstack server of a pool, failing with error if it is set."""
+
+    def __init__(self, name, latency, error=None):
+        self.server = name
+        self.latency = latency
+        self.in_flight = 0
+        self.max_concurrent_requests = 1
+        self.available = True
+        self.error = error
+        self.requests = 0
+
+    async def async_detect(self, image, **kwargs):
+        self.requests += 1
+        if self.error:
+            raise self.error
+        return [{"server": self.server}]
+
+
+def test_pool_routing_and_failover():
+    fast, slow = MockServer("fast", 0.1), MockServer("slow", 0.5)
+    mask = MockServer("mask", 1.0)
+    pool = DeepstackPool(
+        [
+            PoolServer(fast, ["other"]),
+            PoolServer(slow, None),
+            PoolServer(mask, ["mask"]),
+        ]
+    )
+
+    assert asyncio.run(pool.async_detect(b"1")) == [{"server": "fast"}]
+    fast.in_flight = 10  # busy, the slow server is expected to answer sooner
+    assert asyncio.run(pool.async_detect(b"1")) == [{"server": "slow"}]
+    # Only the servers hosting the custom model are used
+    assert asyncio.run(pool.async_detect(b"1", custom_model="mask")) == [
+        {"server": "slow"}
+    ]
+    slow.error = DeepstackException("timeout")
+    assert asyncio.run(pool.async_detect(b"1", custom_model="mask")) == [
+        {"server": "mask"}
+    ]
+    # A rejected request is not retried on other servers
+    slow.error = RequestRejected("bad image")
+    with pytest.raises(RequestRejected):
+        asyncio.run(pool.async_detect(b"1", custom_model="mask"))
+    assert mask.requests == 1
+    with pytest.raises(DeepstackException):
+        asyncio.run(pool.async_detect(b"1", custom_model="unknown"))
+
+
+class MockScheduler:
+    """Answer every request with predictions, recording its options."""
+
+    def __init__(self, predictions):
+        self.client = MockServer("mock", 0.1)
+        self.client.register_entity = lambda: None
+        self.client.status = {}
+        self.predictions = predictions
+        self.requests = []
+
+    async def async_detect(self, key, image, **options):
+        self.requests.append(options)
+        return self.predictions
+
+
+def make_entity(scheduler, **kwargs):
+    """Return an entity for camera.test targeting person, with kwargs set."""
+    options = dict(
+        scheduler=scheduler,
+        api_key="",
+        timeout=10,
+        custom_model="",
+        targets=[{"target": "person"}],
+        confidence=80.0,
+        roi_y_min=0.0,
+        roi_x_min=0.0,
+        roi_y_max=1.0,
+        roi_x_max=1.0,
+        scale=1.0,
+        show_boxes=True,
+        save_file_folder=None,
+        save_file_format="jpg",
+        save_timestamped_file=False,
+        always_save_latest_file=False,
+        crop_roi=False,
+        camera_entity="camera.test",
+    )
+    options.update(kwargs)
+    return ObjectClassifyEntity(**options)
+
+
+def test_scan_finished_when_frame_dropped():
+    class DroppingScheduler(MockScheduler):
+        async def async_detect(self, key, image, **options):
+            raise DetectionDropped("Superseded by a newer frame")
+
+    events = []
+    entity = make_entity(DroppingScheduler([]), timing_events=True)
+    entity.entity_id = "image_processing.test"
+    entity.hass = SimpleNamespace(
+        async_add_executor_job=lambda function, *args: asyncio.sleep(
+            0, function(*args)
+        ),
+        bus=SimpleNamespace(async_fire=lambda *event: events.append(event)),
+    )
+    frame = encode_jpeg(Image.new("RGB", (64, 48)))
+    asyncio.run(entity.async_process_image(frame))
+    assert len(events) == 1
+    assert events[0][1]["result"] == "dropped"
+    assert "detect" in events[0][1] and "total" in events[0][1]
+    assert entity._timings.result_counts() == {"dropped": 1}
+
+
+def test_overlapping_scans_save_their_own_frame(tmp_path):
+    class FirstSlowestScheduler(MockScheduler):
+        async def async_detect(self, key, image, **options):
+            self.requests.append(options)
+            await asyncio.sleep(0.05 if len(self.requests) == 1 else 0)
+            return self.predictions
+
+    jobs = []
+    entity = make_entity(
+        FirstSlowestScheduler(MOCK_PREDICTIONS),
+        scale=0.5,
+        save_file_folder=tmp_path,
+        always_save_latest_file=True,
+        writer=SimpleNamespace(submit=lambda job, policy: jobs.append(job)),
+    )
+    entity.entity_id = "image_processing.test"
+    entity.hass = SimpleNamespace(
+        async_add_executor_job=lambda function, *args: asyncio.sleep(
+            0, function(*args)
+        ),
+        bus=SimpleNamespace(fire=lambda *event: None),
+    )
+    frames = [
+        encode_jpeg(Image.new("RGB", size)) for size in ((640, 480), (320, 240))
+    ]
+
+    async def run():
+        await asyncio.gather(*(entity.async_process_image(frame) for frame in frames))
+
+    asyncio.run(run())
+    # The second scan finishes first, each saves the frame it detected on
+    images = [job.args[0] for job in jobs]
+    assert [image.size for image in images] == [(160, 120), (320, 240)]
+
+
+def test_snapshots_dropped_per_entity(tmp_path):
+    # The writer is not started, so its single slot stays full
+    writer = SnapshotWriter(max_queue=1)
+    hass = SimpleNamespace(
+        async_add_executor_job=lambda function, *args: asyncio.sleep(
+            0, function(*args)
+        ),
+        bus=SimpleNamespace(fire=lambda *event: None),
+    )
+    entities = []
+    for name in ("busy", "idle"):
+        entity = make_entity(
+            MockScheduler(MOCK_PREDICTIONS),
+            save_file_folder=tmp_path,
+            always_save_latest_file=True,
+            writer=writer,
+            name=name,
+        )
+        entity.entity_id = f"image_processing.{name}"
+        entity.hass = hass
+        entities.append(entity)
+    busy, idle = entities
+    frame = encode_jpeg(Image.new("RGB", (64, 48)))
+    for _ in range(3):
+        asyncio.run(busy.async_process_image(frame))
+
+    assert writer.stats["dropped"] == 2
+    assert busy.extra_state_attributes["snapshots_dropped"] == 2
+    assert idle.extra_state_attributes["snapshots_dropped"] == 0
+
+
+def test_stream_replays_recorded_file(tmp_path):
+    frames = [
+        encode_jpeg(Image.new("RGB", (IMG_WIDTH, IMG_HEIGHT), (index, 0, 0)))
+        for index in range(0, 250, 50)
+    ]
+    recording = tmp_path / "recording.mjpeg"
+    recording.write_bytes(b"".join(mjpeg_part(frame) for frame in frames))
+    stub = StubDeepstack()
+
+    async def test(client):
+        loop = asyncio.get_running_loop()
+        hass = SimpleNamespace(
+            async_add_executor_job=lambda function, *args: loop.run_in_executor(
+                None, function, *args
+            ),
+            bus=SimpleNamespace(fire=lambda *event: None),
+        )
+        source = str(recording)
+        stream = FrameStream(
+            functools.partial(async_read_source, hass, source),
+            fps=1000,
+            live=is_live_source(source),
+        )
+        entity = make_entity(DetectionScheduler(client, max_in_flight=1), stream=stream)
+        entity.entity_id = "image_processing.test"
+        entity.hass = hass
+        entity.async_write_ha_state = lambda: None
+        # A recording ends with the file, rather than reconnecting
+        await asyncio.wait_for(
+            stream.async_run(entity.async_process_stream_frame), timeout=10
+        )
+        return entity, stream.stats
+
+    entity, stats = run_client(stub, test)
+    assert stats == {"received": 5, "dropped": 0, "processed": 5}
+    assert stub.requests == 5
+    assert entity._state == 2  # The two people of MOCK_PREDICTIONS
+
+
+def test_prefilter_finds_candidates_near_threshold():
+    # A person at 60% in a 320x240 first pass frame, around (0.4, 0.4)
+    prediction = {"label": "person", "y_min": 60, "x_min": 80, "y_max": 130}
+    prediction.update(x_max=176, confidence=0.6)
+    scheduler = MockScheduler([prediction])
+    entity = make_entity(scheduler, prefilter_scale=0.25, prefilter_margin=0.7)
+    scan = ScanFrame(b"full frame", b"frame", None, 1280, 960)
+    scan = scan._replace(prefilter_body=b"small", prefilter_size=(320, 240))
+
+    # 60% is within 0.7 times the 80% confidence of the target
+    assert asyncio.run(entity.async_prefilter(scan))
+    assert scheduler.requests[0]["min_confidence"] == pytest.approx(0.56)
+    entity._roi_dict["x_min"] = 0.5
+    assert not asyncio.run(entity.async_prefilter(scan))
+    assert entity._prefilter_stats == {
+        "first_stage": 2,
+        "second_stage": 1,
+        "bytes_sent": 20,
+        "bytes_saved": 0,
+    }
+
+    for prefilter_scale in (0, 0.25):
+        entity = make_entity(scheduler, targets=[], prefilter_scale=prefilter_scale)
+        assert entity._prefilter_confidence == MIN_CONFIDENCE
+
+
+def test_result_attributes_cached_and_limited():
+    entity = make_entity(MockScheduler([]), all_objects_limit=2)
+    events = []
+    entity.hass = SimpleNamespace(
+        bus=SimpleNamespace(fire=lambda *event: events.append(event))
+    )
+    entity.entity_id = "image_processing.test"
+    scan = ScanFrame(b"", b"", None, IMG_WIDTH, IMG_HEIGHT)
+    entity.process_predictions(MOCK_PREDICTIONS, scan)
+    attributes = entity.extra_state_attributes
+    assert attributes["all_objects"] == [{"person": 99.954}, {"person": 99.949}]
+    assert attributes["all_objects_count"] == 3
+    # Built once per scan, the counters are read on every state write
+    assert entity.extra_state_attributes["targets_found"] is (
+        attributes["targets_found"]
+    )
+    assert len(events) == 2
+    entity.process_predictions(MOCK_PREDICTIONS[2:], scan)
+    assert entity.extra_state_attributes["all_objects_count"] == 1
+
+
+def test_prepare_frame_matches_entity():
+    frame = encode_jpeg(Image.effect_noise((1280, 720), 40).convert("RGB"))
+    options = dict(
+        roi_x_min=0.2,
+        roi_x_max=0.8,
+        crop_roi=True,
+        scale=0.5,
+        change_threshold=0.1,
+        prefilter_scale=0.25,
+    )
+    entity = make_entity(MockScheduler([]), **options)
+    frame_options = entity.get_frame_options()
+    scan = entity.prepare_image(frame)
+
+    prepared = prepare_frame(frame, frame_options)
+    assert prepared.body == scan.body
+    assert prepared.size == (scan.width, scan.height) == (384, 360)
+    assert prepared.image_hash == entity._image_hash
+    assert prepared.prefilter_body == scan.prefilter_body
+    assert prepared.prefilter_size == scan.prefilter_size
+    unchanged = prepare_frame(
+        frame, frame_options._replace(last_hash=prepared.image_hash)
+    )
+    assert unchanged.unchanged and unchanged.body is None
+    assert unchanged.change_score == 0
+
+
+def test_image_workers_prepare_and_save(tmp_path):
+    frame = encode_jpeg(Image.new("RGB", (640, 480), (40, 40, 40)))
+    latest = tmp_path / "camera_latest.jpg"
+    timestamped = tmp_path / "2021-01-01" / "camera_2021-01-01_00-00-00-000000.jpg"
+    options = SnapshotOptions((0.0, 0.0, 1.0, 1.0), False, 0.5, True, [], "jpg")
+    targets = get_objects(MOCK_PREDICTIONS, 320, 240)
+    workers = ImageWorkers(1)
+    workers.start()
+    try:
+        prepared = workers.prepare(frame, FrameOptions(roi=None, scale=0.5))
+        assert prepared.size == (320, 240)
+        assert decode_image(prepared.body)[0].size == (320, 240)
+        assert workers.save(frame, options, targets, latest, [timestamped])
+        assert not workers.save(b"not an image", options, targets, latest)
+    finally:
+        workers.stop()
+    assert Image.open(latest).size == (320, 240)
+    assert timestamped.exists()
+    assert workers.stats == {"jobs": 3, "restarts": 0}
+
+
+class MockBatchEntity:
+    """Find a person in the drive zone in each image, failing on some."""
+
+    async def async_detect_frame(self, frame):
+        if frame == b"fail":
+            raise DeepstackException("error")
+        if frame == b"bad":
+            raise OSError(None, "bad")
+        return get_objects(MOCK_PREDICTIONS, IMG_WIDTH, IMG_HEIGHT)[:1], [["drive"]]
+
+
+def test_batch_writes_and_resumes(tmp_path):
+    hass = SimpleNamespace(
+        async_add_executor_job=lambda function, *args: asyncio.sleep(
+            0, function(*args)
+        )
+    )
+    folder = tmp_path / "clips"
+    folder.mkdir()
+    for name, content in (("a.jpg", b"ok"), ("b.jpg", b"fail"), ("c.jpg", b"bad")):
+        (folder / name).write_bytes(content)
+    (folder / "notes.txt").write_text("not an image")
+    images = list_images(str(folder))
+    assert [image.name for image in images] == ["a.jpg", "b.jpg", "c.jpg"]
+    assert list_images(str(tmp_path / "**" / "*.jpg")) == images
+
+    output = BatchOutput(tmp_path / "results.csv")
+    assert output.open() == set()
+    stats = asyncio.run(async_run_batch(hass, MockBatchEntity(), images, output, 2))
+    assert stats == {
+        "images": 3,
+        "done": 2,
+        "failed": 1,
+        "targets_found": 1,
+        "stopped": False,
+    }
+
+    # The failed image is detected again on resume, the others are skipped
+    (folder / "b.jpg").write_bytes(b"ok")
+    output = BatchOutput(tmp_path / "results.csv")
+    done = output.open()
+    assert done == {str(folder / "a.jpg"), str(folder / "c.jpg")}
+    remaining = [image for image in images if str(image) not in done]
+    asyncio.run(async_run_batch(hass, MockBatchEntity(), remaining, output))
+    rows = (tmp_path / "results.csv").read_text().splitlines()
+    assert rows[0].startswith("file,name,confidence")
+    assert [row.split(",")[0] for row in rows[1:]] == [
+        str(folder / name) for name in ("a.jpg", "c.jpg", "b.jpg")
+    ]
+    assert rows[1].endswith("person,99.954,0.148,0.307,0.817,0.47,drive,")
+    assert rows[2].endswith(",bad")
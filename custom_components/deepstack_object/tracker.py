@@ -0,0 +1,119 @@
+"""
+Tracking of detected targets across scans.
+
+A parked car or a person standing still is detected on every scan. The
+tracker matches the targets of a scan to those of previous scans by the
+overlap of their boxes (intersection over union), so each object keeps a
+track id and events are only fired when an object first appears, moves
+between zones, or leaves. Matching is greedy on the highest overlap, as in
+SORT but without a motion model, which suits the seconds between scans.
+"""
+import itertools
+from typing import List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from .geometry import iou_matrix
+
+DEFAULT_TRACK_IOU_THRESHOLD = 0.3
+DEFAULT_TRACK_MAX_AGE = 3  # scans a track is kept without a match
+
+
+class Track:
+    """An object followed across scans."""
+
+    __slots__ = ("track_id", "name", "box", "zones", "misses")
+
+    def __init__(self, track_id: int, name: str, box: np.ndarray, zones: frozenset):
+        self.track_id = track_id
+        self.name = name
+        self.box = box
+        self.zones = zones
+        self.misses = 0
+
+
+class TrackUpdate(NamedTuple):
+    """How the track of a detected object changed in a scan."""
+
+    track_id: int
+    new: bool
+    entered: List[str]  # zones entered, all zones of a new track
+    left: List[str]  # zones left
+
+
+class ObjectTracker:
+    """Assign track ids to the targets found in each scan."""
+
+    def __init__(
+        self,
+        iou_threshold: float = DEFAULT_TRACK_IOU_THRESHOLD,
+        max_age: int = DEFAULT_TRACK_MAX_AGE,
+    ):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.tracks: List[Track] = []
+        self._track_ids = itertools.count(1)
+
+    def update(
+        self, names: Sequence[str], boxes: np.ndarray, zones: Sequence[Sequence[str]]
+    ) -> Tuple[List[TrackUpdate], List[Track]]:
+        """Match the targets found in a scan to the tracks.
+
+        names, boxes and zones describe each target. Returns the update of
+        each target, and the tracks that expired after max_age scans without
+        a match.
+        """
+        matches = self._match(names, boxes)
+        updates = []
+        matched_tracks = set()
+        for index, (name, box) in enumerate(zip(names, boxes)):
+            target_zones = frozenset(zones[index]) if zones else frozenset()
+            track = matches.get(index)
+            if track is None:
+                track = Track(next(self._track_ids), name, box, target_zones)
+                self.tracks.append(track)
+                updates.append(
+                    TrackUpdate(track.track_id, True, sorted(target_zones), [])
+                )
+            else:
+                updates.append(
+                    TrackUpdate(
+                        track.track_id,
+                        False,
+                        sorted(target_zones - track.zones),
+                        sorted(track.zones - target_zones),
+                    )
+                )
+                track.box = box
+                track.zones = target_zones
+                track.misses = 0
+            matched_tracks.add(track.track_id)
+
+        expired = []
+        for track in self.tracks:
+            if track.track_id not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_age:
+                    expired.append(track)
+        if expired:
+            self.tracks = [track for track in self.tracks if track not in expired]
+        return updates, expired
+
+    def _match(self, names: Sequence[str], boxes: np.ndarray) -> dict:
+        """Return the track matched to each target index, greedily by overlap."""
+        if not self.tracks or not len(names):
+            return {}
+        track_boxes = np.array([track.box for track in self.tracks])
+        overlaps = iou_matrix(track_boxes, np.asarray(boxes, dtype=float))
+        track_names = np.array([track.name for track in self.tracks])
+        overlaps[track_names[:, None] != np.array(names)[None, :]] = 0
+        candidates = np.argwhere(overlaps > self.iou_threshold)
+        order = np.argsort(-overlaps[candidates[:, 0], candidates[:, 1]], kind="stable")
+        matches = {}
+        matched_tracks = set()
+        for track_index, index in candidates[order].tolist():
+            if track_index in matched_tracks or index in matches:
+                continue
+            matched_tracks.add(track_index)
+            matches[index] = self.tracks[track_index]
+        return matches
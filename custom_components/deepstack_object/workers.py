@@ -0,0 +1,179 @@
+"""
+Worker processes for the pixel work of preparing and saving frames.
+
+Decoding, scaling, encoding and annotating frames hold the GIL for much of
+their time, so in executor threads they slow the event loop, and every
+other integration, under multi-camera load. With image_workers set this
+work runs in a small pool of worker processes shared by all entities, and
+the main process only makes the requests and fires the events.
+
+Frames are passed to the workers in shared memory rather than pickled
+through the pipe of the pool, and only the prepared request bodies, which
+are much smaller, are sent back. Workers are started with spawn, as forking
+a process with running threads is unsafe. If a worker dies the pool is
+restarted and the job runs in the calling thread.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+
+from .pipeline import (
+    FrameOptions,
+    PreparedFrame,
+    RelativeBox,
+    annotate_image,
+    prepare_frame,
+    render_frame,
+)
+from .writer import write_image
+
+if TYPE_CHECKING:
+    import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_WORKERS = "deepstack_object_workers"
+
+
+class SnapshotOptions(NamedTuple):
+    """How a frame is rendered and annotated for a snapshot, as on the entity."""
+
+    roi: RelativeBox
+    crop_roi: bool
+    scale: float
+    show_boxes: bool
+    zones: Sequence[Tuple[str, "np.ndarray"]]  # The name and polygon of each zone
+    save_format: str
+
+
+def read_shared(name: str, size: int) -> bytes:
+    """Return the frame in the shared memory block name."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+
+
+def run_prepare(name: str, size: int, options: FrameOptions) -> PreparedFrame:
+    """Prepare the frame in shared memory, in a worker."""
+    return prepare_frame(read_shared(name, size), options)
+
+
+def run_save(
+    name: str,
+    size: int,
+    options: SnapshotOptions,
+    targets: List[Dict],
+    path: Path,
+    link_paths: List[Path],
+) -> bool:
+    """Render, annotate and save the frame in shared memory, in a worker.
+
+    Returns False if the frame cannot be decoded.
+    """
+    from PIL import UnidentifiedImageError  # pylint: disable=import-outside-toplevel
+
+    try:
+        img = render_frame(
+            read_shared(name, size),
+            options.roi if options.crop_roi else None,
+            options.scale,
+        )
+    except (UnidentifiedImageError, OSError):
+        return False
+    if options.show_boxes:
+        annotate_image(img, targets, options.roi, options.crop_roi, options.zones)
+    write_image(img, path, options.save_format, link_paths)
+    return True
+
+
+class ImageWorkers:
+    """Run the pixel work of the entities in a pool of worker processes.
+
+    prepare and save block until the worker is done, they are called from
+    the executor and the writer thread, which release the GIL while waiting.
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+        self.stats = {"jobs": 0, "restarts": 0}
+
+    def start(self):
+        """Create the pool, worker processes are started on the first job."""
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def stop(self, *args):
+        """Finish the running jobs and stop the worker processes."""
+        self._executor.shutdown(wait=True)
+
+    def prepare(self, image: bytes, options: FrameOptions) -> PreparedFrame:
+        """Prepare image for a request in a worker, see prepare_frame."""
+        return self._run(run_prepare, image, options)
+
+    def save(
+        self,
+        image: bytes,
+        options: SnapshotOptions,
+        targets: List[Dict],
+        path: Path,
+        link_paths: Iterable[Path] = (),
+    ) -> bool:
+        """Render, annotate and save image in a worker, False if it is bad data."""
+        return self._run(run_save, image, options, targets, path, list(link_paths))
+
+    def _run(self, function, image: bytes, *args):
+        block = shared_memory.SharedMemory(create=True, size=max(1, len(image)))
+        try:
+            block.buf[: len(image)] = image
+            executor = self._executor
+            try:
+                future = executor.submit(function, block.name, len(image), *args)
+            except RuntimeError:
+                # Shut down, while the last queued snapshots are saved
+                return function(block.name, len(image), *args)
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                self._restart(executor)
+                result = function(block.name, len(image), *args)
+            self.stats["jobs"] += 1
+            return result
+        finally:
+            block.close()
+            block.unlink()
+
+    def _restart(self, broken: concurrent.futures.Executor):
+        with self._lock:
+            if self._executor is broken:
+                _LOGGER.warning("Deepstack image worker died, restarting the workers")
+                self.stats["restarts"] += 1
+                broken.shutdown(wait=False)
+                self.start()
+
+
+def get_workers(hass, processes: int) -> ImageWorkers:
+    """Return the shared worker pool, creating it on first use."""
+    workers = hass.data.get(DATA_WORKERS)
+    if workers is None:
+        workers = hass.data[DATA_WORKERS] = ImageWorkers(processes)
+        workers.start()
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, workers.stop)
+    elif workers.processes != processes:
+        _LOGGER.warning(
+            "Deepstack image workers already started with %s processes, not %s",
+            workers.processes,
+            processes,
+        )
+    return workers
@@ -0,0 +1,119 @@
+"""
+Background writer for annotated snapshots.
+
+Annotating and saving a snapshot can take hundreds of milliseconds on slow
+storage, so the work is queued to a single thread and detection events
+are fired without waiting for it. The queue is bounded: when it is full a
+snapshot is either dropped or the caller blocks until there is room.
+"""
+import logging
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_WRITER = "deepstack_object_writer"
+DEFAULT_SAVE_QUEUE_SIZE = 8
+POLICY_DROP = "drop"
+POLICY_BLOCK = "block"
+SAVE_QUEUE_POLICIES = [POLICY_DROP, POLICY_BLOCK]
+PIL_FORMATS = {"jpg": "JPEG", "png": "PNG"}
+
+
+def write_image(
+    img: "Image.Image", path: Path, save_format: str, link_paths: Iterable[Path] = ()
+):
+    """Save img to path atomically, then hardlink it to each of link_paths.
+
+    The image is written to a temporary file in the same folder which is
+    renamed over path, so readers never see a partially written file. Where
+    hardlinks are not supported the file is copied instead. The folders of
+    link_paths are created if needed.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    img.save(tmp_path, format=PIL_FORMATS[save_format])
+    for link_path in link_paths:
+        link_path.parent.mkdir(exist_ok=True)
+        try:
+            if link_path.exists():
+                link_path.unlink()
+            os.link(tmp_path, link_path)
+        except OSError:
+            shutil.copyfile(tmp_path, link_path)
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter:
+    """Run save jobs on a background thread."""
+
+    def __init__(self, max_queue: int = DEFAULT_SAVE_QUEUE_SIZE):
+        self._queue: "queue.Queue[Callable[[], None]]" = queue.Queue(max_queue)
+        self._thread = threading.Thread(
+            target=self._run, name="deepstack_object_writer", daemon=True
+        )
+        self.stats = {"saved": 0, "dropped": 0}
+
+    @property
+    def max_queue(self) -> int:
+        """Return the maximum number of queued jobs."""
+        return self._queue.maxsize
+
+    @max_queue.setter
+    def max_queue(self, value: int):
+        self._queue.maxsize = value
+
+    @property
+    def queued(self) -> int:
+        """Return the number of jobs waiting."""
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread.start()
+
+    def stop(self, *args):
+        """Finish the queued jobs and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, job: Callable[[], None], policy: str = POLICY_DROP) -> bool:
+        """Queue job, returning False if it was dropped because the queue is full."""
+        try:
+            self._queue.put(job, block=policy == POLICY_BLOCK)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            _LOGGER.warning("Deepstack save queue is full, snapshot dropped")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job()
+                self.stats["saved"] += 1
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Deepstack error saving snapshot")
+
+
+def get_writer(hass, max_queue: int) -> SnapshotWriter:
+    """Return the shared writer, starting it on first use."""
+    writer = hass.data.get(DATA_WRITER)
+    if writer is None:
+        writer = hass.data[DATA_WRITER] = SnapshotWriter(max_queue)
+        writer.start()
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, writer.stop)
+    else:
+        writer.max_queue = max(writer.max_queue, max_queue)
+    return writer